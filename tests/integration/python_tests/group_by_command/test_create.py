@@ -1,4 +1,5 @@
 import os
+import sys
 import unittest
 
 from tests.integration.python_tests.group_by_command.base import (
@@ -12,6 +13,35 @@ from tests.integration.python_tests.group_by_command.base import (
     write_file,
 )
 
+# A stand-in for `hsi`, storing the HPSS archive in a local directory.
+# It only knows the commands zstash runs.
+# Putting the file named by $FAKE_HSI_FAIL fails, to simulate an interrupted run.
+FAKE_HSI = """#!{python}
+import os, shutil, sys
+args = [a for a in sys.argv[1:] if a != "-q"]
+if args[:2] == ["mkdir", "-p"]:
+    os.makedirs(args[2], exist_ok=True)
+    sys.exit(0)
+hpss_dir = None
+for command in " ".join(args).split(";"):
+    words = command.split()
+    if words[0] == "cd":
+        hpss_dir = words[1]
+    elif words[0] == "ls":
+        print("\\n".join(os.listdir(hpss_dir)))
+    elif words[-1] == os.environ.get("FAKE_HSI_FAIL"):
+        sys.exit("fake hsi: failing on " + words[-1])
+    elif words[:3] == ["put", "-", ":"]:
+        with open(os.path.join(hpss_dir, words[3]), "wb") as f:
+            shutil.copyfileobj(sys.stdin.buffer, f)
+    elif words[0] == "put":
+        shutil.copy(words[1], hpss_dir)
+    elif words[0] == "get":
+        shutil.copy(os.path.join(hpss_dir, words[1]), words[1])
+    else:
+        sys.exit("fake hsi: unknown command " + command)
+"""
+
 
 class TestCreate(TestZstash):
     """
@@ -27,6 +57,10 @@ class TestCreate(TestZstash):
     # --keep            | | | | | |x| | |b| |
     # --cache           | | | | | | |x|x| | |
     # -v                |x| | | | | | | | | |
+    # --workers: CreateWorkers
+    # --packing: CreatePacking
+    # --stream: CreateStream, CreateResume
+    # --resume: CreateResume
 
     def helperCreateVerbose(self, test_name, hpss_path: str, zstash_path=ZSTASH_PATH):
         """
@@ -221,6 +255,194 @@ class TestCreate(TestZstash):
         # Test that the link in the src directory remains a link (i.e., is not a copied file)
         self.assertTrue(os.path.islink(f"{self.test_dir}/file0_soft.txt"))
 
+    def helperCreateWorkers(self, test_name, zstash_path=ZSTASH_PATH):
+        """
+        Test `zstash create --workers=3`, with one file per tar.
+        """
+        self.hpss_path = "none"
+        self.setupDirs(test_name)
+        print_starred("Adding files to local archive")
+        self.assertWorkspace()
+        cmd = "{}zstash create --workers=3 --maxsize=0.0000001 --hpss={} {}".format(
+            zstash_path, self.hpss_path, self.test_dir
+        )
+        output, err = run_cmd(cmd)
+        self.check_strings(
+            cmd,
+            output + err,
+            ["put: HPSS is unavailable", "Building 7 tars with 3 workers"],
+            ["ERROR"],
+        )
+        # Tars are numbered in file order, regardless of which worker finished first.
+        files = os.listdir("{}/{}".format(self.test_dir, self.cache))
+        expected_files = ["index.db"] + ["00000{}.tar".format(i) for i in range(7)]
+        if not compare(files, expected_files):
+            error_message = (
+                "The zstash cache does not contain expected files.\nIt has: {}".format(
+                    files
+                )
+            )
+            self.stop(error_message)
+        os.chdir(self.test_dir)
+        cmd = "{}zstash ls -l".format(zstash_path)
+        output, err = run_cmd(cmd)
+        os.chdir(TOP_LEVEL)
+        expected_present = [
+            "dir/file1.txt",
+            "000000.tar",
+            "file_empty.txt",
+            "000006.tar",
+        ]
+        self.check_strings(cmd, output + err, expected_present, ["ERROR"])
+        os.chdir(self.test_dir)
+        cmd = "{}zstash check".format(zstash_path)
+        output, err = run_cmd(cmd)
+        os.chdir(TOP_LEVEL)
+        self.check_strings(
+            cmd,
+            output + err,
+            ["No failures detected when checking the files."],
+            ["ERROR"],
+        )
+
+    def helperCreatePacking(self, test_name, zstash_path=ZSTASH_PATH):
+        """
+        Test `zstash create --packing=balanced`.
+        """
+        self.hpss_path = "none"
+        self.setupDirs(test_name)
+        print_starred("Adding files to local archive")
+        self.assertWorkspace()
+        cmd = "{}zstash create -v --packing=balanced --hpss={} {}".format(
+            zstash_path, self.hpss_path, self.test_dir
+        )
+        output, err = run_cmd(cmd)
+        self.check_strings(
+            cmd,
+            output + err,
+            [
+                "Planned 1 tars with balanced packing",
+                "Planned 000000.tar: 7 files",
+                "Archiving dir/file1.txt",
+            ],
+            ["ERROR"],
+        )
+        os.chdir(self.test_dir)
+        cmd = "{}zstash check".format(zstash_path)
+        output, err = run_cmd(cmd)
+        os.chdir(TOP_LEVEL)
+        self.check_strings(
+            cmd,
+            output + err,
+            ["No failures detected when checking the files."],
+            ["ERROR"],
+        )
+
+    def helperCreateStream(self, test_name, zstash_path=ZSTASH_PATH):
+        """
+        Test `zstash create --stream`, with a stand-in `hsi`.
+        """
+        self.hpss_path = "none"
+        self.setupDirs(test_name)
+        # The stand-in archive is removed with the backup directory.
+        fake_hpss = "{}/{}/hpss".format(TOP_LEVEL, self.backup_dir)
+        fake_bin = "{}/{}/bin".format(TOP_LEVEL, self.backup_dir)
+        os.makedirs(fake_bin)
+        write_file("{}/hsi".format(fake_bin), FAKE_HSI.format(python=sys.executable))
+        os.chmod("{}/hsi".format(fake_bin), 0o755)
+        path = os.environ["PATH"]
+        os.environ["PATH"] = "{}:{}".format(fake_bin, path)
+        try:
+            cmd = "{}zstash create --stream --maxsize=0.000001 --hpss={} {}".format(
+                zstash_path, fake_hpss, self.test_dir
+            )
+            output, err = run_cmd(cmd)
+        finally:
+            os.environ["PATH"] = path
+        self.check_strings(
+            cmd,
+            output + err,
+            ["Streaming file to HPSS: 000000.tar", "000005.tar was streamed to HPSS"],
+            ["ERROR"],
+        )
+        # Tars never touch the cache.
+        files = os.listdir("{}/{}".format(self.test_dir, self.cache))
+        if not compare(files, ["index.db"]):
+            self.stop("The zstash cache should only contain index.db: {}".format(files))
+        # The archive has every tar, with the sizes and digests in the database.
+        os.chdir(self.test_dir)
+        cmd = "{}zstash check --hpss=none --cache={}".format(zstash_path, fake_hpss)
+        output, err = run_cmd(cmd)
+        os.chdir(TOP_LEVEL)
+        self.check_strings(
+            cmd,
+            output + err,
+            ["000005.tar: Size check passed", "No failures detected"],
+            ["ERROR"],
+        )
+
+    def helperCreateResume(self, test_name, zstash_path=ZSTASH_PATH):
+        """
+        Test `zstash create --resume` after a failed transfer.
+        """
+        self.hpss_path = "none"
+        self.setupDirs(test_name)
+        fake_hpss = "{}/{}/hpss".format(TOP_LEVEL, self.backup_dir)
+        fake_bin = "{}/{}/bin".format(TOP_LEVEL, self.backup_dir)
+        os.makedirs(fake_bin)
+        write_file("{}/hsi".format(fake_bin), FAKE_HSI.format(python=sys.executable))
+        os.chmod("{}/hsi".format(fake_bin), 0o755)
+        path = os.environ["PATH"]
+        os.environ["PATH"] = "{}:{}".format(fake_bin, path)
+        try:
+            cmd = "{}zstash create --stream --maxsize=0.000001 --hpss={} {}".format(
+                zstash_path, fake_hpss, self.test_dir
+            )
+            os.environ["FAKE_HSI_FAIL"] = "000003.tar"
+            try:
+                output, err = run_cmd(cmd)
+            finally:
+                del os.environ["FAKE_HSI_FAIL"]
+            self.check_strings(
+                cmd,
+                output + err,
+                [
+                    "000002.tar was streamed to HPSS",
+                    "Error=Streaming file to HPSS: 000003.tar",
+                ],
+                ["000003.tar was streamed to HPSS"],
+            )
+            cmd = "{}zstash create --resume --stream --hpss={} {}".format(
+                zstash_path, fake_hpss, self.test_dir
+            )
+            output, err = run_cmd(cmd)
+        finally:
+            os.environ["PATH"] = path
+        self.check_strings(
+            cmd,
+            output + err,
+            [
+                "Resuming creation: 3 of 6 planned groups of files are already archived",
+                "000003.tar was streamed to HPSS",
+                "000005.tar was streamed to HPSS",
+            ],
+            ["ERROR", "000002.tar was streamed to HPSS"],
+        )
+        # The journal is gone once the archive is complete.
+        files = os.listdir("{}/{}".format(self.test_dir, self.cache))
+        if not compare(files, ["index.db"]):
+            self.stop("The zstash cache should only contain index.db: {}".format(files))
+        os.chdir(self.test_dir)
+        cmd = "{}zstash check --hpss=none --cache={}".format(zstash_path, fake_hpss)
+        output, err = run_cmd(cmd)
+        os.chdir(TOP_LEVEL)
+        self.check_strings(
+            cmd,
+            output + err,
+            ["No failures detected"],
+            ["ERROR"],
+        )
+
     def testCreateVerbose(self):
         self.helperCreateVerbose("testCreateVerbose", "none")
 
@@ -267,6 +489,18 @@ class TestCreate(TestZstash):
     def testCreateFollowSymlinks(self):
         self.helperCreateFollowSymlinks("testCreateFollowSymlinks")
 
+    def testCreateWorkers(self):
+        self.helperCreateWorkers("testCreateWorkers")
+
+    def testCreatePacking(self):
+        self.helperCreatePacking("testCreatePacking")
+
+    def testCreateStream(self):
+        self.helperCreateStream("testCreateStream")
+
+    def testCreateResume(self):
+        self.helperCreateResume("testCreateResume")
+
 
 if __name__ == "__main__":
     unittest.main()
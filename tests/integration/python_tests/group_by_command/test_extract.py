@@ -281,6 +281,51 @@ class TestExtract(TestZstash):
         expected_absent = ["ERROR", "Not extracting"]
         self.check_strings(cmd, output + err, expected_present, expected_absent)
 
+    def helperExtractSplitLargeFiles(self, test_name, zstash_path=ZSTASH_PATH):
+        """
+        Test `zstash extract` of files split across tars by `--split-large-files`.
+        """
+        self.hpss_path = "none"
+        self.setupDirs(test_name)
+        # About 2.5 parts of 1 MB (--maxsize=0.001 GB)
+        contents = os.urandom(2600000)
+        with open("{}/dir/large.bin".format(self.test_dir), "wb") as f:
+            f.write(contents)
+        print_starred("Adding files to local archive")
+        cmd = "{}zstash create -v --split-large-files --maxsize=0.001 --hpss={} {}".format(
+            zstash_path, self.hpss_path, self.test_dir
+        )
+        output, err = run_cmd(cmd)
+        self.check_strings(
+            cmd,
+            output + err,
+            ["Splitting 1 files across 3 tars", "in parts of at most 1073152 bytes"],
+            ["ERROR"],
+        )
+        os.rename(self.test_dir, self.backup_dir)
+        os.mkdir(self.test_dir)
+        os.chdir(self.test_dir)
+        shutil.copytree(
+            "{}/{}/{}".format(TOP_LEVEL, self.backup_dir, self.cache), self.copy_dir
+        )
+        cmd = "{}zstash extract --hpss={}".format(zstash_path, self.hpss_path)
+        output, err = run_cmd(cmd)
+        with open("dir/large.bin", "rb") as f:
+            extracted = f.read()
+        os.chdir(TOP_LEVEL)
+        self.check_strings(
+            cmd,
+            output + err,
+            [
+                "dir/large.bin: part 0 is in",
+                "dir/large.bin: part 2 is in",
+                "No failures detected when extracting the files.",
+            ],
+            ["ERROR"],
+        )
+        if extracted != contents:
+            self.stop("dir/large.bin was not reassembled correctly")
+
     def testExtractVerbose(self):
         self.helperExtractVerbose("testExtractVerbose", "none")
 
@@ -316,6 +361,9 @@ class TestExtract(TestZstash):
         self.conditional_hpss_skip()
         helperExtractTars(self, "testExtractTarsHPSS", HPSS_ARCHIVE)
 
+    def testExtractSplitLargeFiles(self):
+        self.helperExtractSplitLargeFiles("testExtractSplitLargeFiles")
+
     def testExtractFile(self):
         self.helperExtractFile("testExtractFile", "none")
 
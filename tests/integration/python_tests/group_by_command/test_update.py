@@ -25,6 +25,7 @@ class TestUpdate(TestZstash):
     # --dry-run | |x| | | |
     # --keep    | | |x| |b|
     # -v        | | | | |b|
+    # --digest: UpdateDigest
 
     def helperUpdate(self, test_name, hpss_path, zstash_path=ZSTASH_PATH):
         """
@@ -165,6 +166,80 @@ class TestUpdate(TestZstash):
             error_message = f"The zstash cache {self.test_dir}/{self.cache} does not contain expected files.\nIt has: {files}"
             self.stop(error_message)
 
+    def helperUpdateDigest(self, test_name, zstash_path=ZSTASH_PATH):
+        """
+        Test `zstash update --digest` on an archive created with `--digest=blake2b`.
+        """
+        self.hpss_path = "none"
+        self.setupDirs(test_name)
+        print_starred("Creating an archive with blake2b checksums")
+        self.assertWorkspace()
+        cmd = "{}zstash create --digest=blake2b --hpss={} {}".format(
+            zstash_path, self.hpss_path, self.test_dir
+        )
+        output, err = run_cmd(cmd)
+        self.check_strings(cmd, output + err, [], ["ERROR"])
+        write_file("{}/dir/file1.txt".format(self.test_dir), "file1 stuff with changes")
+
+        os.chdir(self.test_dir)
+        # A different digest can't be used to update the archive.
+        cmd = "{}zstash update --digest=md5 --hpss={}".format(
+            zstash_path, self.hpss_path
+        )
+        output, err = run_cmd(cmd)
+        self.check_strings(
+            cmd,
+            output + err,
+            ["does not match the archive's digest algorithm: blake2b"],
+            ["Archiving dir/file1.txt"],
+        )
+        # By default, the archive's digest is used.
+        cmd = "{}zstash update --hpss={}".format(zstash_path, self.hpss_path)
+        output, err = run_cmd(cmd)
+        self.check_strings(cmd, output + err, ["Archiving dir/file1.txt"], ["ERROR"])
+        cmd = "{}zstash check -v".format(zstash_path)
+        output, err = run_cmd(cmd)
+        self.check_strings(
+            cmd,
+            output + err,
+            ["Valid blake2b:", "No failures detected when checking the files."],
+            ["ERROR"],
+        )
+        os.chdir(TOP_LEVEL)
+
+    def helperUpdateFilesFrom(self, test_name, hpss_path, zstash_path=ZSTASH_PATH):
+        """
+        Test `zstash update --files-from`.
+        """
+        self.hpss_path = hpss_path
+        use_hpss = self.setupDirs(test_name)
+        self.create(use_hpss, zstash_path)
+        print_starred("Testing update with a list of files to consider")
+        self.assertWorkspace()
+        if not os.path.exists("{}/dir2".format(self.test_dir)):
+            os.mkdir("{}/dir2".format(self.test_dir))
+        write_file("{}/dir2/file2.txt".format(self.test_dir), "file2 stuff")
+        write_file("{}/dir/file1.txt".format(self.test_dir), "file1 stuff with changes")
+        # Only dir2/file2.txt is listed, so the change to dir/file1.txt is not seen
+        write_file("{}/new_files.txt".format(self.test_dir), "dir2/file2.txt\n")
+
+        os.chdir(self.test_dir)
+        cmd = "{}zstash update --dry-run --hpss={} --files-from=new_files.txt".format(
+            zstash_path, self.hpss_path
+        )
+        output, err = run_cmd(cmd)
+        os.chdir(TOP_LEVEL)
+        self.check_strings(
+            cmd,
+            output + err,
+            [
+                "Gathering the files listed in new_files.txt",
+                "List of files to be updated",
+                "dir2/file2.txt",
+            ],
+            ["ERROR", "dir/file1.txt"],
+        )
+
     def testUpdate(self):
         self.helperUpdate("testUpdate", "none")
 
@@ -200,6 +275,12 @@ class TestUpdate(TestZstash):
         self.conditional_hpss_skip()
         self.helperUpdateNonEmpty("testUpdateNonEmptyHPSS", HPSS_ARCHIVE)
 
+    def testUpdateFilesFrom(self):
+        self.helperUpdateFilesFrom("testUpdateFilesFrom", "none")
+
+    def testUpdateDigest(self):
+        self.helperUpdateDigest("testUpdateDigest")
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,35 @@
+import sqlite3
+
+import pytest
+
+from zstash.hpss_utils import BuiltTar
+
+
+@pytest.fixture
+def index_database():
+    """Fixture providing an in-memory index database, with files and tars tables."""
+    con = sqlite3.connect(":memory:", detect_types=sqlite3.PARSE_DECLTYPES)
+    cur = con.cursor()
+    cur.execute(
+        "create table files (id integer primary key, name text, size integer, mtime timestamp, md5 text, tar text, offset integer);"
+    )
+    cur.execute(
+        "create table tars (id integer primary key, name text, size integer, md5 text);"
+    )
+    con.commit()
+
+    yield con, cur
+
+    con.close()
+
+
+@pytest.fixture
+def make_built_tar():
+    """Fixture providing a function that makes a built tar holding one file."""
+
+    def make(tfname):
+        return BuiltTar(
+            tfname, 1024, "abc", [(f"{tfname}.txt", 1, None, "x", tfname, 0)]
+        )
+
+    return make
@@ -0,0 +1,276 @@
+import argparse
+import collections
+import hashlib
+import os
+import queue
+import sqlite3
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import List
+
+import pytest
+
+from zstash import extract
+from zstash.extract import (
+    TarPrefetcher,
+    extract_worker,
+    extractFiles,
+    pread_member,
+    queue_tasks,
+    retrieve_tar,
+    skip_extracted_tars,
+)
+from zstash.parallel import ExtractWorker
+from zstash.settings import FilesRow, config, logger
+from zstash.transfer_tracking import CacheBudget
+
+
+def fake_hpss(monkeypatch, fetched: List[str]):
+    monkeypatch.setattr(config, "hpss", "/hpss/archive")
+
+    def fake_hpss_get(hpss: str, file_path: str, cache: str):
+        fetched.append(os.path.basename(file_path))
+        with open(file_path, "wb") as f:
+            f.write(b"x" * 10)
+
+    monkeypatch.setattr(extract, "hpss_get", fake_hpss_get)
+
+
+def test_tar_prefetcher_keeps_tars_ahead(tmp_path, monkeypatch):
+    fetched: List[str] = []
+    fake_hpss(monkeypatch, fetched)
+    tars = ["00000{}.tar".format(i) for i in range(5)]
+    prefetcher = TarPrefetcher(tars, str(tmp_path), {}, 2)
+
+    prefetcher.next_tar(tars[0])
+    # The current tar is there; the 2 next ones may still be coming
+    assert (tmp_path / tars[0]).exists()
+    assert list(prefetcher.fetching) == tars[1:3]
+    prefetcher.next_tar(tars[1])
+    assert list(prefetcher.fetching) == tars[2:4]
+    prefetcher.close(keep_tars=False)
+    assert sorted(fetched) == tars[:4]
+    # Fetched, but never processed
+    assert not (tmp_path / tars[2]).exists()
+    assert not (tmp_path / tars[3]).exists()
+
+
+def test_tar_prefetcher_budget(tmp_path, monkeypatch):
+    fetched: List[str] = []
+    fake_hpss(monkeypatch, fetched)
+    tars = ["00000{}.tar".format(i) for i in range(5)]
+    sizes = {tar: 10 for tar in tars}
+    # The current tar is always fetched, even over the budget
+    prefetcher = TarPrefetcher(tars, str(tmp_path), sizes, 3, CacheBudget(max_bytes=5))
+    prefetcher.next_tar(tars[0])
+    assert prefetcher.fetching == {}
+    prefetcher.close(keep_tars=True)
+
+    prefetcher = TarPrefetcher(tars, str(tmp_path), sizes, 3, CacheBudget(max_bytes=25))
+    prefetcher.next_tar(tars[0])
+    assert list(prefetcher.fetching) == tars[1:2]
+    prefetcher.next_tar(tars[2])
+    assert list(prefetcher.fetching) == tars[1:2] + tars[3:4]
+    prefetcher.close(keep_tars=True)
+    assert (tmp_path / tars[3]).exists()
+
+
+def test_failed_prefetch_counts_as_a_try(tmp_path, monkeypatch):
+    fetched: List[str] = []
+    monkeypatch.setattr(config, "hpss", "/hpss/archive")
+
+    def failing_hpss_get(hpss: str, file_path: str, cache: str):
+        fetched.append(os.path.basename(file_path))
+        with open(file_path, "wb") as f:
+            f.write(b"x" * (5 if len(fetched) == 1 else 10))
+        if len(fetched) == 1:
+            raise RuntimeError("Transfer interrupted")
+
+    monkeypatch.setattr(extract, "hpss_get", failing_hpss_get)
+    tfname = str(tmp_path / "000000.tar")
+    prefetcher = TarPrefetcher(["000000.tar"], str(tmp_path), {}, 1)
+    error = prefetcher.next_tar("000000.tar")
+    prefetcher.close(keep_tars=True)
+    assert isinstance(error, RuntimeError)
+
+    # Without a retry left, the prefetch's error is raised
+    args = argparse.Namespace(retries=0, error_on_duplicate_tar=False)
+    with pytest.raises(RuntimeError):
+        retrieve_tar(tfname, str(tmp_path), None, args, prefetch_error=error)
+    # The partial tar isn't taken as complete, but fetched again
+    (tmp_path / "000000.tar").write_bytes(b"x" * 5)
+    args.retries = 1
+    retrieve_tar(tfname, str(tmp_path), None, args, prefetch_error=error)
+    assert fetched == ["000000.tar", "000000.tar"]
+    assert (tmp_path / "000000.tar").stat().st_size == 10
+
+
+def test_extract_worker_takes_a_task_at_a_time(tmp_path, monkeypatch):
+    fetched: List[str] = []
+    fake_hpss(monkeypatch, fetched)
+    sqlite3.connect(str(tmp_path / "index.db")).close()
+    mtime = datetime(2020, 1, 1)
+    tasks = [
+        [FilesRow((i, "{}.txt".format(i), 1, mtime, None, "00000{}.tar".format(i), 0))]
+        for i in range(4)
+    ]
+    task_queue: queue.Queue = queue.Queue()
+    for task in tasks:
+        task_queue.put((task, None))
+    task_queue.put(None)
+
+    # Tasks left on the queue as each one is extracted
+    left: List[int] = []
+
+    def fake_extract_files(files, *args):
+        left.append(task_queue.qsize())
+        prefetcher = args[-1]
+        prefetcher.next_tar(files[0].tar)
+        # The next tar taken is downloading
+        assert list(prefetcher.fetching) == [
+            task[0].tar
+            for task in tasks[files[0].identifier + 1 : files[0].identifier + 2]
+        ]
+        if files[0].tar == "000002.tar":
+            raise RuntimeError("Corrupt tar")
+        return []
+
+    monkeypatch.setattr(extract, "extractFiles", fake_extract_files)
+    monkeypatch.setattr(logger, "handlers", [])
+    monkeypatch.setattr(logger, "propagate", True)
+    output_queue: queue.Queue = queue.Queue()
+    args = argparse.Namespace(prefetch=1, prefetch_budget=None)
+    extract_worker(
+        task_queue, True, True, str(tmp_path), args, ExtractWorker(output_queue)
+    )
+
+    # One tar downloading ahead, the others left for the other workers,
+    # and the stop signal
+    assert left == [3, 2, 1, 0]
+    assert sorted(fetched) == [task[0].tar for task in tasks]
+    messages = []
+    while not output_queue.empty():
+        messages.append(output_queue.get_nowait())
+    # The files of a tar that couldn't be extracted are failures
+    assert messages[-1] == tasks[2]
+
+
+def test_extract_files_cleans_up_when_a_tar_cannot_be_got(
+    tmp_path, monkeypatch, index_database
+):
+    con, cur = index_database
+    fake_hpss(monkeypatch, [])
+    monkeypatch.setattr(config, "digest", "md5")
+
+    def fail(*args):
+        raise RuntimeError("hsi get failed")
+
+    monkeypatch.setattr(extract, "retrieve_tar", fail)
+    closed: List[bool] = []
+    monkeypatch.setattr(
+        TarPrefetcher, "close", lambda self, keep_tars: closed.append(keep_tars)
+    )
+    shutdown: List[ThreadPoolExecutor] = []
+    original_shutdown = ThreadPoolExecutor.shutdown
+
+    def record_shutdown(self, *args, **kwargs):
+        shutdown.append(self)
+        original_shutdown(self, *args, **kwargs)
+
+    monkeypatch.setattr(ThreadPoolExecutor, "shutdown", record_shutdown)
+    mtime = datetime(2020, 1, 1)
+    rows = [
+        FilesRow((i, "{}.txt".format(i), 1, mtime, None, "00000{}.tar".format(i), 0))
+        for i in range(2)
+    ]
+    args = argparse.Namespace(
+        prefetch=1,
+        prefetch_budget=None,
+        tar_threads=2,
+        retries=0,
+        error_on_duplicate_tar=False,
+    )
+    with pytest.raises(RuntimeError):
+        extractFiles(rows, True, False, str(tmp_path), cur, args)
+    # The threads are stopped, and the tars fetched ahead removed
+    assert len(shutdown) == 1
+    assert closed == [False]
+
+
+def test_queue_tasks_as_requested():
+    class FakeRetriever:
+        def __init__(self):
+            self.task_ids = {"000000.tar": "task0", "000001.tar": "task0"}
+
+        def is_pending(self, name: str) -> bool:
+            return name not in self.task_ids
+
+    mtime = datetime(2020, 1, 1)
+    tar_to_matches = {
+        "00000{}.tar".format(i): [
+            FilesRow(
+                (i, "{}.txt".format(i), 1, mtime, None, "00000{}.tar".format(i), 0)
+            )
+        ]
+        for i in range(3)
+    }
+    tars_to_queue = collections.deque(tar_to_matches)
+    task_queue: queue.Queue = queue.Queue()
+    retriever = FakeRetriever()
+    queue_tasks(task_queue, tars_to_queue, tar_to_matches, 2, retriever)
+    # Up to the tar that hasn't been requested yet, with their tasks
+    assert [task_queue.get_nowait() for _ in range(task_queue.qsize())] == [
+        (tar_to_matches["000000.tar"], "task0"),
+        (tar_to_matches["000001.tar"], "task0"),
+    ]
+    retriever.task_ids["000002.tar"] = "task1"
+    queue_tasks(task_queue, tars_to_queue, tar_to_matches, 2, retriever)
+    # Then the stop signals
+    assert [task_queue.get_nowait() for _ in range(task_queue.qsize())] == [
+        (tar_to_matches["000002.tar"], "task1"),
+        None,
+        None,
+    ]
+
+
+def test_skip_extracted_tars(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    mtime = datetime(2020, 1, 1)
+    rows = [
+        FilesRow((1, "a.txt", 3, mtime, None, "000000.tar", 0)),
+        FilesRow((2, "b.txt", 3, mtime, None, "000000.tar", 512)),
+        FilesRow((3, "c.txt", 3, mtime, None, "000001.tar", 0)),
+        FilesRow((4, "d.txt", 3, mtime, None, "000002.tar", 0)),
+    ]
+    # a.txt and b.txt are up to date, c.txt has changed, d.txt is missing
+    timestamp = (mtime - datetime(1970, 1, 1)).total_seconds()
+    for name, content in (("a.txt", "aaa"), ("b.txt", "bbb"), ("c.txt", "cc")):
+        (tmp_path / name).write_text(content)
+        os.utime(name, (timestamp, timestamp))
+
+    remaining = skip_extracted_tars(rows, {"000001.tar": 1024})
+    assert [row.name for row in remaining] == ["c.txt", "d.txt"]
+
+
+def test_pread_member(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    data = os.urandom(3 * 1024 + 7)
+    (tmp_path / "src.bin").write_bytes(data)
+    with tarfile.open("000000.tar", "w") as tar:
+        tar.add("src.bin", arcname="a.bin")
+        tar.add("src.bin", arcname="b.bin")
+    with tarfile.open("000000.tar", "r") as tar:
+        members = tar.getmembers()
+    monkeypatch.setattr(extract, "TAR_THREADS_BLOCK_SIZE", 1024)
+
+    fd = os.open("000000.tar", os.O_RDONLY)
+    try:
+        md5 = hashlib.md5(data).hexdigest()
+        assert pread_member(fd, members[1], True, "md5") == md5
+        assert (tmp_path / "b.bin").read_bytes() == data
+        # Checking only
+        assert pread_member(fd, members[0], False, "md5") == md5
+        assert not (tmp_path / "a.bin").exists()
+    finally:
+        os.close(fd)
@@ -0,0 +1,262 @@
+import os
+from typing import Dict, List, Optional
+from unittest.mock import MagicMock
+
+import pytest
+
+from zstash.globus import GLOBUS_MAX_ACTIVE_TASKS, GlobusRetriever
+from zstash.transfer_tracking import CacheBudget, GlobusConfig
+
+
+class FakeGlobus:
+    """
+    Stands in for a TransferClient: each submitted task "transfers" its tars
+    into the cache the second time its status is checked.
+    With `slow`, the task is still active then,
+    and only its first tar has been reported as transferred.
+    """
+
+    def __init__(self, sizes: Dict[str, int], fail: List[str], slow: bool = False):
+        self.sizes: Dict[str, int] = sizes
+        # Tars that are missing from the archive
+        self.fail: List[str] = fail
+        self.slow: bool = slow
+        self.tasks: Dict[str, List[Dict[str, str]]] = {}
+        self.polls: Dict[str, int] = {}
+        self.succeeded: Dict[str, List[Dict[str, str]]] = {}
+        self.client: MagicMock = MagicMock()
+        self.client.submit_transfer.side_effect = self.submit_transfer
+        self.client.get_task.side_effect = self.get_task
+        self.client.paginated.task_successful_transfers.side_effect = (
+            self.task_successful_transfers
+        )
+
+    def submit_transfer(self, transfer_data):
+        task_id: str = "task{}".format(len(self.tasks))
+        self.tasks[task_id] = list(transfer_data["DATA"])
+        self.polls[task_id] = 0
+        self.succeeded[task_id] = []
+        return {"task_id": task_id}
+
+    def get_task(self, task_id: str):
+        self.polls[task_id] += 1
+        if self.polls[task_id] == 1:
+            return {"status": "ACTIVE"}
+        if self.slow and self.polls[task_id] == 2:
+            self.succeeded[task_id] = self.tasks[task_id][:1]
+            status = "ACTIVE"
+        else:
+            self.succeeded[task_id] = list(self.tasks[task_id])
+            status = "SUCCEEDED"
+        for item in self.tasks[task_id]:
+            name: str = os.path.basename(item["destination_path"])
+            if name in self.fail:
+                self.succeeded[task_id].remove(item)
+                status = "FAILED"
+            else:
+                with open(item["destination_path"], "wb") as f:
+                    f.write(b"x" * self.sizes.get(name, 1))
+        return {"status": status, "files_transferred": len(self.succeeded[task_id])}
+
+    def task_successful_transfers(self, task_id: str):
+        paginator: MagicMock = MagicMock()
+        paginator.items.return_value = list(self.succeeded[task_id])
+        return paginator
+
+
+def make_retriever(
+    tmp_path,
+    fake: FakeGlobus,
+    sizes: Dict[str, int],
+    budget: Optional[CacheBudget] = None,
+):
+    globus_config = GlobusConfig()
+    globus_config.local_endpoint = "local-uuid"
+    globus_config.remote_endpoint = "remote-uuid"
+    globus_config.transfer_client = fake.client
+    return GlobusRetriever(
+        "globus://remote-uuid/~/archive",
+        str(tmp_path),
+        sizes,
+        budget,
+        globus_config=globus_config,
+        poll_interval=0,
+    )
+
+
+def test_globus_retriever_batches_tars(tmp_path):
+    sizes = {"{:06x}.tar".format(i): 10 * (i + 1) for i in range(7)}
+    # Already in the cache
+    (tmp_path / "000000.tar").write_bytes(b"x" * 10)
+    fake = FakeGlobus(sizes, fail=[])
+    retriever = make_retriever(tmp_path, fake, sizes)
+    retriever.submit(sorted(sizes))
+
+    # The 6 missing tars, in order, in as many tasks as Globus runs at once
+    assert fake.client.submit_transfer.call_count == GLOBUS_MAX_ACTIVE_TASKS
+    items = [item for task in fake.tasks.values() for item in task]
+    assert [item["source_path"] for item in items] == [
+        "/~/archive/{:06x}.tar".format(i) for i in range(1, 7)
+    ]
+    assert [item["destination_path"] for item in items] == [
+        str(tmp_path / "{:06x}.tar".format(i)) for i in range(1, 7)
+    ]
+
+    # Not submitted, so left to hpss_get
+    assert not retriever.wait_for(str(tmp_path / "000000.tar"))
+    for i in range(1, 7):
+        name = "{:06x}.tar".format(i)
+        assert retriever.wait_for(str(tmp_path / name))
+        assert (tmp_path / name).stat().st_size == sizes[name]
+    # Each task is polled until its tars land, not once per tar
+    assert fake.client.get_task.call_count == 2 * GLOBUS_MAX_ACTIVE_TASKS
+
+
+def test_globus_retriever_failed_task(tmp_path):
+    sizes = {"000000.tar": 10}
+    fake = FakeGlobus(sizes, fail=["000000.tar"])
+    retriever = make_retriever(tmp_path, fake, sizes)
+    retriever.submit(["000000.tar"])
+    with pytest.raises(RuntimeError):
+        retriever.wait_for(str(tmp_path / "000000.tar"))
+    # The retry gets it some other way
+    assert not retriever.wait_for(str(tmp_path / "000000.tar"))
+
+
+def test_globus_retriever_without_sizes(tmp_path):
+    # Archives without a tars table: a tar is only complete once Globus lists it
+    fake = FakeGlobus({}, fail=[])
+    retriever = make_retriever(tmp_path, fake, {})
+    retriever.submit(["000000.tar", "000001.tar"])
+    assert fake.client.submit_transfer.call_count == 2
+    assert retriever.wait_for(str(tmp_path / "000001.tar"))
+    assert fake.client.get_task.call_count == 2
+
+
+def test_globus_retriever_waits_for_confirmed_transfers(tmp_path):
+    sizes = {"{:06x}.tar".format(i): 10 for i in range(2 * GLOBUS_MAX_ACTIVE_TASKS)}
+    fake = FakeGlobus(sizes, fail=[], slow=True)
+    retriever = make_retriever(tmp_path, fake, sizes)
+    retriever.submit(sorted(sizes))
+    assert fake.tasks["task0"][1]["destination_path"] == str(tmp_path / "000001.tar")
+
+    # Reported as transferred while the task is still active
+    assert retriever.wait_for(str(tmp_path / "000000.tar"))
+    assert fake.polls["task0"] == 2
+    assert "task0" not in retriever.task_statuses
+    # The whole size, but not confirmed until the next poll
+    assert (tmp_path / "000001.tar").stat().st_size == 10
+    assert retriever.wait_for(str(tmp_path / "000001.tar"))
+    assert fake.polls["task0"] == 3
+    # Its successful transfers are listed again only once there are more
+    assert fake.client.paginated.task_successful_transfers.call_count == 2
+
+
+def test_globus_retriever_keeps_to_the_budget(tmp_path):
+    sizes = {"{:06x}.tar".format(i): 10 for i in range(10)}
+    fake = FakeGlobus(sizes, fail=[])
+    retriever = make_retriever(tmp_path, fake, sizes, CacheBudget(max_tars=6))
+    retriever.submit(sorted(sizes))
+
+    def requested() -> List[List[str]]:
+        return [
+            [os.path.basename(item["destination_path"]) for item in task]
+            for task in fake.tasks.values()
+        ]
+
+    # As many tars as the budget allows, in as many tasks as Globus runs at once
+    assert requested() == [
+        ["000000.tar", "000001.tar"],
+        ["000002.tar", "000003.tar"],
+        ["000004.tar", "000005.tar"],
+    ]
+    assert retriever.is_pending("000006.tar")
+    # A tar done with isn't worth a task of its own
+    assert retriever.wait_for(str(tmp_path / "000000.tar"))
+    retriever.done(str(tmp_path / "000000.tar"))
+    assert len(fake.tasks) == GLOBUS_MAX_ACTIVE_TASKS
+    # Two are
+    assert retriever.wait_for(str(tmp_path / "000001.tar"))
+    retriever.done(str(tmp_path / "000001.tar"))
+    assert requested()[-1] == ["000006.tar", "000007.tar"]
+    for i in range(2, 10):
+        name = "{:06x}.tar".format(i)
+        assert retriever.wait_for(str(tmp_path / name))
+        assert len(retriever.held) <= 6
+        retriever.done(str(tmp_path / name))
+    assert requested()[-1] == ["000008.tar", "000009.tar"]
+    assert not retriever.held
+
+
+def test_globus_retriever_requests_a_tar_needed_early(tmp_path):
+    sizes = {"{:06x}.tar".format(i): 10 for i in range(4)}
+    fake = FakeGlobus(sizes, fail=[])
+    retriever = make_retriever(tmp_path, fake, sizes, CacheBudget(max_tars=1))
+    retriever.submit(sorted(sizes))
+    assert len(fake.tasks) == 1
+    # E.g. for a file split across tars
+    assert retriever.wait_for(str(tmp_path / "000003.tar"))
+    assert not retriever.is_pending("000003.tar")
+    assert len(fake.tasks) == 2
+
+
+def test_globus_retriever_refetches_partial_tars(tmp_path):
+    sizes = {"000000.tar": 10}
+    # Too small, or of unknown size: may be a partial download
+    (tmp_path / "000000.tar").write_bytes(b"x" * 5)
+    (tmp_path / "000001.tar").write_bytes(b"x" * 5)
+    fake = FakeGlobus(sizes, fail=[])
+    retriever = make_retriever(tmp_path, fake, sizes)
+    retriever.submit(["000000.tar", "000001.tar"])
+    items = [item for task in fake.tasks.values() for item in task]
+    assert [item["source_path"] for item in items] == [
+        "/~/archive/000000.tar",
+        "/~/archive/000001.tar",
+    ]
+
+
+def test_globus_retriever_gives_up_on_inactive_task(tmp_path):
+    sizes = {"{:06x}.tar".format(i): 10 for i in range(GLOBUS_MAX_ACTIVE_TASKS + 1)}
+    fake = FakeGlobus(sizes, fail=[])
+    fake.client.get_task.side_effect = lambda task_id: {"status": "INACTIVE"}
+    retriever = make_retriever(tmp_path, fake, sizes)
+    retriever.submit(sorted(sizes))
+    last_task = "task{}".format(GLOBUS_MAX_ACTIVE_TASKS - 1)
+    first, second = [
+        os.path.basename(item["destination_path"]) for item in fake.tasks[last_task]
+    ]
+    with pytest.raises(RuntimeError):
+        retriever.wait_for(str(tmp_path / first))
+    fake.client.cancel_task.assert_called_once_with(last_task)
+    # The retry gets it some other way
+    assert not retriever.wait_for(str(tmp_path / first))
+    # The other tar of the task isn't waited for either
+    with pytest.raises(RuntimeError):
+        retriever.wait_for(str(tmp_path / second))
+    assert fake.client.get_task.call_count == 1
+
+
+def test_globus_retriever_gives_up_on_fatal_error(tmp_path):
+    sizes = {"000000.tar": 10}
+    fake = FakeGlobus(sizes, fail=[])
+    fake.client.get_task.side_effect = lambda task_id: {
+        "status": "ACTIVE",
+        "fatal_error": {"code": "PERMISSION_DENIED"},
+    }
+    retriever = make_retriever(tmp_path, fake, sizes)
+    retriever.submit(["000000.tar"])
+    with pytest.raises(RuntimeError):
+        retriever.wait_for(str(tmp_path / "000000.tar"))
+    fake.client.cancel_task.assert_called_once_with("task0")
+
+
+def test_globus_retriever_times_out(tmp_path):
+    sizes = {"000000.tar": 10}
+    fake = FakeGlobus(sizes, fail=[])
+    fake.client.get_task.side_effect = lambda task_id: {"status": "ACTIVE"}
+    retriever = make_retriever(tmp_path, fake, sizes)
+    retriever.timeout = 0
+    retriever.submit(["000000.tar"])
+    with pytest.raises(RuntimeError):
+        retriever.wait_for(str(tmp_path / "000000.tar"))
+    fake.client.cancel_task.assert_called_once_with("task0")
@@ -0,0 +1,410 @@
+import hashlib
+import io
+import os
+import tarfile
+import threading
+from datetime import datetime
+
+import pytest
+
+from zstash import hpss_utils
+from zstash.hpss_utils import BlockStage, DevOptions, TransferPipeline
+from zstash.journal import CreateJournal
+from zstash.transfer_tracking import (
+    TaskStatus,
+    TransferBatch,
+    TransferManager,
+    parse_cache_budget,
+)
+from zstash.utils import FileStats
+
+
+def make_file_stats(sizes):
+    file_stats = FileStats()
+    for path, size in sizes.items():
+        file_stats.add(path, size, 0)
+    return file_stats
+
+
+def test_transfer_pipeline_records_tars_after_transfer(
+    monkeypatch, index_database, make_built_tar
+):
+    con, cur = index_database
+    dev_options = DevOptions(False, False, "")
+    release_first = threading.Event()
+    transferred = []
+
+    def fake_transfer_tar(built_tar, cache, keep, non_blocking, transfer_manager):
+        if built_tar.tfname == "000000.tar":
+            # Hold the first transfer until the test says so
+            release_first.wait(timeout=10)
+        transferred.append(built_tar.tfname)
+
+    monkeypatch.setattr(hpss_utils, "transfer_tar", fake_transfer_tar)
+    pipeline = TransferPipeline(
+        "zstash", False, False, None, False, cur, con, dev_options  # type: ignore
+    )
+
+    pipeline.submit(make_built_tar("000000.tar"))
+    # The first tar is still transferring, so it's not in the database yet.
+    cur.execute("select count(*) from tars")
+    assert cur.fetchone()[0] == 0
+
+    release_first.set()
+    pipeline.submit(make_built_tar("000001.tar"))
+    # Submitting the second tar waited for the first one to be recorded.
+    cur.execute("select name from tars")
+    assert cur.fetchall() == [("000000.tar",)]
+
+    pipeline.close()
+    assert transferred == ["000000.tar", "000001.tar"]
+    cur.execute("select name, tar from files order by id")
+    assert cur.fetchall() == [
+        ("000000.tar.txt", "000000.tar"),
+        ("000001.tar.txt", "000001.tar"),
+    ]
+
+
+def test_transfer_pipeline_journals_tars_once_transferred(
+    tmp_path, monkeypatch, index_database, make_built_tar
+):
+    con, cur = index_database
+    batch = TransferBatch()
+    batch.is_globus = True
+    batch.task_id = "task0"
+    batch.task_status = TaskStatus.ACTIVE
+
+    def fake_transfer_tar(built_tar, cache, keep, non_blocking, transfer_manager):
+        # A non-blocking Globus transfer, still going
+        return batch
+
+    monkeypatch.setattr(hpss_utils, "transfer_tar", fake_transfer_tar)
+    journal = CreateJournal(str(tmp_path))
+    journal.start([["a"], ["b"]], [0, 1], [0, 0])
+    pipeline = TransferPipeline(
+        str(tmp_path), False, True, TransferManager(), False, cur, con, DevOptions(False, False, ""), journal  # type: ignore
+    )
+    pipeline.submit(make_built_tar("000000.tar"))
+    pipeline.submit(make_built_tar("000001.tar"))
+    # In the database, but not in the journal
+    cur.execute("select count(*) from tars")
+    assert cur.fetchone()[0] == 1
+    assert journal.done == {}
+
+    batch.task_status = TaskStatus.SUCCEEDED
+    pipeline.close()
+    assert sorted(journal.done) == ["000000.tar", "000001.tar"]
+
+
+def test_transfer_pipeline_raises_transfer_errors(
+    monkeypatch, index_database, make_built_tar
+):
+    con, cur = index_database
+    dev_options = DevOptions(False, False, "")
+
+    def failing_transfer_tar(built_tar, cache, keep, non_blocking, transfer_manager):
+        raise RuntimeError("Transferring file to HPSS")
+
+    monkeypatch.setattr(hpss_utils, "transfer_tar", failing_transfer_tar)
+    pipeline = TransferPipeline(
+        "zstash", False, False, None, False, cur, con, dev_options  # type: ignore
+    )
+    pipeline.submit(make_built_tar("000000.tar"))
+    with pytest.raises(RuntimeError, match="Transferring file to HPSS"):
+        pipeline.close()
+    # A tar that failed to transfer is never added to the database.
+    cur.execute("select count(*) from tars")
+    assert cur.fetchone()[0] == 0
+
+
+def test_plan_tars_splits_contiguous_groups():
+    file_stats = make_file_stats({"a": 100, "b": 1000, "c": 10, "d": 5000, "e": 0})
+    # a (1024) + b (1536) fit under 3000; c would overflow.
+    # d alone is over the limit, so it gets its own tar.
+    assert hpss_utils.plan_tars(file_stats, 3000) == [[0, 1], [2], [3], [4]]
+    assert hpss_utils.plan_tars(FileStats(), 3000) == []
+
+
+def test_plan_tars_counts_long_name_headers(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    directory = "d" * 140
+    os.mkdir(directory)
+    names = [f"{directory}/{i}.bin" for i in range(3)] + ["été.bin"]
+    for name in names:
+        (tmp_path / name).write_bytes(os.urandom(1000))
+    file_stats = make_file_stats({name: 1000 for name in names})
+    # Each file would fit 3 to a tar with a 512-byte header
+    max_size = 3 * (512 + 1024)
+    for packing in ["sequential", "balanced"]:
+        for group in hpss_utils.plan_tars(file_stats, max_size, packing):
+            tar_wrapper = hpss_utils.TarWrapper(0, ".", True, False)
+            for j in group:
+                tar_info = tar_wrapper.tar.gettarinfo(file_stats.path(j))
+                tar_wrapper.process_file(file_stats.path(j), tar_info, [], [])
+            # What the members take, before the end of the archive
+            assert tar_wrapper.tar.offset <= max_size
+            tar_wrapper.close([])
+    assert hpss_utils.estimate_tar_entry_size(1000, names[0]) == 2560
+    assert hpss_utils.estimate_tar_entry_size(1000, names[3]) == 2560
+    assert hpss_utils.estimate_tar_entry_size(1000, "short.bin") == 1536
+    # Parts of a split file with a long name leave room for their headers
+    assert hpss_utils.split_chunk_size(4096, names[0]) == 2560
+    assert hpss_utils.split_chunk_size(4096, "short.bin") == 3584
+
+
+def test_tar_wrapper_matches_tarfile_addfile(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    contents = {
+        # Many times the block size, so the buffers are reused
+        "big.bin": os.urandom(100 * 1024 + 17),
+        "small.txt": b"file0 stuff",
+        "blocks.bin": os.urandom(2 * 512),
+        "empty.txt": b"",
+    }
+    for name, data in contents.items():
+        (tmp_path / name).write_bytes(data)
+    os.mkdir("dir")
+    os.symlink("small.txt", "soft.txt")
+    os.link("big.bin", "hard.bin")
+    names = ["big.bin", "small.txt", "blocks.bin", "empty.txt", "dir"]
+    names += ["soft.txt", "hard.bin"]
+    os.mkdir("cache")
+
+    # The tar written by TarWrapper, with a small block size...
+    tar_wrapper = hpss_utils.TarWrapper(0, "cache", True, False, block_size=4096)
+    archived: list = []
+    failures: list = []
+    for name in names:
+        tar_info = tar_wrapper.tar.gettarinfo(name)
+        if tar_info.islnk():
+            tar_info.size = os.path.getsize(name)
+        tar_wrapper.process_file(name, tar_info, archived, failures)
+    built_tar = tar_wrapper.close(archived)
+
+    # ...is identical to the one tarfile writes on its own.
+    expected = io.BytesIO()
+    with tarfile.open(mode="w", fileobj=expected) as expected_tar:
+        for name in names:
+            tar_info = expected_tar.gettarinfo(name)
+            if tar_info.islnk():
+                tar_info.size = os.path.getsize(name)
+            if tar_info.size > 0:
+                with open(name, "rb") as f:
+                    expected_tar.addfile(tar_info, f)
+            else:
+                expected_tar.addfile(tar_info)
+    written = (tmp_path / "cache" / "000000.tar").read_bytes()
+    assert written == expected.getvalue()
+    assert failures == []
+    assert built_tar.size == len(written)
+    assert built_tar.md5 == hashlib.md5(written).hexdigest()
+
+    md5s = {row[0]: row[3] for row in archived}
+    for name, data in contents.items():
+        assert md5s[name] == hashlib.md5(data).hexdigest()
+    assert md5s["hard.bin"] == md5s["big.bin"]
+    assert md5s["dir"] is None
+    # Offsets point at each member's header.
+    with tarfile.open(tmp_path / "cache" / "000000.tar") as tar:
+        assert [(m.name, m.offset) for m in tar.getmembers()] == [
+            (row[0], row[5]) for row in archived
+        ]
+
+
+def test_block_stage_reraises_errors():
+    def consume(item):
+        raise OSError("No space left on device")
+
+    stage = BlockStage(consume, "tar-write")
+    stage.put(b"block")
+    with pytest.raises(OSError, match="No space left on device"):
+        stage.drain()
+
+
+def test_first_fit_bins():
+    bins = hpss_utils.FirstFitBins(10)
+    assert [bins.add(size) for size in [6, 5, 4, 3, 2, 12, 1]] == [0, 1, 0, 1, 1, 2, 3]
+    assert bins.count == 4
+
+
+def test_plan_tars_balanced():
+    file_stats = make_file_stats(
+        {
+            # Fits in one tar: kept together
+            "a/1": 100,
+            "a/2": 100,
+            # Too big for one tar: packed file by file
+            "b/big": 9000,
+            "b/mid": 3000,
+            "b/small1": 1000,
+            "b/small2": 1000,
+            "c/1": 4000,
+        }
+    )
+    groups = hpss_utils.plan_tars_balanced(file_stats, 10 * 1024)
+    # Sizes including headers, largest first: b/big 9728, c/1 4608, b/mid 3584,
+    # a/ 2048 (filling the second tar), b/small1 1536, b/small2 1536
+    assert [[file_stats.path(i) for i in group] for group in groups] == [
+        ["a/1", "a/2", "b/mid", "c/1"],
+        ["b/big"],
+        ["b/small1", "b/small2"],
+    ]
+    # Every file is planned exactly once.
+    assert sorted(i for group in groups for i in group) == list(range(len(file_stats)))
+    assert hpss_utils.plan_tars(file_stats, 10 * 1024, "balanced") == groups
+
+
+def test_file_stats_columns(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("run/atm")
+    (tmp_path / "run" / "atm" / "b.nc").write_text("bb")
+    (tmp_path / "run" / "atm" / "a.nc").write_text("a")
+    (tmp_path / "top.txt").write_text("top")
+    file_stats = FileStats()
+    for path in ["run/atm/b.nc", "top.txt", "run/atm/a.nc"]:
+        st = os.lstat(path)
+        file_stats.add(path, st.st_size, st.st_mtime_ns)
+    # Each directory is stored once
+    assert file_stats.directories == ["run/atm", ""]
+    assert list(file_stats.sizes) == [2, 3, 1]
+    sorted_stats = file_stats.sorted()
+    assert list(sorted_stats) == ["top.txt", "run/atm/a.nc", "run/atm/b.nc"]
+    st = os.lstat("run/atm/a.nc")
+    assert sorted_stats["run/atm/a.nc"] == (1, datetime.utcfromtimestamp(st.st_mtime))
+    assert "missing" not in sorted_stats
+    assert list(sorted_stats.subset([2, 0])) == ["run/atm/b.nc", "top.txt"]
+
+
+def test_build_split_file(tmp_path, monkeypatch, index_database):
+    monkeypatch.chdir(tmp_path)
+    data = os.urandom(5000)
+    (tmp_path / "big.bin").write_bytes(data)
+    os.mkdir("cache")
+    chunk_size = hpss_utils.split_chunk_size(2048)
+    assert chunk_size == 1536
+
+    failures: list = []
+    built_tars = list(
+        hpss_utils.build_split_file(
+            3, "big.bin", "cache", True, False, "creation", chunk_size, "md5", failures
+        )
+    )
+    assert failures == []
+    assert [b.tfname for b in built_tars] == [
+        "000003.tar",
+        "000004.tar",
+        "000005.tar",
+        "000006.tar",
+    ]
+    # Only the last tar carries the rows, once every part is built.
+    assert all(b.split_file is None for b in built_tars[:-1])
+    last = built_tars[-1]
+    assert last.split_file is not None
+    assert last.split_file[0] == "big.bin"
+    assert last.split_file[1] == len(data)
+    assert last.split_file[3] == hashlib.md5(data).hexdigest()
+    assert last.split_file[4] == "000006.tar"
+
+    # Each part is a regular member of its tar.
+    parts = []
+    for part, size, md5, tfname, offset in last.split_chunks:
+        with tarfile.open(tmp_path / "cache" / tfname) as tar:
+            member = tar.getmembers()[0]
+            assert member.name == f"big.bin.part{part:04d}"
+            assert member.offset == offset
+            contents = tar.extractfile(member).read()  # type: ignore
+        assert len(contents) == size
+        assert hashlib.md5(contents).hexdigest() == md5
+        parts.append(contents)
+    assert b"".join(parts) == data
+
+    # The file and its parts are added to the database with the last tar.
+    con, cur = index_database
+    dev_options = DevOptions(False, False, "")
+    for built_tar in built_tars:
+        hpss_utils.add_tar_to_database(built_tar, False, cur, con, dev_options)
+    cur.execute("select id, name, tar from files")
+    assert cur.fetchall() == [(1, "big.bin", "000006.tar")]
+    cur.execute("select file_id, part, size, tar from chunks order by part")
+    assert cur.fetchall() == [
+        (1, 0, 1536, "000003.tar"),
+        (1, 1, 1536, "000004.tar"),
+        (1, 2, 1536, "000005.tar"),
+        (1, 3, 392, "000006.tar"),
+    ]
+    cur.execute("select count(*) from tars")
+    assert cur.fetchone()[0] == 4
+
+
+def test_parse_cache_budget():
+    budget = parse_cache_budget("1.5G")
+    assert (budget.max_bytes, budget.max_tars) == (1536 * 1024**2, None)
+    budget = parse_cache_budget("8tars")
+    assert (budget.max_bytes, budget.max_tars) == (None, 8)
+    assert parse_cache_budget("100").max_bytes == 100
+    with pytest.raises(ValueError, match="Invalid cache budget: lots"):
+        parse_cache_budget("lots")
+
+
+def test_wait_for_cache_pauses_until_transfers_finish(
+    tmp_path, monkeypatch, index_database
+):
+    con, cur = index_database
+    transfer_manager = TransferManager()
+    for i in range(3):
+        tar = tmp_path / f"00000{i}.tar"
+        tar.write_bytes(b"x" * 100)
+        batch = TransferBatch()
+        batch.is_globus = True
+        batch.task_id = f"task{i}"
+        batch.task_status = TaskStatus.SUBMITTED
+        batch.file_paths = [str(tar)]
+        transfer_manager.batches.append(batch)
+    batches = list(transfer_manager.batches)
+    polls = []
+
+    def fake_release_cache(transfer_manager):
+        # One more transfer finishes each time transfers are checked
+        polls.append(len(polls))
+        batches[len(polls) - 1].task_status = TaskStatus.SUCCEEDED
+        transfer_manager.delete_successfully_transferred_files()
+
+    monkeypatch.setattr(hpss_utils, "globus_release_cache", fake_release_cache)
+    monkeypatch.setattr(hpss_utils, "CACHE_BUDGET_POLL_INTERVAL", 0)
+    pipeline = TransferPipeline(
+        "zstash", False, True, transfer_manager, False, cur, con, DevOptions(False, False, "")  # type: ignore
+    )
+    # Room for 2 tars: the next one, and one already staged
+    pipeline.wait_for_cache(parse_cache_budget("2tars"), 1, 100)
+    assert len(polls) == 2
+    assert transfer_manager.staged_files() == [str(tmp_path / "000002.tar")]
+    # 100 bytes staged + 100 incoming fit in 200 bytes
+    pipeline.wait_for_cache(parse_cache_budget("200"), 1, 100)
+    assert len(polls) == 3
+    pipeline.close()
+
+
+def test_wait_for_cache_counts_the_tar_in_flight(
+    tmp_path, monkeypatch, index_database, make_built_tar
+):
+    con, cur = index_database
+    (tmp_path / "000000.tar").write_bytes(b"x" * 100)
+    release = threading.Event()
+
+    def fake_transfer_tar(built_tar, cache, keep, non_blocking, transfer_manager):
+        release.wait(timeout=10)
+
+    monkeypatch.setattr(hpss_utils, "transfer_tar", fake_transfer_tar)
+    monkeypatch.setattr(hpss_utils, "globus_release_cache", lambda tm: None)
+    pipeline = TransferPipeline(
+        str(tmp_path), False, True, TransferManager(), False, cur, con, DevOptions(False, False, "")  # type: ignore
+    )
+    pipeline.submit(make_built_tar("000000.tar"))
+    # Within the budget: the next tar is built while this one is transferred
+    pipeline.wait_for_cache(parse_cache_budget("2tars"), 1, 100)
+    assert pipeline.in_flight is not None
+    # Over the budget: its transfer has to be submitted first
+    release.set()
+    pipeline.wait_for_cache(parse_cache_budget("150"), 1, 100)
+    assert pipeline.in_flight is None
+    pipeline.close()
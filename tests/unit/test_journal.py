@@ -0,0 +1,117 @@
+import hashlib
+
+import pytest
+
+from zstash import journal as journal_module
+from zstash.journal import CreateJournal, tar_names
+
+
+def archive(cur, cache, tfname, contents, record_in=None):
+    """
+    Put a tar in the cache and the database, as a transfer would.
+    """
+    (cache / tfname).write_bytes(contents)
+    md5 = hashlib.md5(contents).hexdigest()
+    cur.execute("insert into tars values (NULL,?,?,?)", (tfname, len(contents), md5))
+    cur.execute(
+        "insert into files values (NULL,?,?,NULL,?,?,0)",
+        (tfname + ".txt", 1, "x", tfname),
+    )
+    if record_in:
+        record_in.record(tfname, len(contents), md5)
+
+
+def test_tar_names():
+    assert tar_names(9, 0) == ["000009.tar"]
+    assert tar_names(9, 3) == ["000009.tar", "00000a.tar", "00000b.tar"]
+
+
+def test_journal_load_ignores_torn_last_line(tmp_path):
+    journal = CreateJournal(str(tmp_path))
+    journal.start([["a"], ["b", "c"]], [0, 1], [0, 0])
+    journal.record("000000.tar", 10, "abc")
+    with open(journal.path, "a") as f:
+        f.write('{"tar": "000001.ta')
+
+    loaded = CreateJournal.load(str(tmp_path))
+    assert loaded.groups == [["a"], ["b", "c"]]
+    assert loaded.tar_nums == [0, 1]
+    assert loaded.done == {"000000.tar": (10, "abc")}
+
+
+def test_journal_plan_a_line_per_group(tmp_path):
+    journal = CreateJournal(str(tmp_path))
+    journal.start([["a"], ["b", "c"], ["d"]], [0, 1, 2], [0, 0, 0])
+    with open(journal.path) as f:
+        assert len(f.readlines()) == 4
+
+    # A run that died while writing its plan archived nothing
+    with open(journal.path) as f:
+        lines = f.readlines()
+    with open(journal.path, "w") as f:
+        f.writelines(lines[:2])
+    with pytest.raises(RuntimeError):
+        CreateJournal.load(str(tmp_path))
+
+
+def test_journal_remaining(tmp_path, index_database):
+    con, cur = index_database
+    journal = CreateJournal(str(tmp_path))
+    journal.start([["a"], ["b"], ["c"], ["big"]], [0, 1, 2, 3], [0, 0, 0, 2])
+    # Done and matching
+    archive(cur, tmp_path, "000000.tar", b"tar 0", journal)
+    # Done, but truncated in the cache since
+    archive(cur, tmp_path, "000001.tar", b"tar 1", journal)
+    (tmp_path / "000001.tar").write_bytes(b"tar")
+    # In the database, but the run died before the journal recorded it
+    archive(cur, tmp_path, "000002.tar", b"tar 2")
+    # Only the first part of a split file is done
+    archive(cur, tmp_path, "000003.tar", b"tar 3", journal)
+    con.commit()
+
+    loaded = CreateJournal.load(str(tmp_path))
+    assert loaded.remaining(cur, con, str(tmp_path), "md5", keep=True) == [1, 2, 3]
+    # What will be built again is gone from the database and the cache.
+    cur.execute("select name from tars")
+    assert cur.fetchall() == [("000000.tar",)]
+    cur.execute("select tar from files")
+    assert cur.fetchall() == [("000000.tar",)]
+    assert sorted(p.name for p in tmp_path.glob("*.tar")) == ["000000.tar"]
+
+
+def test_journal_tar_left_in_cache(tmp_path, index_database):
+    con, cur = index_database
+    journal = CreateJournal(str(tmp_path))
+    journal.start([["a"], ["b"]], [0, 1], [0, 0])
+    archive(cur, tmp_path, "000000.tar", b"tar 0", journal)
+    archive(cur, tmp_path, "000001.tar", b"tar 1", journal)
+    # Deleted from the cache once transferred
+    (tmp_path / "000000.tar").unlink()
+    con.commit()
+
+    # Without --keep, a tar still in the cache may never have been transferred
+    loaded = CreateJournal.load(str(tmp_path))
+    assert loaded.remaining(cur, con, str(tmp_path), "md5", keep=False) == [1]
+
+
+def test_journal_only_hashes_last_tar(tmp_path, monkeypatch, index_database):
+    con, cur = index_database
+    journal = CreateJournal(str(tmp_path))
+    journal.start([["a"], ["b"], ["c"]], [0, 1, 2], [0, 0, 0])
+    archive(cur, tmp_path, "000000.tar", b"tar 0", journal)
+    archive(cur, tmp_path, "000001.tar", b"tar 1", journal)
+    # Same size, different contents: only found by hashing
+    (tmp_path / "000001.tar").write_bytes(b"tar X")
+    con.commit()
+
+    hashed = []
+
+    def hash_file(file_path, digest):
+        hashed.append(file_path)
+        return hashlib.md5(open(file_path, "rb").read()).hexdigest()
+
+    monkeypatch.setattr(journal_module, "hash_file", hash_file)
+    loaded = CreateJournal.load(str(tmp_path))
+    # The last tar recorded is hashed again, the others are trusted
+    assert loaded.remaining(cur, con, str(tmp_path), "md5", keep=True) == [1, 2]
+    assert hashed == [str(tmp_path / "000001.tar")]
@@ -0,0 +1,45 @@
+import argparse
+import sqlite3
+
+import pytest
+
+from zstash.ls import ls_database
+from zstash.settings import config
+
+
+def make_archive(cache):
+    cache.mkdir()
+    con = sqlite3.connect(str(cache / "index.db"))
+    cur = con.cursor()
+    cur.execute("create table config (arg text primary key, value text);")
+    cur.executemany(
+        "insert into config values (?,?)",
+        [
+            ("path", "/data"),
+            ("hpss", "none"),
+            ("maxsize", "1024"),
+            ("schema_version", "2"),
+        ],
+    )
+    cur.execute(
+        "create table files (id integer primary key, name text, size integer, mtime_ns integer, md5 text, tar text, offset integer);"
+    )
+    cur.execute("insert into files values (1, 'a.txt', 1, 0, 'x', '000000.tar', 0)")
+    con.commit()
+    con.close()
+
+
+def test_ls_database_checks_matches_before_iterating(tmp_path, monkeypatch, capsys):
+    make_archive(tmp_path / "zstash")
+    # Restore the global config afterwards
+    for attr in ("path", "hpss", "maxsize", "schema_version", "digest"):
+        monkeypatch.setattr(config, attr, getattr(config, attr))
+    args = argparse.Namespace(hpss=None, files=["b*"], long=True)
+    with pytest.raises(FileNotFoundError, match="There was nothing to ls."):
+        ls_database(args, str(tmp_path / "zstash"))
+
+    args.files = ["a*"]
+    matches = ls_database(args, str(tmp_path / "zstash"))
+    # The header is printed before any row is read
+    assert capsys.readouterr().out.startswith("id\tname\tsize\tmtime\t")
+    assert [files_row.name for files_row in matches] == ["a.txt"]
@@ -9,14 +9,27 @@ Tests cover:
 
 import os
 import sqlite3
-from collections import OrderedDict
+from collections.abc import Mapping
 from datetime import datetime, timedelta
 from typing import Dict, Tuple
 from unittest.mock import patch
 
 import pytest
 
-from zstash.utils import DirectoryScanner, get_files_to_archive_with_stats
+from zstash.migrate import migrate_files_table
+from zstash.settings import SCHEMA_VERSION, FilesRow, config
+from zstash.update import find_new_files, last_tar_number
+from zstash.utils import (
+    DirectoryScanner,
+    FileStats,
+    PathMatcher,
+    create_chunks_table,
+    create_tars_table,
+    filter_files,
+    get_files_from_manifest,
+    get_files_to_archive_with_stats,
+    read_manifest,
+)
 
 
 class TestDirectoryScanner:
@@ -159,6 +172,258 @@ class TestDirectoryScanner:
         assert isinstance(file_mtime, datetime)
         assert abs((file_mtime - datetime.utcfromtimestamp(mtime)).total_seconds()) < 1
 
+    def test_parallel_scan_matches_sequential(self, tmp_path):
+        """Test that scanning with a thread pool finds exactly the same entries."""
+        for i in range(5):
+            subdir = tmp_path / f"dir{i}" / "sub"
+            subdir.mkdir(parents=True)
+            (subdir / "data.nc").write_text("x" * i)
+            (tmp_path / f"dir{i}" / "log.txt").write_text("log")
+        (tmp_path / "empty").mkdir()
+        (tmp_path / "cache").mkdir()
+        (tmp_path / "cache" / "000000.tar").write_text("tar")
+        os.symlink("dir0/log.txt", tmp_path / "link")
+
+        os.chdir(tmp_path)
+        sequential = DirectoryScanner("./cache")
+        sequential.scan_directory(".")
+        parallel = DirectoryScanner("./cache")
+        parallel.scan_directory_parallel(".", 4)
+
+        assert parallel.file_stats == sequential.file_stats
+        assert parallel.dir_count == sequential.dir_count == 12
+        assert parallel.file_count == sequential.file_count == 11
+        assert parallel.empty_dir_count == sequential.empty_dir_count == 1
+
+    def test_excluded_subtrees_are_not_entered(self, tmp_path):
+        """Test that the scan skips what the filters would remove anyway."""
+        (tmp_path / "keep").mkdir()
+        (tmp_path / "keep" / "a.nc").write_text("a")
+        (tmp_path / "keep" / "a.log").write_text("a")
+        (tmp_path / "skip" / "sub").mkdir(parents=True)
+        (tmp_path / "skip" / "sub" / "b.nc").write_text("b")
+
+        os.chdir(tmp_path)
+        stat_calls = []
+
+        with patch("os.scandir", wraps=os.scandir) as scandir:
+            scanner = DirectoryScanner("./cache", None, "skip*,*.log")
+            scanner.scan_directory(".")
+        assert scanner.file_stats.keys() == {"keep/a.nc"}
+        # skip/ matches "skip*" itself, so it isn't even listed
+        assert sorted(call.args[0] for call in scandir.call_args_list) == [
+            ".",
+            "./keep",
+        ]
+
+        # "skip/" excludes the content of skip, but not skip itself:
+        # it's only listed to check whether it's empty.
+        scanner = DirectoryScanner("./cache", None, "skip/")
+        scanner.scan_directory(".")
+        assert "skip" not in scanner.file_stats
+        assert scanner.dir_count == 3
+        assert scanner.file_count == 2
+
+        # Only the files that are kept are stat'ed
+        class CountingEntry:
+            def __init__(self, entry):
+                self.entry = entry
+                self.path = entry.path
+                self.name = entry.name
+
+            def is_dir(self, **kwargs):
+                return self.entry.is_dir(**kwargs)
+
+            def stat(self, **kwargs):
+                stat_calls.append(self.path)
+                return self.entry.stat(**kwargs)
+
+        real_scandir = os.scandir
+        scanner = DirectoryScanner("./cache", "keep/*.nc")
+        with patch(
+            "os.scandir",
+            side_effect=lambda path: [CountingEntry(e) for e in real_scandir(path)],
+        ):
+            scanner.scan_directory(".")
+        assert scanner.file_stats.keys() == {"keep/a.nc"}
+        assert sorted(stat_calls) == ["./keep", "./keep/a.nc"]
+
+
+class TestScanState:
+    """Tests for reusing the listings of unchanged directories."""
+
+    def test_unchanged_directories_are_reused(self, tmp_path):
+        for name in ["a", "b", "c/d"]:
+            (tmp_path / name).mkdir(parents=True)
+            (tmp_path / name / "file.txt").write_text(name)
+        (tmp_path / "cache").mkdir()
+        os.chdir(tmp_path)
+        old = 1600000000
+
+        def age_directories():
+            # Recently modified directories aren't recorded
+            for directory in [".", "a", "b", "c", "c/d"]:
+                os.utime(directory, (old, old))
+
+        age_directories()
+        first = get_files_to_archive_with_stats("cache", None, None, scan_cache=True)
+        assert os.path.exists(os.path.join("cache", "scan_state.db"))
+
+        # Nothing changed: no directory is read again
+        with patch("os.scandir", wraps=os.scandir) as scandir:
+            second = get_files_to_archive_with_stats(
+                "cache", None, None, scan_cache=True
+            )
+        assert scandir.call_count == 0
+        assert list(second.items()) == list(first.items())
+
+        # A new file changes the mtime of its directory, which is read again.
+        (tmp_path / "b" / "new.txt").write_text("new")
+        # A file modified in place doesn't, so it's only found by a full scan.
+        (tmp_path / "c" / "d" / "file.txt").write_text("modified")
+        with patch("os.scandir", wraps=os.scandir) as scandir:
+            third = get_files_to_archive_with_stats(
+                "cache", None, None, scan_cache=True
+            )
+        assert [call.args[0] for call in scandir.call_args_list] == ["./b"]
+        assert list(third) == [
+            "a/file.txt",
+            "b/file.txt",
+            "b/new.txt",
+            "c/d/file.txt",
+        ]
+        assert third["c/d/file.txt"][0] == len("c/d")
+
+        full = get_files_to_archive_with_stats(
+            "cache", None, None, scan_cache=True, full_scan=True
+        )
+        assert full == get_files_to_archive_with_stats("cache", None, None)
+        assert full["c/d/file.txt"][0] == len("modified")
+
+        # Different filters don't reuse the listings
+        age_directories()
+        get_files_to_archive_with_stats("cache", None, "a", scan_cache=True)
+        with patch("os.scandir", wraps=os.scandir) as scandir:
+            result = get_files_to_archive_with_stats(
+                "cache", None, None, scan_cache=True
+            )
+        assert scandir.call_count == 5
+        assert result == full
+
+
+class TestFilesFrom:
+    """Tests for gathering the files listed in a manifest."""
+
+    def test_read_manifest(self, tmp_path):
+        manifest = tmp_path / "manifest"
+        manifest.write_text("a.txt\r\nrun/b.nc\t12\t1700000000.1234567890\n\n")
+        assert read_manifest(str(manifest)) == [
+            ("a.txt", None, None),
+            ("run/b.nc", 12, 1700000000123456789),
+        ]
+        manifest.write_bytes(b"with\nnewline\0c.txt\0")
+        assert read_manifest(str(manifest)) == [
+            ("with\nnewline", None, None),
+            ("c.txt", None, None),
+        ]
+        manifest.write_text("a.txt\t12\n")
+        with pytest.raises(ValueError):
+            read_manifest(str(manifest))
+
+    def test_same_as_walk(self, tmp_path):
+        """Test that listing every file gives the same result as a walk."""
+        (tmp_path / "dir" / "sub").mkdir(parents=True)
+        (tmp_path / "dir" / "sub" / "file1.txt").write_text("file1")
+        (tmp_path / "dir" / "file2.txt").write_text("file2 stuff")
+        (tmp_path / "empty_dir").mkdir()
+        (tmp_path / "file_empty.txt").write_text("")
+        os.symlink("dir/file2.txt", tmp_path / "link.txt")
+        (tmp_path / "cache").mkdir()
+        (tmp_path / "cache" / "index.db").write_text("db")
+
+        os.chdir(tmp_path)
+        expected = get_files_to_archive_with_stats("cache", None, None)
+        manifest = tmp_path / "cache" / "manifest"
+        listed = ["link.txt", "./dir/sub/file1.txt", "empty_dir", "dir/file2.txt"]
+        listed += ["file_empty.txt", "dir/file2.txt", "cache/index.db"]
+        manifest.write_text("\n".join(listed))
+        result = get_files_from_manifest("cache", str(manifest), None, None, 4)
+        assert list(result.items()) == list(expected.items())
+
+        # Given sizes and mtimes of regular files are used as is
+        manifest.write_text("dir/file2.txt\t5\t1.5\nnew.txt\t3\t2\n")
+        result = get_files_from_manifest("cache", str(manifest), None, "new*")
+        assert list(result.items()) == [
+            ("dir/file2.txt", (5, datetime.utcfromtimestamp(1.5)))
+        ]
+
+        # Only empty directories are archived
+        manifest.write_text("dir\n")
+        assert len(get_files_from_manifest("cache", str(manifest), None, None)) == 0
+        manifest.write_text("../outside.txt\n")
+        with pytest.raises(ValueError):
+            get_files_from_manifest("cache", str(manifest), None, None)
+
+    def test_stats_of_other_than_regular_files(self, tmp_path):
+        """Test that only regular files keep the size and mtime listed."""
+        (tmp_path / "empty_dir").mkdir()
+        (tmp_path / "a.txt").write_text("a")
+        os.symlink("a.txt", tmp_path / "link.txt")
+        os.chdir(tmp_path)
+        expected = get_files_to_archive_with_stats("cache", None, None)
+        manifest = tmp_path / "manifest"
+        manifest.write_text(
+            "empty_dir\t4096\t1\nlink.txt\t5\t1\na.txt\t1\t1\nmissing.txt\t1\t1\n"
+        )
+        result = get_files_from_manifest("cache", str(manifest), None, "manifest")
+        assert list(result) == list(expected)
+        assert result["a.txt"] == (1, datetime.utcfromtimestamp(1))
+        assert result["empty_dir"] == expected["empty_dir"]
+        assert result["link.txt"] == expected["link.txt"]
+
+    def test_unreadable_directory(self, tmp_path, monkeypatch):
+        """Test that a directory that can't be listed is skipped, not fatal."""
+        (tmp_path / "locked").mkdir()
+        (tmp_path / "a.txt").write_text("a")
+        os.chdir(tmp_path)
+        manifest = tmp_path / "manifest"
+        manifest.write_text("locked\na.txt\n")
+
+        def scandir(path):
+            raise PermissionError(13, "Permission denied", path)
+
+        monkeypatch.setattr(os, "scandir", scandir)
+        result = get_files_from_manifest("cache", str(manifest), None, None)
+        assert [path for path, _ in result.items()] == ["a.txt"]
+
+
+class TestPathMatcher:
+    """Tests for the compiled include/exclude patterns."""
+
+    def test_same_rules_as_fnmatch(self):
+        matcher = PathMatcher("*.nc,run/,a?c,[xy]z")
+        assert matcher.matches("deep/dir/file.nc")
+        assert matcher.matches("run/sub/file")
+        assert not matcher.matches("run")
+        assert matcher.matches("abc")
+        assert not matcher.matches("abbc")
+        assert matcher.matches("yz")
+        assert not matcher.matches("file.nc.bak")
+
+    def test_subtrees(self):
+        matcher = PathMatcher("run/*.nc,archive*")
+        assert matcher.may_match_under("run")
+        assert not matcher.may_match_under("runs")
+        assert not matcher.may_match_under("other")
+        assert matcher.matches_all_under("archive")
+        assert matcher.matches_all_under("archive2/sub")
+        assert not matcher.matches_all_under("run")
+
+    def test_filter_files(self):
+        files = ["a.txt", "b.dat", "dir/c.txt", "dir/d.dat"]
+        assert filter_files("*.txt", files, include=True) == ["a.txt", "dir/c.txt"]
+        assert filter_files("dir/", files, include=False) == ["a.txt", "b.dat"]
+
 
 class TestGetFilesToArchiveWithStats:
     """Tests for get_files_to_archive_with_stats function."""
@@ -170,7 +435,7 @@ class TestGetFilesToArchiveWithStats:
         os.chdir(tmp_path)
         result = get_files_to_archive_with_stats("cache", None, None)
 
-        assert isinstance(result, dict)
+        assert isinstance(result, Mapping)
         assert len(result) > 0
 
         # Check structure: path -> (size, mtime)
@@ -180,6 +445,20 @@ class TestGetFilesToArchiveWithStats:
             assert isinstance(stats[0], int)  # size
             assert isinstance(stats[1], datetime)  # mtime
 
+    def test_scan_workers_same_result(self, tmp_path):
+        """Test that the number of scan workers doesn't change the result or its order."""
+        for name in ["b", "a", "c/d", "c/e"]:
+            (tmp_path / name).mkdir(parents=True)
+            (tmp_path / name / "file.txt").write_text(name)
+        (tmp_path / "c" / "empty").mkdir()
+        (tmp_path / "top.txt").write_text("top")
+
+        os.chdir(tmp_path)
+        expected = get_files_to_archive_with_stats("cache", None, None)
+        result = get_files_to_archive_with_stats("cache", None, None, 8)
+
+        assert list(result.items()) == list(expected.items())
+
     def test_ordered_dict_preserves_order(self, tmp_path):
         """Test that results maintain sorted order."""
         # Create files in specific order
@@ -192,7 +471,7 @@ class TestGetFilesToArchiveWithStats:
         os.chdir(tmp_path)
         result = get_files_to_archive_with_stats("cache", None, None)
 
-        assert isinstance(result, OrderedDict)
+        assert isinstance(result, FileStats)
         # Should be sorted by directory first, then filename
         keys = list(result.keys())
         # Files in root should come before subdir
@@ -563,6 +842,106 @@ class TestUpdateDatabaseOptimization:
             assert is_within_tolerance == should_match
 
 
+class TestFindNewFiles:
+    """Tests for the change detection done in SQLite."""
+
+    def make_database(self):
+        con = sqlite3.connect(":memory:", detect_types=sqlite3.PARSE_DECLTYPES)
+        cur = con.cursor()
+        cur.execute("create table config (arg text primary key, value text)")
+        cur.execute(
+            "create table files (id integer primary key, name text, size integer, mtime timestamp, md5 text, tar text, offset integer)"
+        )
+        base = datetime(2024, 1, 1, 12, 0, 0)
+        archived = [
+            ("same.txt", 10, base),
+            ("size.txt", 10, base),
+            # Older versions are ignored: the one with the latest mtime counts
+            ("versions.txt", 99, base - timedelta(days=1)),
+            ("versions.txt", 20, base),
+            ("versions.txt", 98, base - timedelta(days=2)),
+            ("within.txt", 10, base),
+            ("edge.txt", 10, base),
+            ("past_edge.txt", 10, base),
+            ("micro.txt", 10, base + timedelta(microseconds=250)),
+        ]
+        cur.executemany(
+            "insert into files (name, size, mtime, tar) values (?,?,?,'000000.tar')",
+            archived,
+        )
+        scanned = [
+            ("edge.txt", 10, base + timedelta(seconds=1)),
+            ("micro.txt", 10, base + timedelta(seconds=1, microseconds=251)),
+            ("new.txt", 10, base),
+            ("past_edge.txt", 10, base - timedelta(seconds=1, microseconds=1)),
+            ("same.txt", 10, base),
+            ("size.txt", 11, base),
+            ("versions.txt", 20, base),
+            ("within.txt", 10, base + timedelta(seconds=0.5)),
+        ]
+        file_stats = FileStats()
+        epoch = datetime(1970, 1, 1)
+        for name, size, mtime in scanned:
+            delta = mtime - epoch
+            mtime_ns = (delta.days * 86400 + delta.seconds) * 10**9
+            file_stats.add(name, size, mtime_ns + delta.microseconds * 1000)
+        return con, file_stats
+
+    def check_new_files(self, cur, file_stats):
+        newfiles = find_new_files(cur, file_stats)
+        assert [file_stats.path(i) for i in newfiles] == [
+            "micro.txt",
+            "new.txt",
+            "past_edge.txt",
+            "size.txt",
+        ]
+        # The temporary table is gone, so it can run again
+        assert find_new_files(cur, file_stats) == newfiles
+
+    def test_matches_python_comparison(self, monkeypatch):
+        monkeypatch.setattr(config, "schema_version", 1)
+        con, file_stats = self.make_database()
+        self.check_new_files(con.cursor(), file_stats)
+
+    def test_migrated_layout(self, monkeypatch):
+        monkeypatch.setattr(config, "schema_version", 1)
+        con, file_stats = self.make_database()
+        cur = con.cursor()
+        cur.execute("select * from files order by id")
+        before = [FilesRow(row).to_tuple() for row in cur.fetchall()]
+
+        migrate_files_table(con)
+        cur.execute("select value from config where arg = 'schema_version'")
+        assert cur.fetchone() == (str(SCHEMA_VERSION),)
+        cur.execute("PRAGMA table_info(files)")
+        assert [col[1] for col in cur.fetchall()][3] == "mtime_ns"
+        cur.execute("select * from files order by id")
+        rows = cur.fetchall()
+        assert all(isinstance(row[3], int) for row in rows)
+        # Same ids and mtimes, to the microsecond
+        assert [FilesRow(row).to_tuple() for row in rows] == before
+
+        monkeypatch.setattr(config, "schema_version", str(SCHEMA_VERSION))
+        self.check_new_files(cur, file_stats)
+
+
+def test_last_tar_number():
+    con = sqlite3.connect(":memory:")
+    cur = con.cursor()
+    cur.execute("create table files (name text, tar text)")
+    # Older archives have neither a tars nor a chunks table
+    assert last_tar_number(cur) == -1
+    cur.execute("insert into files values ('a.txt', '000009.tar')")
+    assert last_tar_number(cur) == 9
+
+    create_tars_table(cur, con)
+    create_chunks_table(cur, con)
+    # The parts of a split file that never got its files row
+    cur.execute("insert into tars (name) values ('00000a.tar')")
+    cur.execute("insert into chunks (tar) values ('00000a.tar'), ('00000b.tar')")
+    assert last_tar_number(cur) == 11
+
+
 @pytest.fixture
 def mock_database():
     """Fixture providing a mock database cursor."""
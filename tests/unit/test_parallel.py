@@ -0,0 +1,67 @@
+import queue
+
+from zstash.parallel import ExtractWorker, OutputCollector, TarAndMsg
+
+
+def test_extract_worker_sends_output_per_tar():
+    output_queue: queue.Queue = queue.Queue()
+    worker = ExtractWorker(output_queue)
+    worker.set_curr_tar("000001.tar")
+    worker.print_queue.write("Opening 000001.tar\n")
+    worker.print_queue.write("Extracting b.txt\n")
+    # Nothing is sent until the tar is done
+    assert output_queue.empty()
+    worker.done_enqueuing_output_for_tar("000001.tar")
+    worker.done([])
+
+    message = output_queue.get_nowait()
+    assert isinstance(message, TarAndMsg)
+    assert (message.tar, message.msg) == (
+        "000001.tar",
+        "Opening 000001.tar\nExtracting b.txt\n",
+    )
+    assert output_queue.get_nowait() == []
+
+
+def test_extract_worker_sends_output_left_after_tar(capsys):
+    output_queue: queue.Queue = queue.Queue()
+    worker = ExtractWorker(output_queue)
+    worker.print_queue.write("Before any tar\n")
+    worker.set_curr_tar("000001.tar")
+    worker.print_queue.write("Opening 000001.tar\n")
+    worker.done_enqueuing_output_for_tar("000001.tar")
+    # Logged after the tar is done, still tagged with it
+    worker.print_queue.write("Closing 000001.tar\n")
+    worker.done([])
+
+    messages = []
+    while not output_queue.empty():
+        messages.append(output_queue.get_nowait())
+    assert messages[-1] == []
+    assert [(message.tar, message.msg) for message in messages[:-1]] == [
+        ("000001.tar", "Opening 000001.tar\n"),
+        (None, "Before any tar\n"),
+        ("000001.tar", "Closing 000001.tar\n"),
+    ]
+
+    collector = OutputCollector(["000000.tar", "000001.tar"])
+    for message in messages[:-1]:
+        collector.add(message.tar, message.msg)
+    # 000001.tar waits on 000000.tar, along with what came in after it was done
+    assert capsys.readouterr().out == "Before any tar\n"
+    collector.add("000000.tar", "a\n")
+    assert capsys.readouterr().out == "a\nOpening 000001.tar\nClosing 000001.tar\n"
+    # Printed already: printed as it comes
+    collector.add("000000.tar", "late\n")
+    assert capsys.readouterr().out == "late\n"
+
+
+def test_output_collector_prints_in_tar_order(capsys):
+    collector = OutputCollector(["000000.tar", "000001.tar", "000002.tar"])
+    collector.add("000001.tar", "b\n")
+    assert capsys.readouterr().out == ""
+    collector.add("000000.tar", "a\n")
+    assert capsys.readouterr().out == "a\nb\n"
+    # 000002.tar never came
+    collector.flush()
+    assert capsys.readouterr().out == ""
@@ -1,6 +1,13 @@
+import sqlite3
 from typing import Dict, List
 
-from zstash.utils import run_command
+from zstash.settings import config
+from zstash.utils import (
+    create_indexes,
+    create_matches_table,
+    run_command,
+    update_config,
+)
 
 
 class FakeProcess:
@@ -51,3 +58,76 @@ def test_run_command_keeps_loader_vars_for_non_hsi(monkeypatch):
     assert captured["command_args"] == ["echo", "hello"]
     assert captured["env"]["LD_LIBRARY_PATH"] == "/tmp/pixi/lib"
     assert captured["env"]["LD_PRELOAD"] == "/tmp/pixi/preload.so"
+
+
+def test_update_config_defaults_digest_for_older_archives(monkeypatch):
+    con = sqlite3.connect(":memory:")
+    cur = con.cursor()
+    cur.execute("create table config (arg text primary key, value text);")
+    # An archive created before the digest was recorded
+    cur.executemany(
+        "insert into config values (?,?)",
+        [("path", "/data"), ("hpss", "none"), ("maxsize", "1024")],
+    )
+    # Restore the global config afterwards
+    for attr in ("path", "hpss", "maxsize", "schema_version"):
+        monkeypatch.setattr(config, attr, getattr(config, attr))
+    monkeypatch.setattr(config, "digest", "blake2b")
+    update_config(cur)
+    assert config.digest == "md5"
+    assert config.maxsize == "1024"
+    assert config.schema_version == 1
+
+    cur.execute("insert into config values ('digest', 'sha256')")
+    update_config(cur)
+    assert config.digest == "sha256"
+
+
+def test_create_indexes_for_older_archives(index_database):
+    # Tables made by a version that didn't index them
+    con, cur = index_database
+    create_indexes(cur, con)
+    cur.execute("select name from sqlite_master where type = 'index' order by name")
+    assert cur.fetchall() == [("files_name",), ("files_tar",), ("tars_name",)]
+    # Nothing left to do the next time
+    create_indexes(cur, con)
+
+    def plan(query, params):
+        cur.execute("explain query plan " + query, params)
+        return " ".join(row[3] for row in cur.fetchall())
+
+    # A pattern with a literal prefix is a range of the index
+    query = "select * from files where name GLOB ? or tar GLOB ?"
+    assert "INDEX files_name" in plan(query, ("dir/*.nc", "dir/*.nc"))
+    assert "INDEX files_tar" in plan(query, ("dir/*.nc", "dir/*.nc"))
+    query = "select size from tars where name = ? order by id desc"
+    assert "INDEX tars_name" in plan(query, ("000000.tar",))
+
+
+def test_create_matches_table():
+    con = sqlite3.connect(":memory:")
+    cur = con.cursor()
+    cur.execute(
+        "create table files (id integer primary key, name text, size integer, mtime_ns integer, md5 text, tar text, offset integer)"
+    )
+    cur.executemany(
+        "insert into files (name, tar, offset) values (?,?,?)",
+        [
+            ("a/x.nc", "000000.tar", 0),
+            ("a/y.nc", "000000.tar", 512),
+            ("b/z.txt", "000001.tar", 0),
+            ("a/x.nc", "000001.tar", 512),
+        ],
+    )
+    # Overlapping patterns, a tar, and patterns matching nothing
+    patterns = ["a/*", "*.nc", "000001.tar", "c/*", "a/x.nc"]
+    assert create_matches_table(cur, patterns) == ["c/*"]
+    cur.execute("select id from matches order by id")
+    assert cur.fetchall() == [(1,), (2,), (3,), (4,)]
+
+    # Called again, it starts over
+    assert create_matches_table(cur, ["00000[01].tar", "b/*"], tars_only=True) == [
+        "b/*"
+    ]
+    cur.execute("select id from matches order by id")
+    assert cur.fetchall() == [(1,), (2,), (3,), (4,)]
@@ -6,22 +6,35 @@ import logging
 import os.path
 import sqlite3
 import sys
-from datetime import datetime
-from typing import Any, Dict, List, Tuple
+from typing import Any, List, Tuple
 
 from six.moves.urllib.parse import urlparse
 
 from .globus import globus_activate, globus_finalize
-from .hpss import hpss_put
+from .hpss import check_stream_supported, hpss_put
 from .hpss_utils import DevOptions, construct_tars
-from .settings import DEFAULT_CACHE, config, get_db_filename, logger
-from .transfer_tracking import TransferManager
+from .journal import CreateJournal
+from .settings import (
+    DEFAULT_CACHE,
+    DEFAULT_DIGEST,
+    DIGESTS,
+    PACKINGS,
+    SCHEMA_VERSION,
+    config,
+    get_db_filename,
+    logger,
+)
+from .transfer_tracking import TransferManager, parse_cache_budget
 from .utils import (
+    FileStats,
+    create_indexes,
     create_tars_table,
+    get_files_from_manifest,
     get_files_to_archive_with_stats,
     run_command,
     tars_table_exists,
     ts_utc,
+    update_config,
 )
 
 
@@ -45,6 +58,7 @@ def create():
     logger.debug("HPSS path  : {}".format(hpss))
     logger.debug("Max size  : {}".format(config.maxsize))
     logger.debug("Keep local tar files  : {}".format(args.keep))
+    logger.debug("Digest  : {}".format(config.digest))
 
     # Make sure input path exists and is a directory
     logger.debug("Making sure input path exists and is a directory")
@@ -89,9 +103,14 @@ def create():
 
     # TODO: Verify that cache is empty
 
-    # Create and set up the database
-    logger.debug(f"{ts_utc()}: Calling create_database()")
-    failures: List[str] = create_database(cache, args, transfer_manager)
+    failures: List[str]
+    if args.resume:
+        logger.debug(f"{ts_utc()}: Calling resume_database()")
+        failures = resume_database(cache, args, transfer_manager)
+    else:
+        # Create and set up the database
+        logger.debug(f"{ts_utc()}: Calling create_database()")
+        failures = create_database(cache, args, transfer_manager)
 
     # Transfer to HPSS. Always keep a local copy.
     logger.debug(f"{ts_utc()}: calling hpss_put() for {get_db_filename(cache)}")
@@ -105,7 +124,13 @@ def create():
     )
 
     logger.debug(f"{ts_utc()}: calling globus_finalize()")
-    globus_finalize(transfer_manager, args.keep)
+    if globus_finalize(transfer_manager, args.keep):
+        # Every tar is archived: nothing left to resume.
+        CreateJournal(cache).remove()
+    else:
+        logger.error(
+            "Some Globus transfers did not succeed. Their tars are left out of the journal, so `zstash create --resume` builds and transfers them again."
+        )
 
     if len(failures) > 0:
         # List the failures
@@ -163,6 +188,62 @@ def setup_create() -> Tuple[str, argparse.Namespace]:
         action="store_true",
         help="do not wait for each Globus transfer to complete before creating additional archive files.  This option will use more intermediate disk-space, but can increase throughput.",
     )
+    optional.add_argument(
+        "--digest",
+        type=str,
+        choices=DIGESTS,
+        default=DEFAULT_DIGEST,
+        help="checksum algorithm for the files and tars (default md5). blake2b is usually the fastest.",
+    )
+    optional.add_argument(
+        "--packing",
+        type=str,
+        choices=PACKINGS,
+        default="sequential",
+        help="how files are assigned to tars. sequential (default): fill tars in path order. balanced: first-fit-decreasing, keeping small directories together, for tars closer to --maxsize.",
+    )
+    optional.add_argument(
+        "--split-large-files",
+        action="store_true",
+        help="split files larger than --maxsize into parts stored in consecutive tars, instead of giving each its own oversized tar. Archives with split files need this version of zstash or later to extract.",
+    )
+    optional.add_argument(
+        "--stream",
+        action="store_true",
+        help="write tars straight to HPSS through `hsi put -`, instead of staging them in the cache. Requires an hsi HPSS path; --keep and --non-blocking have no effect on tars.",
+    )
+    optional.add_argument(
+        "--cache-budget",
+        type=parse_cache_budget,
+        help='with --non-blocking, pause building tars while the tars waiting in the cache to be transferred would exceed this. Either a size (e.g. "500G"; K, M, G and T are powers of 1024) or a number of tars (e.g. "8tars"). Has no effect with --keep.',
+    )
+    optional.add_argument(
+        "--resume",
+        action="store_true",
+        help="resume an interrupted create, from the journal it left in the cache. Tars it already archived are checked against the database and skipped. Run it with the same path, --hpss and --cache.",
+    )
+    optional.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="num of multiprocess workers building tars in parallel",
+    )
+    optional.add_argument(
+        "--scan-workers",
+        type=int,
+        default=1,
+        help="num of threads listing directories in parallel while looking for files to archive. Helps on parallel filesystems such as Lustre, where every metadata call is a round trip.",
+    )
+    optional.add_argument(
+        "--scan-cache",
+        action="store_true",
+        help="keep what each directory contained in the cache, so that `zstash update --scan-cache` can reuse it for directories whose mtime hasn't changed, without stat'ing their files. Files modified in place don't change their directory's mtime, so that update only finds them with --full-scan.",
+    )
+    optional.add_argument(
+        "--files-from",
+        type=str,
+        help="only consider the files listed in this file (- for stdin), instead of walking the whole directory. One path per line, or NUL-separated, relative to the directory being archived. A regular file may be followed by its size and mtime (in seconds since the epoch), tab-separated, which are archived instead of the ones it's stat'ed with, e.g. from `find . -type f -printf '%%P\\t%%s\\t%%T@\\n'`. Other entries listed that way get their own size and mtime.",
+    )
     optional.add_argument(
         "-v", "--verbose", action="store_true", help="increase output verbosity"
     )
@@ -200,11 +281,18 @@ def setup_create() -> Tuple[str, argparse.Namespace]:
         args.keep = True
     if args.verbose:
         logger.setLevel(logging.DEBUG)
+    if args.stream:
+        check_stream_supported(args.hpss)
+
+    # The paths it lists are relative to the archived directory, but not the file itself
+    if args.files_from and args.files_from != "-":
+        args.files_from = os.path.abspath(args.files_from)
 
     # Copy configuration
     config.path = os.path.abspath(args.path)
     config.hpss = args.hpss
     config.maxsize = int(1024 * 1024 * 1024 * args.maxsize)
+    config.digest = args.digest
     cache: str
     if args.cache:
         cache = args.cache
@@ -242,7 +330,7 @@ create table files (
   id integer primary key,
   name text,
   size integer,
-  mtime timestamp,
+  mtime_ns integer,
   md5 text,
   tar text,
   offset integer
@@ -256,6 +344,7 @@ create table files (
         raise Exception("tars table exists but it should not")
 
     # Store configuration in database
+    config.schema_version = SCHEMA_VERSION
     # Loop through all attributes of config.
     for attr in dir(config):
         value: Any = getattr(config, attr)
@@ -268,9 +357,22 @@ create table files (
             cur.execute("insert into config values (?,?)", (attr, value))
     con.commit()
 
-    file_stats: Dict[str, Tuple[int, datetime]] = get_files_to_archive_with_stats(
-        cache, args.include, args.exclude
-    )
+    file_stats: FileStats
+    if args.files_from:
+        file_stats = get_files_from_manifest(
+            cache, args.files_from, args.include, args.exclude, args.scan_workers
+        )
+    else:
+        # A new archive starts from a full scan:
+        # listings left in the cache by an earlier archive aren't reused.
+        file_stats = get_files_to_archive_with_stats(
+            cache,
+            args.include,
+            args.exclude,
+            args.scan_workers,
+            args.scan_cache,
+            full_scan=True,
+        )
 
     failures: List[str]
     dev_options: DevOptions = DevOptions(
@@ -291,6 +393,73 @@ create table files (
         transfer_manager,
         skip_tars_table=args.no_tars_md5,
         non_blocking=args.non_blocking,
+        workers=args.workers,
+        packing=args.packing,
+        split_large_files=args.split_large_files,
+        stream=args.stream,
+        journal=CreateJournal(cache),
+        cache_budget=args.cache_budget,
+    )
+
+    # Index the files once they're all loaded
+    create_indexes(cur, con)
+
+    # Close database
+    con.commit()
+    con.close()
+
+    return failures
+
+
+def resume_database(
+    cache: str, args: argparse.Namespace, transfer_manager: TransferManager
+) -> List[str]:
+    """
+    Finish an interrupted `zstash create`, following the plan in its journal.
+    """
+    journal: CreateJournal = CreateJournal.load(cache)
+    if not os.path.exists(get_db_filename(cache)):
+        error_str: str = f"Cannot resume: {get_db_filename(cache)} does not exist"
+        logger.error(error_str)
+        raise FileNotFoundError(error_str)
+    logger.debug(f"{ts_utc()}: Opening index database to resume")
+    con: sqlite3.Connection = sqlite3.connect(
+        get_db_filename(cache), detect_types=sqlite3.PARSE_DECLTYPES
+    )
+    cur: sqlite3.Cursor = con.cursor()
+
+    # Keep the settings the archive was created with,
+    # so the remaining tars match the ones already archived.
+    update_config(cur)
+    create_indexes(cur, con)
+    if config.maxsize is not None:
+        config.maxsize = int(config.maxsize)
+    else:
+        raise TypeError("Invalid config.maxsize={}".format(config.maxsize))
+    config.hpss = args.hpss
+
+    dev_options: DevOptions = DevOptions(
+        error_on_duplicate_tar=args.error_on_duplicate_tar,
+        overwrite_duplicate_tars=args.overwrite_duplicate_tars,
+        force_database_corruption=args.for_developers_force_database_corruption,
+    )
+    failures: List[str] = construct_tars(
+        cur,
+        con,
+        -1,
+        FileStats(),
+        cache,
+        args.keep,
+        args.follow_symlinks,
+        dev_options,
+        transfer_manager,
+        skip_tars_table=not tars_table_exists(cur),
+        non_blocking=args.non_blocking,
+        workers=args.workers,
+        stream=args.stream,
+        journal=journal,
+        resume=True,
+        cache_budget=args.cache_budget,
     )
 
     # Close database
@@ -3,34 +3,55 @@ from __future__ import absolute_import, print_function
 import argparse
 import collections
 import hashlib
-import heapq
 import logging
 import multiprocessing
 import os.path
+import queue
 import re
 import sqlite3
 import sys
 import tarfile
 import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
-from typing import DefaultDict, List, Optional, Set, Tuple
+from typing import Deque, Dict, List, Optional, Set, Tuple, Union
+from urllib.parse import urlparse
+from urllib.request import pathname2url
 
 import _hashlib
 import _io
 
 from . import parallel
+from .globus import GlobusRetriever
 from .hpss import hpss_get
 from .settings import (
     BLOCK_SIZE,
     DEFAULT_CACHE,
     TIME_TOL,
+    ChunksRow,
     FilesRow,
-    TupleFilesRow,
     config,
     get_db_filename,
     logger,
 )
-from .utils import tars_table_exists, update_config
+from .transfer_tracking import CacheBudget, parse_cache_budget
+from .utils import (
+    chunks_table_exists,
+    create_indexes,
+    create_matches_table,
+    tars_table_exists,
+    update_config,
+)
+
+# How many tars holding the parts of a split file are fetched at once
+SPLIT_FILE_PREFETCH: int = 2
+
+# Read size of the threads copying files with --tar-threads
+TAR_THREADS_BLOCK_SIZE: int = 16 * 1024 * 1024
+
+# How long, in seconds, the parent of a parallel extract waits on its workers
+# before checking that they haven't been killed without reporting
+WORKER_CHECK_INTERVAL: float = 60.0
 
 
 def extract(keep_files: bool = True):
@@ -98,6 +119,23 @@ def setup_extract() -> Tuple[argparse.Namespace, str]:
         "--retries", type=int, default=1, help="number of times to retry an hsi command"
     )
     optional.add_argument("--tars", type=str, help="specify which tars to process")
+    optional.add_argument(
+        "--prefetch",
+        type=int,
+        default=0,
+        help="number of tars to keep downloading from HPSS ahead of the one being processed, per worker. The default, 0, gets each tar only once the previous one is done.",
+    )
+    optional.add_argument(
+        "--prefetch-budget",
+        type=parse_cache_budget,
+        help="with --prefetch, the most the tars fetched ahead, and the one being processed, may take in the cache, per worker: a size with an optional K, M, G or T suffix (e.g. 500G), or a number of tars (e.g. 4tars). From a Globus archive, the most the tars requested and not yet extracted may take, for all the workers together, 12tars by default. Without a tars table, every tar is assumed to be --maxsize.",
+    )
+    optional.add_argument(
+        "--tar-threads",
+        type=int,
+        default=1,
+        help="number of threads copying and checking the files of a tar at once, per worker. The default, 1, reads the files of a tar one after another.",
+    )
     optional.add_argument(
         "-v", "--verbose", action="store_true", help="increase output verbosity"
     )
@@ -189,6 +227,7 @@ def extract_database(
     cur: sqlite3.Cursor = con.cursor()
 
     update_config(cur)
+    create_indexes(cur, con)
     if config.maxsize is not None:
         maxsize = config.maxsize
     else:
@@ -214,7 +253,6 @@ def extract_database(
     logger.debug("Max size  : {}".format(config.maxsize))
     logger.debug("Keep local tar files : {}".format(keep))
 
-    matches_: List[TupleFilesRow] = []
     if args.tars is not None:
         # Ignore default value for args.files ("*")
         if args.files != ["*"]:
@@ -227,65 +265,63 @@ def extract_database(
         tar_list: List[str] = parse_tars_option(
             args.tars, tar_names[0][:-4], tar_names[-1][:-4]
         )
-        for tar in tar_list:
-            cur.execute(
-                "select * from files where tar GLOB ?",
-                (tar + ".tar",),
-            )
-            matches_ = matches_ + cur.fetchall()
+        create_matches_table(cur, [tar + ".tar" for tar in tar_list], tars_only=True)
     else:
         # Find matching files
-        for args_file in args.files:
-            cur.execute(
-                "select * from files where name GLOB ? or tar GLOB ?",
-                (args_file, args_file),
-            )
-            match: List[TupleFilesRow] = cur.fetchall()
-            if match:
-                matches_ = matches_ + match
-            else:
-                logger.info("No matches for {}".format(args_file))
-
-    if matches_ == []:
+        for args_file in create_matches_table(cur, args.files):
+            logger.info("No matches for {}".format(args_file))
+
+    # We may have different versions of the same file across many tars:
+    # keep only the last one, i.e. the one in the last tar.
+    # Then sort by tape and offset, so that we extract the files by tape order.
+    cur.execute("""
+with latest as (
+  select id, row_number() over (
+    partition by name order by tar desc, offset desc, id desc
+  ) as version
+  from files where id in (select id from matches)
+)
+select files.* from latest join files using (id)
+where latest.version = 1
+order by files.tar, files.offset, files.name
+    """)
+    matches: List[FilesRow] = [FilesRow(match) for match in cur]
+    cur.execute("drop table temp.matches")
+
+    if matches == []:
         raise FileNotFoundError("There was nothing to extract.")
 
-    matches: List[FilesRow] = list(map(lambda match: FilesRow(match), matches_))
-
-    # Sort by the filename, tape (so the tar archive),
-    # and order within tapes (offset).
-    matches.sort(key=lambda t: (t.name, t.tar, t.offset))
-
-    # Based off the filenames, keep only the last instance of a file.
-    # This is because we may have different versions of the
-    # same file across many tars.
-    insert_idx: int
-    iter_idx: int
-    insert_idx, iter_idx = 0, 1
-    for iter_idx in range(1, len(matches)):
-        # If the filenames are unique, just increment insert_idx.
-        # iter_idx will increment after this iteration.
-        # (matches[x][1] is the name.)
-        if matches[insert_idx].name != matches[iter_idx].name:
-            insert_idx += 1
-        # Always copy over the value at the correct location.
-        matches[insert_idx] = matches[iter_idx]
-
-    # `matches` will only be as long as the number of unique filenames
-    matches = matches[: insert_idx + 1]
-
-    # Sort by tape and offset, so that we make sure
-    # that extract the files by tape order.
-    matches.sort(key=lambda t: (t.tar, t.offset))
+    tar_sizes: Dict[str, int] = load_tar_sizes(cur)
+    if keep_files:
+        # Don't retrieve tars that have nothing left to extract
+        matches = skip_extracted_tars(matches, tar_sizes)
+
+    # From Globus, request the tars in a few large tasks, within --prefetch-budget
+    retriever: Optional[GlobusRetriever] = None
+    if (
+        matches
+        and (config.hpss is not None)
+        and (urlparse(config.hpss).scheme == "globus")
+    ):
+        retriever = GlobusRetriever(config.hpss, cache, tar_sizes, args.prefetch_budget)
 
     # Retrieve from tapes
     failures: List[FilesRow]
-    if args.workers > 1:
+    if matches == []:
+        failures = []
+    elif args.workers > 1:
         logger.debug("Running zstash {} with multiprocessing".format(cmd))
         failures = multiprocess_extract(
-            args.workers, matches, keep_files, keep, cache, cur, args
+            args.workers, matches, keep_files, keep, cache, args, retriever
         )
     else:
-        failures = extractFiles(matches, keep_files, keep, cache, cur, args)
+        if retriever:
+            retriever.submit(
+                list(dict.fromkeys(files_row.tar for files_row in matches))
+            )
+        failures = extractFiles(
+            matches, keep_files, keep, cache, cur, args, retriever=retriever
+        )
 
     # Close database
     logger.debug("Closing index database")
@@ -300,100 +336,222 @@ def multiprocess_extract(
     keep_files: bool,
     keep_tars: Optional[bool],
     cache: str,
-    cur: sqlite3.Cursor,
     args: argparse.Namespace,
+    retriever: Optional[GlobusRetriever] = None,
 ) -> List[FilesRow]:
     """
     Extract the files from the matches in parallel.
 
     A single unit of work is a tar and all of
     the files in it to extract.
+    The tars go on a shared queue, largest first,
+    and each worker takes the next one as soon as it's done with its own,
+    so that a slow tar doesn't hold up the ones behind it.
     """
-    # A dict of tar -> size of files in it.
-    # This is because we're trying to balance the load between
-    # the processes.
-    tar_to_size_unsorted: DefaultDict[str, float] = collections.defaultdict(float)
+    # A dict of tar -> files in it to extract.
+    tar_to_matches: Dict[str, List[FilesRow]] = {}
     db_row: FilesRow
-    tar: str
-    size: int
     for db_row in matches:
-        tar, size = db_row.tar, db_row.size
-        tar_to_size_unsorted[tar] += size
-    # Sort by the size.
-    tar_to_size: collections.OrderedDict[str, float] = collections.OrderedDict(
-        sorted(tar_to_size_unsorted.items(), key=lambda x: x[1])
+        tar_to_matches.setdefault(db_row.tar, []).append(db_row)
+    # Start with the largest tars, so that the small ones fill in at the end.
+    tars_by_size: List[str] = sorted(
+        tar_to_matches,
+        key=lambda tar: sum(db_row.size for db_row in tar_to_matches[tar]),
+        reverse=True,
     )
 
     # We don't want to instantiate more processes than we need to.
     # So, if the number of tars is less than the number of workers,
     # set the number of workers to the number of tars.
-    num_workers = min(num_workers, len(tar_to_size))
-
-    # For worker i, workers_to_tars[i] is a set of tars
-    # that worker i will work on.
-    workers_to_tars: List[set] = [set() for _ in range(num_workers)]
-    # A min heap, of (work, worker_idx) tuples, work is the size of data
-    # that worker_idx needs to work on.
-    # We can efficiently get the worker with the least amount of work.
-    work_to_workers: List[Tuple[int, int]] = [(0, i) for i in range(num_workers)]
-    heapq.heapify(workers_to_tars)
-
-    # Using a greedy approach, populate workers_to_tars.
-    for _, tar in enumerate(tar_to_size):
-        # The worker with the least work should get the current largest amount of work.
-        workers_work: int
-        worker_idx: int
-        workers_work, worker_idx = heapq.heappop(work_to_workers)
-        workers_to_tars[worker_idx].add(tar)
-        # Add this worker back to the heap, with the new amount of work.
-        worker_tuple: Tuple[float, int] = (workers_work + tar_to_size[tar], worker_idx)
-        # FIXME: error: Cannot infer type argument 1 of "heappush"
-        heapq.heappush(work_to_workers, worker_tuple)  # type: ignore
-
-    # For worker i, workers_to_matches[i] is a list of
-    # matches from the database for it to process.
-    workers_to_matches: List[List[FilesRow]] = [[] for _ in range(num_workers)]
-    for db_row in matches:
-        tar = db_row.tar
-        workers_idx: int
-        for workers_idx in range(len(workers_to_tars)):
-            if tar in workers_to_tars[workers_idx]:
-                # This worker gets this db_row.
-                workers_to_matches[workers_idx].append(db_row)
-
-    tar_ordering: List[str] = sorted([tar for tar in tar_to_size])
-    monitor: parallel.PrintMonitor = parallel.PrintMonitor(tar_ordering)
-
-    # The return value for extractFiles will be added here.
-    failure_queue: multiprocessing.Queue[FilesRow] = multiprocessing.Queue()
+    num_workers = min(num_workers, len(tar_to_matches))
+
+    task_queue: multiprocessing.Queue[
+        Optional[Tuple[List[FilesRow], Optional[str]]]
+    ] = multiprocessing.Queue()
+    # From Globus, the tars go on the queue as they're requested,
+    # and more are requested as the workers are done with the others.
+    if retriever:
+        retriever.submit(tars_by_size)
+    tars_to_queue: Deque[str] = collections.deque(tars_by_size)
+    queue_tasks(task_queue, tars_to_queue, tar_to_matches, num_workers, retriever)
+
+    tar_ordering: List[str] = sorted(tar_to_matches)
+    collector: parallel.OutputCollector = parallel.OutputCollector(tar_ordering)
+
+    # The workers put the output of each tar here once it's done,
+    # and then the list of their failures.
+    output_queue: multiprocessing.Queue[Union[parallel.TarAndMsg, List[FilesRow]]] = (
+        multiprocessing.Queue()
+    )
     processes: List[multiprocessing.Process] = []
-    for matches in workers_to_matches:
-        tars_for_this_worker: List[str] = list(set(match.tar for match in matches))
-        worker: parallel.ExtractWorker = parallel.ExtractWorker(
-            monitor, tars_for_this_worker, failure_queue
-        )
+    for _ in range(num_workers):
+        worker: parallel.ExtractWorker = parallel.ExtractWorker(output_queue)
         process: multiprocessing.Process = multiprocessing.Process(
-            target=extractFiles,
-            args=(matches, keep_files, keep_tars, cache, cur, args, worker),
+            target=extract_worker,
+            args=(task_queue, keep_files, keep_tars, cache, args, worker, retriever),
             daemon=True,
         )
         process.start()
         processes.append(process)
 
-    # While the processes are running, we need to empty the queue.
-    # Otherwise, it causes hanging.
-    # No need to join() each of the processes when doing this,
-    # because we'll be in this loop until completion.
+    # Print the output as it comes, until each worker has sent its failures,
+    # the last thing it sends, even if extracting a tar raised.
+    # The queue has to be emptied before joining the processes,
+    # otherwise they hang on exit.
     failures: List[FilesRow] = []
-    while any(p.is_alive() for p in processes):
-        while not failure_queue.empty():
-            failures.append(failure_queue.get())
+    reported: int = 0
+    workers_alive: bool = True
+    while reported < num_workers:
+        message: Union[parallel.TarAndMsg, List[FilesRow]]
+        try:
+            if workers_alive:
+                # Only times out if a worker was killed before reporting
+                message = output_queue.get(timeout=WORKER_CHECK_INTERVAL)
+            else:
+                # The workers are gone, but what they sent before exiting
+                # can still be on its way.
+                message = output_queue.get_nowait()
+        except queue.Empty:
+            if workers_alive:
+                workers_alive = any(p.is_alive() for p in processes)
+                continue
+            logger.error(f"{num_workers - reported} workers exited without reporting")
+            break
+        if isinstance(message, parallel.TarAndMsg):
+            collector.add(message.tar, message.msg)
+            if retriever and (message.tar is not None) and tars_to_queue:
+                retriever.done(message.tar)
+                queue_tasks(
+                    task_queue, tars_to_queue, tar_to_matches, num_workers, retriever
+                )
+        else:
+            failures.extend(message)
+            reported += 1
+    collector.flush()
+    for process in processes:
+        process.join()
 
     # Sort the failures, since they can come in at any order.
     failures.sort(key=lambda t: (t.name, t.tar, t.offset))
     return failures
 
 
+def queue_tasks(
+    # TODO: task_queue has type `multiprocessing.Queue[Optional[Tuple[List[FilesRow], Optional[str]]]]`
+    task_queue,
+    tars_to_queue: Deque[str],
+    tar_to_matches: Dict[str, List[FilesRow]],
+    num_workers: int,
+    retriever: Optional[GlobusRetriever] = None,
+):
+    """
+    Move the tars from `tars_to_queue` to the task queue, in order,
+    up to the first one `retriever` hasn't requested yet,
+    each with the Globus task getting it, if any.
+    Once they're all on it, add one stop signal for each worker.
+    """
+    while tars_to_queue and not (retriever and retriever.is_pending(tars_to_queue[0])):
+        tar: str = tars_to_queue.popleft()
+        task_id: Optional[str] = retriever.task_ids.get(tar) if retriever else None
+        task_queue.put((tar_to_matches[tar], task_id))
+        if not tars_to_queue:
+            for _ in range(num_workers):
+                task_queue.put(None)
+
+
+def extract_worker(
+    # TODO: task_queue has type `multiprocessing.Queue[Optional[Tuple[List[FilesRow], Optional[str]]]]`
+    task_queue,
+    keep_files: bool,
+    keep_tars: Optional[bool],
+    cache: str,
+    args: argparse.Namespace,
+    multiprocess_worker: parallel.ExtractWorker,
+    retriever: Optional[GlobusRetriever] = None,
+):
+    """
+    Extract the tars from task_queue, one at a time, until the stop signal,
+    then report the failures.
+
+    With --prefetch, the worker keeps that many more tars taken from the queue,
+    downloading while it extracts the current one.
+    They're taken one at a time, as it moves on to the next,
+    so most of the tars are still on the shared queue for whichever worker is free.
+    It only waits on the queue when it has nothing else to extract:
+    from Globus, tars are only queued once others are done with.
+    """
+    # A connection of its own: one inherited through fork isn't safe to use.
+    con: sqlite3.Connection = sqlite3.connect(
+        "file:{}?mode=ro".format(pathname2url(os.path.abspath(get_db_filename(cache)))),
+        uri=True,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+    )
+    cur: sqlite3.Cursor = con.cursor()
+
+    # All messages to the logger will now be sent to
+    # this queue, instead of sys.stdout.
+    sh = logging.StreamHandler(multiprocess_worker.print_queue)
+    sh.setLevel(logging.DEBUG)
+    formatter: logging.Formatter = logging.Formatter("%(levelname)s: %(message)s")
+    sh.setFormatter(formatter)
+    logger.addHandler(sh)
+    # Don't have the logger print to the console as the message come in.
+    logger.propagate = False
+
+    prefetcher: Optional[TarPrefetcher] = make_prefetcher(
+        [], cache, cur, args, retriever
+    )
+    # The tasks taken off the queue, the first one being extracted next
+    lookahead: Deque[List[FilesRow]] = collections.deque()
+    stopped: bool = False
+    failures: List[FilesRow] = []
+    try:
+        while True:
+            while (not stopped) and (len(lookahead) <= args.prefetch):
+                next_task: Optional[Tuple[List[FilesRow], Optional[str]]]
+                try:
+                    next_task = task_queue.get(block=not lookahead)
+                except queue.Empty:
+                    break
+                if next_task is None:
+                    stopped = True
+                    continue
+                files, task_id = next_task
+                lookahead.append(files)
+                if prefetcher:
+                    prefetcher.add(files[0].tar)
+                if retriever and task_id:
+                    # Requested by the parent, maybe after this worker started
+                    retriever.task_ids[files[0].tar] = task_id
+            if not lookahead:
+                break
+            task: List[FilesRow] = lookahead.popleft()
+            try:
+                failures += extractFiles(
+                    task,
+                    keep_files,
+                    keep_tars,
+                    cache,
+                    cur,
+                    args,
+                    multiprocess_worker,
+                    retriever,
+                    prefetcher,
+                )
+            except Exception:
+                logger.error(
+                    f"Could not extract {task[0].tar}:\n{traceback.format_exc()}"
+                )
+                failures += task
+                # The parent is waiting for it to be done with, too
+                multiprocess_worker.done_enqueuing_output_for_tar(task[0].tar)
+    finally:
+        if prefetcher:
+            prefetcher.close(keep_tars)
+        con.close()
+        multiprocess_worker.done(failures)
+
+
 def check_sizes_match(cur, tfname, error_on_duplicate_tar):
     if cur and tars_table_exists(cur):
         logger.info(f"{tfname} exists. Checking expected size matches actual size.")
@@ -473,6 +631,336 @@ def check_sizes_match(cur, tfname, error_on_duplicate_tar):
         return True
 
 
+def load_tar_sizes(cur: sqlite3.Cursor) -> Dict[str, int]:
+    """
+    Return the size of each tar, from its most recent entry in the tars table.
+    """
+    tar_sizes: Dict[str, int] = {}
+    if tars_table_exists(cur):
+        cur.execute("select name, size from tars order by id")
+        for name, size in cur.fetchall():
+            tar_sizes[name] = size
+    return tar_sizes
+
+
+def retrieve_tar(
+    tfname: str,
+    cache: str,
+    cur: sqlite3.Cursor,
+    args,
+    retriever: Optional[GlobusRetriever] = None,
+    prefetch_error: Optional[BaseException] = None,
+):
+    """
+    Get `tfname` from HPSS into the cache,
+    unless it's already there with the expected size.
+    If `retriever` is already getting it, wait for it to land instead.
+    A failed prefetch of the tar, `prefetch_error`, counts as the first try.
+    """
+    if config.hpss is not None:
+        hpss: str = config.hpss
+    else:
+        raise TypeError("Invalid config.hpss={}".format(config.hpss))
+    tries: int = args.retries + 1
+    if prefetch_error is not None:
+        logger.info(f"Prefetching {tfname} failed: {prefetch_error}")
+        # Whatever it left is incomplete
+        if os.path.exists(tfname):
+            os.remove(tfname)
+        tries -= 1
+        if tries == 0:
+            raise prefetch_error
+        logger.info(f"Retrying HPSS get: {tries} tries remaining.")
+    # Set to True to test the `--retries` option with a forced failure.
+    # Then run `python -m unittest tests.test_extract.TestExtract.testExtractRetries`
+    test_retry: bool = False
+    while tries > 0:
+        tries -= 1
+        do_retrieve: bool
+
+        if not os.path.exists(tfname):
+            do_retrieve = True
+        else:
+            do_retrieve = not check_sizes_match(
+                cur, tfname, args.error_on_duplicate_tar
+            )
+
+        try:
+            if test_retry:
+                test_retry = False
+                raise RuntimeError
+            if do_retrieve:
+                if not (retriever and retriever.wait_for(tfname)):
+                    hpss_get(hpss, tfname, cache)
+                if not check_sizes_match(cur, tfname, args.error_on_duplicate_tar):
+                    raise RuntimeError(f"{tfname} size does not match expected size.")
+            # `hpss_get` successful or not needed: no more tries needed
+            break
+        except RuntimeError as e:
+            if tries > 0:
+                logger.info(f"Retrying HPSS get: {tries} tries remaining.")
+                # Run the try-except block again
+                continue
+            else:
+                raise e
+
+
+def load_split_files(cur: sqlite3.Cursor) -> Dict[int, List[ChunksRow]]:
+    """
+    Return the parts of every file split across several tars,
+    by the file's id in the files table, in order.
+    """
+    split_files: Dict[int, List[ChunksRow]] = collections.defaultdict(list)
+    if chunks_table_exists(cur):
+        cur.execute("select * from chunks order by file_id, part")
+        for t in cur.fetchall():
+            chunk: ChunksRow = ChunksRow(t)
+            split_files[chunk.file_id].append(chunk)
+    return split_files
+
+
+def prefetch_tar(tfname: str, cache: str):
+    """
+    Start getting a tar before it's needed.
+    `retrieve_tar` still checks its size once it is needed,
+    and retries if this failed.
+    """
+    if (config.hpss is not None) and not os.path.exists(tfname):
+        hpss_get(config.hpss, tfname, cache)
+
+
+def make_prefetcher(
+    tars: List[str],
+    cache: str,
+    cur: sqlite3.Cursor,
+    args: argparse.Namespace,
+    retriever: Optional[GlobusRetriever] = None,
+) -> Optional["TarPrefetcher"]:
+    """
+    Return a TarPrefetcher for `tars` with --prefetch, if there's anything to fetch.
+    Globus archives have `retriever` instead, and local archives have nothing to fetch.
+    """
+    if (
+        (args.prefetch > 0)
+        and (retriever is None)
+        and (config.hpss not in (None, "none"))
+        and (urlparse(config.hpss).scheme != "globus")
+    ):
+        return TarPrefetcher(
+            tars,
+            cache,
+            load_tar_sizes(cur),
+            args.prefetch,
+            args.prefetch_budget,
+        )
+    return None
+
+
+class TarPrefetcher(object):
+    """
+    Keep the next `ahead` tars to process downloading in the background,
+    while the current one is being extracted.
+    With a `budget`, the tars from the current one on,
+    fetched or being fetched, stay within it.
+    `retrieve_tar` still checks each tar's size once it's needed,
+    and counts a failed prefetch as a try.
+    """
+
+    def __init__(
+        self,
+        tars: List[str],
+        cache: str,
+        tar_sizes: Dict[str, int],
+        ahead: int,
+        budget: Optional[CacheBudget] = None,
+    ):
+        # The tars, in the order they're processed
+        self.tars: List[str] = tars
+        self.cache: str = cache
+        self.tar_sizes: Dict[str, int] = tar_sizes
+        self.ahead: int = ahead
+        self.budget: Optional[CacheBudget] = budget
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=ahead + 1)
+        self.fetching: Dict[str, Future] = {}
+        # Index of the tar being processed, and of the next one to fetch
+        self.current: int = 0
+        self.next: int = 0
+
+    def add(self, tar: str):
+        """
+        Add a tar to process after the others.
+        """
+        self.tars.append(tar)
+
+    def tar_size(self, tar: str) -> int:
+        # Without a tars table, assume the largest size a tar can have
+        return self.tar_sizes.get(tar, int(config.maxsize or 0))
+
+    def next_tar(self, tar: str) -> Optional[BaseException]:
+        """
+        `tar` is the next one to process: keep the ones after it downloading,
+        and wait for it to be fetched.
+        Return the error its prefetch failed with, if it did.
+        """
+        self.current = self.tars.index(tar, self.current)
+        self.next = max(self.next, self.current)
+        held: int = sum(self.tar_size(t) for t in self.tars[self.current : self.next])
+        while (self.next < len(self.tars)) and (self.next <= self.current + self.ahead):
+            size: int = self.tar_size(self.tars[self.next])
+            if (
+                (self.next > self.current)
+                and self.budget
+                and not self.budget.allows(held + size, self.next - self.current + 1)
+            ):
+                break
+            ahead_tar: str = self.tars[self.next]
+            logger.debug(f"Prefetching {ahead_tar}")
+            self.fetching[ahead_tar] = self.executor.submit(
+                prefetch_tar, os.path.join(self.cache, ahead_tar), self.cache
+            )
+            held += size
+            self.next += 1
+        if tar in self.fetching:
+            return self.fetching.pop(tar).exception()
+        return None
+
+    def close(self, keep_tars: Optional[bool]):
+        """
+        Wait for the downloads still going, and unless `keep_tars`,
+        remove the tars fetched but never processed.
+        """
+        self.executor.shutdown(wait=True)
+        if not keep_tars:
+            for tar in self.fetching:
+                tfname: str = os.path.join(self.cache, tar)
+                if os.path.exists(tfname):
+                    os.remove(tfname)
+
+
+def extract_split_file(  # noqa: C901
+    files_row: FilesRow,
+    chunks: List[ChunksRow],
+    last_tar: tarfile.TarFile,
+    last_tarinfo: tarfile.TarInfo,
+    extract_this_file: bool,
+    keep_tars: Optional[bool],
+    cache: str,
+    cur: sqlite3.Cursor,
+    args: argparse.Namespace,
+    digest: str,
+    failures: List[FilesRow],
+    retriever: Optional[GlobusRetriever] = None,
+):
+    """
+    Reassemble a file split across several tars, from its parts in order.
+
+    The last part is in `last_tar`, already open at `last_tarinfo`.
+    The tars holding the other parts are fetched a few at a time,
+    ahead of the part being read, and deleted once read unless `keep_tars`.
+    """
+    fname: str = files_row.name
+    path: str = os.path.dirname(fname)
+    if path != "" and extract_this_file:
+        if not os.path.isdir(path):
+            # The path doesn't exist, so create it.
+            os.makedirs(path)
+
+    # Globus transfers go through a single TransferManager, so they're not prefetched.
+    # Nor are local archives, since there's nothing to fetch.
+    prefetch: int = SPLIT_FILE_PREFETCH
+    if (config.hpss in (None, "none")) or (urlparse(config.hpss).scheme == "globus"):
+        prefetch = 0
+    executor: Optional[ThreadPoolExecutor] = (
+        ThreadPoolExecutor(max_workers=prefetch) if prefetch else None
+    )
+    fetching: Dict[str, Future] = {}
+
+    hash_md5: _hashlib.HASH = hashlib.new(digest)
+    fout: Optional[_io.BufferedWriter] = (
+        open(fname, "wb") if extract_this_file else None
+    )
+    failed: bool = False
+    try:
+        for i, chunk in enumerate(chunks):
+            if executor:
+                for ahead in chunks[i : i + prefetch]:
+                    if (ahead.tar != files_row.tar) and (ahead.tar not in fetching):
+                        fetching[ahead.tar] = executor.submit(
+                            prefetch_tar, os.path.join(cache, ahead.tar), cache
+                        )
+            logger.info(f"{fname}: part {chunk.part} is in {chunk.tar}")
+            tar: tarfile.TarFile
+            tarinfo: tarfile.TarInfo
+            chunk_tfname: str = os.path.join(cache, chunk.tar)
+            if chunk.tar == files_row.tar:
+                tar, tarinfo = last_tar, last_tarinfo
+            else:
+                prefetch_error: Optional[BaseException] = None
+                if chunk.tar in fetching:
+                    prefetch_error = fetching.pop(chunk.tar).exception()
+                retrieve_tar(chunk_tfname, cache, cur, args, retriever, prefetch_error)
+                tar = tarfile.open(chunk_tfname, "r")
+                if tar.fileobj is None:
+                    raise TypeError("Invalid tar.fileobj={}".format(tar.fileobj))
+                tar.fileobj.seek(chunk.offset)
+                tarinfo = tar.tarinfo.fromtarfile(tar)
+            try:
+                # error: Name 'tarfile.ExFileObject' is not defined
+                fin: Optional[tarfile.ExFileObject] = tar.extractfile(tarinfo)  # type: ignore
+                if not fin:
+                    raise TypeError("Invalid extracted_file={}".format(fin))
+                chunk_hash: _hashlib.HASH = hashlib.new(digest)
+                while True:
+                    s: bytes = fin.read(BLOCK_SIZE)
+                    if len(s) > 0:
+                        chunk_hash.update(s)
+                        hash_md5.update(s)
+                        if fout:
+                            fout.write(s)
+                    if len(s) < BLOCK_SIZE:
+                        break
+                fin.close()
+            finally:
+                if tar is not last_tar:
+                    tar.close()
+                    if not keep_tars:
+                        os.remove(chunk_tfname)
+            if chunk_hash.hexdigest() != chunk.md5:
+                logger.error(
+                    "{} mismatch for: {} part {}".format(digest, fname, chunk.part)
+                )
+                failed = True
+    finally:
+        if fout:
+            fout.close()
+        if executor:
+            executor.shutdown(wait=True)
+        # Don't leave prefetched tars behind
+        if not keep_tars:
+            for chunk_tar in fetching:
+                chunk_tfname = os.path.join(cache, chunk_tar)
+                if os.path.exists(chunk_tfname):
+                    os.remove(chunk_tfname)
+
+    md5: str = hash_md5.hexdigest()
+    if extract_this_file:
+        last_tar.chown(last_tarinfo, fname, numeric_owner=False)
+        last_tar.chmod(last_tarinfo, fname)
+        last_tar.utime(last_tarinfo, fname)
+        # Verify size
+        if os.path.getsize(fname) != files_row.size:
+            logger.error("size mismatch for: {}".format(fname))
+
+    # Verify checksum
+    if failed or (md5 != files_row.md5):
+        logger.error("{} mismatch for: {}".format(digest, fname))
+        logger.error("{} of extracted file: {}".format(digest, md5))
+        logger.error("{} of original file:  {}".format(digest, files_row.md5))
+        failures.append(files_row)
+    else:
+        logger.debug("Valid {}: {} {}".format(digest, md5, fname))
+
+
 # FIXME: C901 'extractFiles' is too complex (33)
 def extractFiles(  # noqa: C901
     files: List[FilesRow],
@@ -482,6 +970,8 @@ def extractFiles(  # noqa: C901
     cur: sqlite3.Cursor,
     args: argparse.Namespace,
     multiprocess_worker: Optional[parallel.ExtractWorker] = None,
+    retriever: Optional[GlobusRetriever] = None,
+    prefetcher: Optional[TarPrefetcher] = None,
 ) -> List[FilesRow]:
     """
     Given a list of database rows, extract the files from the
@@ -496,225 +986,381 @@ def extractFiles(  # noqa: C901
 
     If running in parallel, then multiprocess_worker is the Worker
     that called this function.
-    We need a reference to it so we can signal it to print
-    the contents of what's in its print queue.
+    We need a reference to it so we can signal it to send
+    the output of each tar once it's done.
+
+    If retriever is set, it's already getting the tars from Globus.
+
+    If prefetcher is set, it's the worker's, already downloading the tars ahead.
+    Otherwise, with --prefetch, one is made for the tars of `files`.
     """
     failures: List[FilesRow] = []
     tfname: str
     newtar: bool = True
     nfiles: int = len(files)
-    if multiprocess_worker:
-        # All messages to the logger will now be sent to
-        # this queue, instead of sys.stdout.
-        sh = logging.StreamHandler(multiprocess_worker.print_queue)
-        sh.setLevel(logging.DEBUG)
-        formatter: logging.Formatter = logging.Formatter("%(levelname)s: %(message)s")
-        sh.setFormatter(formatter)
-        logger.addHandler(sh)
-        # Don't have the logger print to the console as the message come in.
-        logger.propagate = False
-
-    for i in range(nfiles):
-        files_row: FilesRow = files[i]
-
-        # Open new tar archive
-        if newtar:
-            newtar = False
-            tfname = os.path.join(cache, files_row.tar)
-            # Everytime we're extracting a new tar, if running in parallel,
-            # let the process know.
-            # This is to synchronize the print statements.
-            if multiprocess_worker:
-                multiprocess_worker.set_curr_tar(files_row.tar)
+    # The algorithm the archive's checksums were computed with
+    if config.digest is not None:
+        digest: str = config.digest
+    else:
+        raise TypeError("Invalid config.digest={}".format(config.digest))
+    # Files split across several tars
+    split_files: Dict[int, List[ChunksRow]] = load_split_files(cur)
+    # Download the next tars while extracting the current one.
+    own_prefetcher: bool = prefetcher is None
+    if own_prefetcher:
+        prefetcher = make_prefetcher(
+            list(dict.fromkeys(files_row.tar for files_row in files)),
+            cache,
+            cur,
+            args,
+            retriever,
+        )
 
-            if config.hpss is not None:
-                hpss: str = config.hpss
-            else:
-                raise TypeError("Invalid config.hpss={}".format(config.hpss))
-            tries: int = args.retries + 1
-            # Set to True to test the `--retries` option with a forced failure.
-            # Then run `python -m unittest tests.test_extract.TestExtract.testExtractRetries`
-            test_retry: bool = False
-            while tries > 0:
-                tries -= 1
-                do_retrieve: bool
-
-                if not os.path.exists(tfname):
-                    do_retrieve = True
+    # Copy the regular files of a tar with several threads,
+    # each reading from its own offset of the tar.
+    executor: Optional[ThreadPoolExecutor] = None
+    if args.tar_threads > 1:
+        executor = ThreadPoolExecutor(max_workers=args.tar_threads)
+    tar_fd: Optional[int] = None
+    # The files being copied by the threads, to finish once the tar is done
+    pending: List[Tuple[FilesRow, tarfile.TarInfo, bool, Future]] = []
+    # The tar open, to close if extracting from it raises
+    open_tar: Optional[tarfile.TarFile] = None
+
+    try:
+        for i in range(nfiles):
+            files_row: FilesRow = files[i]
+
+            # Open new tar archive
+            if newtar:
+                newtar = False
+                tfname = os.path.join(cache, files_row.tar)
+                # Everytime we're extracting a new tar, if running in parallel,
+                # let the process know.
+                # This is to synchronize the print statements.
+                if multiprocess_worker:
+                    multiprocess_worker.set_curr_tar(files_row.tar)
+
+                prefetch_error: Optional[BaseException] = None
+                if prefetcher:
+                    prefetch_error = prefetcher.next_tar(files_row.tar)
+                retrieve_tar(tfname, cache, cur, args, retriever, prefetch_error)
+
+                logger.info("Opening tar archive %s" % (tfname))
+                tar: tarfile.TarFile = tarfile.open(tfname, "r")
+                open_tar = tar
+                if executor is not None:
+                    tar_fd = os.open(tfname, os.O_RDONLY)
+
+            # Extract file
+            cmd: str = "Extracting" if keep_files else "Checking"
+            logger.info(cmd + " %s" % (files_row.name))
+            # if multiprocess_worker:
+            #     print('{} is {} {} from {}'.format(multiprocess_worker, cmd, file[1], file[5]))
+
+            if keep_files and not should_extract_file(files_row):
+                # If we were going to extract, but aren't
+                # because a matching file is on disk
+                log_not_extracting(files_row)
+
+            # True if we should actually extract the file from the tar
+            extract_this_file: bool = keep_files and should_extract_file(files_row)
+
+            try:
+                # Seek file position
+                if tar.fileobj is not None:
+                    fileobj = tar.fileobj
                 else:
-                    do_retrieve = not check_sizes_match(
-                        cur, tfname, args.error_on_duplicate_tar
+                    raise TypeError("Invalid tar.fileobj={}".format(tar.fileobj))
+                fileobj.seek(files_row.offset)
+
+                # Get next member
+                tarinfo: tarfile.TarInfo = tar.tarinfo.fromtarfile(tar)
+
+                if files_row.identifier in split_files:
+                    # This is the last part of a split file
+                    extract_split_file(
+                        files_row,
+                        split_files[files_row.identifier],
+                        tar,
+                        tarinfo,
+                        extract_this_file,
+                        keep_tars,
+                        cache,
+                        cur,
+                        args,
+                        digest,
+                        failures,
+                        retriever,
                     )
 
-                try:
-                    if test_retry:
-                        test_retry = False
-                        raise RuntimeError
-                    if do_retrieve:
-                        hpss_get(hpss, tfname, cache)
-                        if not check_sizes_match(
-                            cur, tfname, args.error_on_duplicate_tar
-                        ):
-                            raise RuntimeError(
-                                f"{tfname} size does not match expected size."
-                            )
-                    # `hpss_get` successful or not needed: no more tries needed
-                    break
-                except RuntimeError as e:
-                    if tries > 0:
-                        logger.info(f"Retrying HPSS get: {tries} tries remaining.")
-                        # Run the try-except block again
-                        continue
-                    else:
-                        raise e
-
-            logger.info("Opening tar archive %s" % (tfname))
-            tar: tarfile.TarFile = tarfile.open(tfname, "r")
+                elif (
+                    (executor is not None)
+                    and (tar_fd is not None)
+                    and tarinfo.isreg()
+                    and not tarinfo.issparse()
+                ):
+                    # Copied by a thread, and finished once the tar is done
+                    if extract_this_file and os.path.dirname(tarinfo.name) != "":
+                        os.makedirs(os.path.dirname(tarinfo.name), exist_ok=True)
+                    pending.append(
+                        (
+                            files_row,
+                            tarinfo,
+                            extract_this_file,
+                            executor.submit(
+                                pread_member,
+                                tar_fd,
+                                tarinfo,
+                                extract_this_file,
+                                digest,
+                            ),
+                        )
+                    )
 
-        # Extract file
-        cmd: str = "Extracting" if keep_files else "Checking"
-        logger.info(cmd + " %s" % (files_row.name))
-        # if multiprocess_worker:
-        #     print('{} is {} {} from {}'.format(multiprocess_worker, cmd, file[1], file[5]))
+                elif tarinfo.isfile():
+                    # fileobj to extract
+                    # error: Name 'tarfile.ExFileObject' is not defined
+                    extracted_file: Optional[tarfile.ExFileObject] = tar.extractfile(tarinfo)  # type: ignore
+                    if extracted_file:
+                        fin: tarfile.ExFileObject = extracted_file
+                    else:
+                        raise TypeError(
+                            "Invalid extracted_file={}".format(extracted_file)
+                        )
+                    try:
+                        fname: str = tarinfo.name
+                        path: str
+                        name: str
+                        path, name = os.path.split(fname)
+                        if path != "" and extract_this_file:
+                            if not os.path.isdir(path):
+                                # The path doesn't exist, so create it.
+                                os.makedirs(path)
+                        if extract_this_file:
+                            # If we're keeping the files,
+                            # then have an output file
+                            fout: _io.BufferedWriter = open(fname, "wb")
+
+                        hash_md5: _hashlib.HASH = hashlib.new(digest)
+                        while True:
+                            s: bytes = fin.read(BLOCK_SIZE)
+                            if len(s) > 0:
+                                hash_md5.update(s)
+                                if extract_this_file:
+                                    fout.write(s)
+                            if len(s) < BLOCK_SIZE:
+                                break
+                    finally:
+                        fin.close()
+                        if extract_this_file:
+                            fout.close()
+
+                    md5: str = hash_md5.hexdigest()
+                    finish_member(
+                        tar,
+                        tarinfo,
+                        files_row,
+                        md5,
+                        extract_this_file,
+                        digest,
+                        failures,
+                    )
 
-        if keep_files and not should_extract_file(files_row):
-            # If we were going to extract, but aren't
-            # because a matching file is on disk
-            msg: str = "Not extracting {}, because it"
-            msg += " already exists on disk with the same"
-            msg += " size and modification date."
-            logger.info(msg.format(files_row.name))
+                elif extract_this_file:
+                    if sys.version_info >= (3, 12):
+                        tar.extract(
+                            tarinfo, filter="tar"
+                        )  # "data" is too restrictive, "fully_trusted" is too permissive.
+                    else:
+                        tar.extract(tarinfo)
+                    # Note: tar.extract() will not restore time stamps of symbolic
+                    # links. Could not find a Python-way to restore it either, so
+                    # relying here on 'touch'. This is not the prettiest solution.
+                    # Maybe a better one can be implemented later.
+                    if tarinfo.issym():
+                        tmp1 = tarinfo.mtime
+                        tmp2: datetime = datetime.fromtimestamp(tmp1)
+                        tmp3: str = tmp2.strftime("%Y%m%d%H%M.%S")
+                        os.system("touch -h -t %s %s" % (tmp3, tarinfo.name))
+
+            except Exception:
+                # Catch all exceptions here.
+                traceback.print_exc()
+                logger.error("Retrieving {}".format(files_row.name))
+                failures.append(files_row)
+
+            # Close current archive?
+            if i == nfiles - 1 or files[i].tar != files[i + 1].tar:
+                # We're either on the last file or the tar is distinct from the tar of the next file.
+
+                # Wait for the files the threads are copying
+                for pending_row, pending_info, extract_pending, future in pending:
+                    try:
+                        finish_member(
+                            tar,
+                            pending_info,
+                            pending_row,
+                            future.result(),
+                            extract_pending,
+                            digest,
+                            failures,
+                        )
+                    except Exception:
+                        traceback.print_exc()
+                        logger.error("Retrieving {}".format(pending_row.name))
+                        failures.append(pending_row)
+                pending = []
+                if tar_fd is not None:
+                    os.close(tar_fd)
+                    tar_fd = None
+
+                # Close current archive file
+                logger.debug("Closing tar archive {}".format(tfname))
+                tar.close()
+                open_tar = None
+
+                # Open new archive next time
+                newtar = True
+
+                # Delete this tar if the corresponding command-line arg was used.
+                if not keep_tars:
+                    if tfname is not None:
+                        os.remove(tfname)
+                    else:
+                        raise TypeError("Invalid tfname={}".format(tfname))
+
+                # Make room for the next tars from Globus.
+                # When running in parallel, the parent does, once it has the output.
+                if retriever:
+                    retriever.done(tfname)
+                if multiprocess_worker:
+                    multiprocess_worker.done_enqueuing_output_for_tar(files_row.tar)
+    finally:
+        # Also if getting or reading a tar raised
+        if executor is not None:
+            executor.shutdown()
+        if tar_fd is not None:
+            os.close(tar_fd)
+        if open_tar is not None:
+            open_tar.close()
+        if prefetcher and own_prefetcher:
+            prefetcher.close(keep_tars)
 
-        # True if we should actually extract the file from the tar
-        extract_this_file: bool = keep_files and should_extract_file(files_row)
+    return failures
 
-        try:
-            # Seek file position
-            if tar.fileobj is not None:
-                fileobj = tar.fileobj
-            else:
-                raise TypeError("Invalid tar.fileobj={}".format(tar.fileobj))
-            fileobj.seek(files_row.offset)
 
-            # Get next member
-            tarinfo: tarfile.TarInfo = tar.tarinfo.fromtarfile(tar)
+def pread_member(
+    tar_fd: int, tarinfo: tarfile.TarInfo, extract_this_file: bool, digest: str
+) -> str:
+    """
+    Copy the data of a regular file from the tar, and return its checksum.
+    The data is read with positioned reads, so threads can share tar_fd.
+    """
+    hash_md5: _hashlib.HASH = hashlib.new(digest)
+    position: int = tarinfo.offset_data
+    end: int = tarinfo.offset_data + tarinfo.size
+    fout: Optional[_io.BufferedWriter] = None
+    if extract_this_file:
+        fout = open(tarinfo.name, "wb")
+    try:
+        while position < end:
+            s: bytes = os.pread(
+                tar_fd, min(TAR_THREADS_BLOCK_SIZE, end - position), position
+            )
+            if len(s) == 0:
+                raise tarfile.ReadError(
+                    "unexpected end of data in {}".format(tarinfo.name)
+                )
+            hash_md5.update(s)
+            if fout is not None:
+                fout.write(s)
+            position += len(s)
+    finally:
+        if fout is not None:
+            fout.close()
+    return hash_md5.hexdigest()
+
+
+def finish_member(
+    tar: tarfile.TarFile,
+    tarinfo: tarfile.TarInfo,
+    files_row: FilesRow,
+    md5: str,
+    extract_this_file: bool,
+    digest: str,
+    failures: List[FilesRow],
+):
+    """
+    Once a regular file has been read from the tar, set its attributes
+    and check its size and checksum.
+    """
+    fname: str = tarinfo.name
+    if extract_this_file:
+        # numeric_owner is a required arg in Python 3.
+        # If True, "only the numbers for user/group names
+        # are used and not the names".
+        tar.chown(tarinfo, fname, numeric_owner=False)
+        tar.chmod(tarinfo, fname)
+        tar.utime(tarinfo, fname)
+        # Verify size
+        if os.path.getsize(fname) != files_row.size:
+            logger.error("size mismatch for: {}".format(fname))
+
+    # Verify checksum
+    files_row_md5: Optional[str] = files_row.md5
+    if md5 != files_row_md5:
+        logger.error("{} mismatch for: {}".format(digest, fname))
+        logger.error("{} of extracted file: {}".format(digest, md5))
+        logger.error("{} of original file:  {}".format(digest, files_row_md5))
+
+        failures.append(files_row)
+    else:
+        logger.debug("Valid {}: {} {}".format(digest, md5, fname))
 
-            if tarinfo.isfile():
-                # fileobj to extract
-                # error: Name 'tarfile.ExFileObject' is not defined
-                extracted_file: Optional[tarfile.ExFileObject] = tar.extractfile(tarinfo)  # type: ignore
-                if extracted_file:
-                    fin: tarfile.ExFileObject = extracted_file
-                else:
-                    raise TypeError("Invalid extracted_file={}".format(extracted_file))
-                try:
-                    fname: str = tarinfo.name
-                    path: str
-                    name: str
-                    path, name = os.path.split(fname)
-                    if path != "" and extract_this_file:
-                        if not os.path.isdir(path):
-                            # The path doesn't exist, so create it.
-                            os.makedirs(path)
-                    if extract_this_file:
-                        # If we're keeping the files,
-                        # then have an output file
-                        fout: _io.BufferedWriter = open(fname, "wb")
-
-                    hash_md5: _hashlib.HASH = hashlib.md5()
-                    while True:
-                        s: bytes = fin.read(BLOCK_SIZE)
-                        if len(s) > 0:
-                            hash_md5.update(s)
-                            if extract_this_file:
-                                fout.write(s)
-                        if len(s) < BLOCK_SIZE:
-                            break
-                finally:
-                    fin.close()
-                    if extract_this_file:
-                        fout.close()
-
-                md5: str = hash_md5.hexdigest()
-                if extract_this_file:
-                    # numeric_owner is a required arg in Python 3.
-                    # If True, "only the numbers for user/group names
-                    # are used and not the names".
-                    tar.chown(tarinfo, fname, numeric_owner=False)
-                    tar.chmod(tarinfo, fname)
-                    tar.utime(tarinfo, fname)
-                    # Verify size
-                    if os.path.getsize(fname) != files_row.size:
-                        logger.error("size mismatch for: {}".format(fname))
-
-                # Verify md5 checksum
-                files_row_md5: Optional[str] = files_row.md5
-                if md5 != files_row_md5:
-                    logger.error("md5 mismatch for: {}".format(fname))
-                    logger.error("md5 of extracted file: {}".format(md5))
-                    logger.error("md5 of original file:  {}".format(files_row_md5))
-
-                    failures.append(files_row)
-                else:
-                    logger.debug("Valid md5: {} {}".format(md5, fname))
 
-            elif extract_this_file:
-                if sys.version_info >= (3, 12):
-                    tar.extract(
-                        tarinfo, filter="tar"
-                    )  # "data" is too restrictive, "fully_trusted" is too permissive.
-                else:
-                    tar.extract(tarinfo)
-                # Note: tar.extract() will not restore time stamps of symbolic
-                # links. Could not find a Python-way to restore it either, so
-                # relying here on 'touch'. This is not the prettiest solution.
-                # Maybe a better one can be implemented later.
-                if tarinfo.issym():
-                    tmp1 = tarinfo.mtime
-                    tmp2: datetime = datetime.fromtimestamp(tmp1)
-                    tmp3: str = tmp2.strftime("%Y%m%d%H%M.%S")
-                    os.system("touch -h -t %s %s" % (tmp3, tarinfo.name))
-
-        except Exception:
-            # Catch all exceptions here.
-            traceback.print_exc()
-            logger.error("Retrieving {}".format(files_row.name))
-            failures.append(files_row)
-
-        if multiprocess_worker:
-            multiprocess_worker.print_contents()
-
-        # Close current archive?
-        if i == nfiles - 1 or files[i].tar != files[i + 1].tar:
-            # We're either on the last file or the tar is distinct from the tar of the next file.
-
-            # Close current archive file
-            logger.debug("Closing tar archive {}".format(tfname))
-            tar.close()
-
-            if multiprocess_worker:
-                multiprocess_worker.done_enqueuing_output_for_tar(files_row.tar)
-
-            # Open new archive next time
-            newtar = True
-
-            # Delete this tar if the corresponding command-line arg was used.
-            if not keep_tars:
-                if tfname is not None:
-                    os.remove(tfname)
-                else:
-                    raise TypeError("Invalid tfname={}".format(tfname))
+def log_not_extracting(files_row: FilesRow):
+    msg: str = "Not extracting {}, because it"
+    msg += " already exists on disk with the same"
+    msg += " size and modification date."
+    logger.info(msg.format(files_row.name))
 
-    if multiprocess_worker:
-        # If there are things left to print, print them.
-        multiprocess_worker.print_all_contents()
 
-        # Add the failures to the queue.
-        # When running with multiprocessing, the function multiprocess_extract()
-        # that calls this extractFiles() function will return the failures as a list.
-        for f in failures:
-            multiprocess_worker.failure_queue.put(f)
-    return failures
+def skip_extracted_tars(
+    matches: List[FilesRow], tar_sizes: Dict[str, int]
+) -> List[FilesRow]:
+    """
+    Before retrieving anything, drop the tars whose files to extract
+    are all on disk already with the same size and modification date.
+    The files on disk are checked in parallel, a tar at a time,
+    stopping at the first one of a tar that has to be extracted.
+    """
+    tar_to_rows: Dict[str, List[FilesRow]] = {}
+    for files_row in matches:
+        tar_to_rows.setdefault(files_row.tar, []).append(files_row)
+
+    def any_to_extract(rows: List[FilesRow]) -> bool:
+        return any(should_extract_file(files_row) for files_row in rows)
+
+    with ThreadPoolExecutor() as executor:
+        needed: List[bool] = list(executor.map(any_to_extract, tar_to_rows.values()))
+
+    remaining: List[FilesRow] = []
+    fetch_bytes: int = 0
+    num_tars: int = 0
+    for (tar, rows), tar_needed in zip(tar_to_rows.items(), needed):
+        if tar_needed:
+            remaining.extend(rows)
+            num_tars += 1
+            # Without a tars table, the files are the best estimate
+            fetch_bytes += tar_sizes.get(tar, sum(row.size for row in rows))
+        else:
+            for files_row in rows:
+                log_not_extracting(files_row)
+    logger.info(
+        f"{num_tars} tars to retrieve ({fetch_bytes} bytes), skipping {len(tar_to_rows) - num_tars} tars with all their files on disk already"
+    )
+    return remaining
 
 
 def should_extract_file(db_row: FilesRow) -> bool:
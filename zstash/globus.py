@@ -1,7 +1,10 @@
 from __future__ import absolute_import, print_function
 
+import collections
+import os
 import sys
-from typing import Dict, List, Optional, Set, Tuple
+import time
+from typing import Deque, Dict, List, Optional, Set, Tuple
 
 from globus_sdk import TransferAPIError, TransferClient, TransferData
 from globus_sdk.response import GlobusHTTPResponse
@@ -18,10 +21,27 @@ from .globus_utils import (
     get_transfer_client_with_auth,
     submit_transfer_with_checks,
 )
-from .settings import logger
-from .transfer_tracking import GlobusConfig, TaskStatus, TransferBatch, TransferManager
+from .settings import config, logger
+from .transfer_tracking import (
+    CacheBudget,
+    GlobusConfig,
+    TaskStatus,
+    TransferBatch,
+    TransferManager,
+)
 from .utils import ts_utc
 
+# Globus runs at most this many transfer tasks per user at once
+GLOBUS_MAX_ACTIVE_TASKS: int = 3
+# Without --prefetch-budget, how many tars `GlobusRetriever` holds requested
+# and not done with yet: a few for each task Globus runs at once
+GLOBUS_RETRIEVE_MAX_TARS: int = 4 * GLOBUS_MAX_ACTIVE_TASKS
+# How often, in seconds, `GlobusRetriever` looks for tars that have landed
+GLOBUS_RETRIEVE_POLL_INTERVAL: float = 5.0
+# How long, in seconds, `GlobusRetriever` waits for a tar before giving up on its task:
+# 10 hours, as long as `globus_block_wait` waits by default
+GLOBUS_RETRIEVE_TIMEOUT: float = 36000.0
+
 
 def globus_activate(
     hpss: str, globus_config: Optional[GlobusConfig] = None
@@ -89,6 +109,7 @@ def globus_transfer(  # noqa: C901
     name: str,
     transfer_type: str,
     non_blocking: bool,
+    local_dir: Optional[str] = None,
 ) -> TaskStatus:
 
     logger.info(f"{ts_utc()}: Entered globus_transfer() for name = {name}")
@@ -155,6 +176,7 @@ def globus_transfer(  # noqa: C901
         name,
         transfer_data,
         label,
+        local_dir,
     )
 
     task: GlobusHTTPResponse
@@ -496,11 +518,13 @@ def _wait_for_all_tasks(
     transfer_client: TransferClient,
     task_ids: List[str],
     task_to_batch: Dict[str, TransferBatch],
-) -> None:
+) -> bool:
     """
     For each task_id, refresh status; if not SUCCEEDED, block via globus_wait;
     then refresh status again for deletion logic.
+    Return whether all of the tasks SUCCEEDED.
     """
+    succeeded: bool = True
     for tid in task_ids:
         status = _refresh_batch_status(transfer_client, tid, task_to_batch)
         if status == TaskStatus.SUCCEEDED:
@@ -513,7 +537,10 @@ def _wait_for_all_tasks(
         globus_wait(transfer_client, tid)
 
         # After wait returns, task is terminal; refresh once more.
-        _refresh_batch_status(transfer_client, tid, task_to_batch)
+        status = _refresh_batch_status(transfer_client, tid, task_to_batch)
+        if status != TaskStatus.SUCCEEDED:
+            succeeded = False
+    return succeeded
 
 
 def _prune_empty_batches(transfer_manager: TransferManager) -> None:
@@ -530,13 +557,57 @@ def _prune_empty_batches(transfer_manager: TransferManager) -> None:
         logger.debug(f"{ts_utc()}: Pruned {before - after} empty transfer batches")
 
 
-def globus_finalize(transfer_manager: TransferManager, keep: bool) -> None:
+def globus_release_cache(transfer_manager: TransferManager) -> None:
+    """
+    Without waiting, refresh the status of submitted non-blocking transfers,
+    and delete the files whose transfer has succeeded.
+    """
+    globus_config: Optional[GlobusConfig] = transfer_manager.globus_config
+    if globus_config and globus_config.transfer_client:
+        transfer_client: TransferClient = globus_config.transfer_client
+        for batch in transfer_manager.batches:
+            if not (batch.is_globus and batch.task_id and batch.file_paths):
+                continue
+            if batch.task_status != TaskStatus.SUCCEEDED:
+                _refresh_batch_status(
+                    transfer_client, batch.task_id, {batch.task_id: batch}
+                )
+    transfer_manager.delete_successfully_transferred_files()
+
+
+def globus_transfer_succeeded(
+    transfer_manager: TransferManager, batch: TransferBatch
+) -> bool:
+    """
+    Without waiting, whether the non-blocking transfer of `batch` has succeeded,
+    refreshing its status while it may still be in progress.
+    """
+    if batch.task_status == TaskStatus.SUCCEEDED:
+        return True
+    if (not batch.task_id) or (
+        batch.task_status in (TaskStatus.FAILED, TaskStatus.EXHAUSTED_TIMEOUT_RETRIES)
+    ):
+        # Not submitted yet, or never will succeed
+        return False
+    globus_config: Optional[GlobusConfig] = transfer_manager.globus_config
+    if globus_config and globus_config.transfer_client:
+        _refresh_batch_status(
+            globus_config.transfer_client, batch.task_id, {batch.task_id: batch}
+        )
+    return batch.task_status == TaskStatus.SUCCEEDED
+
+
+def globus_finalize(transfer_manager: TransferManager, keep: bool) -> bool:
+    """
+    Submit what's left to transfer, and wait for all the transfers.
+    Return whether they all succeeded.
+    """
     if transfer_manager.globus_config is None:
         logger.debug("No GlobusConfig object provided for finalization")
-        return
+        return True
     if transfer_manager.globus_config.transfer_client is None:
         logger.debug("GlobusConfig provided but transfer_client is None")
-        return
+        return True
 
     # By this point, we know transfer_client is not None
     transfer_client: TransferClient = transfer_manager.globus_config.transfer_client
@@ -551,8 +622,312 @@ def globus_finalize(transfer_manager: TransferManager, keep: bool) -> None:
         transfer_manager, last_task_id, keep
     )
 
-    _wait_for_all_tasks(transfer_client, task_ids, task_to_batch)
+    succeeded: bool = _wait_for_all_tasks(transfer_client, task_ids, task_to_batch)
 
     transfer_manager.delete_successfully_transferred_files()
 
     _prune_empty_batches(transfer_manager)
+    return succeeded
+
+
+class GlobusRetriever(object):
+    """
+    Get the tars `zstash extract` and `zstash check` need from a Globus archive
+    in a few large transfer tasks, rather than one task per tar,
+    each waited on before the next.
+
+    The tars requested and not done with yet stay within `budget`,
+    and more are requested as the others are done with.
+    A tar can be used once Globus lists it among its task's successful transfers,
+    while the rest of the task goes on.
+    A file of the right size in the cache isn't enough:
+    Globus may still be writing it, or verifying its checksum.
+    A task that fails, goes inactive, or takes longer than `timeout`
+    is given up on, and its tars are left to `hpss_get`.
+    Only the process that made the retriever requests tars:
+    the workers of a parallel extract only wait for them.
+    """
+
+    def __init__(
+        self,
+        hpss: str,
+        cache: str,
+        expected_sizes: Dict[str, int],
+        budget: Optional[CacheBudget] = None,
+        globus_config: Optional[GlobusConfig] = None,
+        poll_interval: float = GLOBUS_RETRIEVE_POLL_INTERVAL,
+        timeout: float = GLOBUS_RETRIEVE_TIMEOUT,
+    ):
+        self.hpss: str = hpss
+        self.remote_path: str = urlparse(hpss).path
+        self.local_dir: str = os.path.abspath(cache)
+        self.expected_sizes: Dict[str, int] = expected_sizes
+        self.budget: CacheBudget = (
+            budget if budget else CacheBudget(max_tars=GLOBUS_RETRIEVE_MAX_TARS)
+        )
+        self.globus_config: Optional[GlobusConfig] = (
+            globus_config if globus_config else globus_activate(hpss)
+        )
+        self.poll_interval: float = poll_interval
+        self.timeout: float = timeout
+        # Tars to request, in the order they're needed
+        self.pending: Deque[str] = collections.deque()
+        # The same tars, to look them up
+        self.pending_names: Set[str] = set()
+        # Tars requested, or left to `hpss_get`, and not done with yet,
+        # with their sizes: what the budget counts
+        self.held: Dict[str, int] = {}
+        # Tar name -> the task getting it, until it's been waited for
+        self.task_ids: Dict[str, str] = {}
+        # Tasks known to have ended, or been given up on
+        self.task_statuses: Dict[str, TaskStatus] = {}
+        # Task -> how many of its successful transfers have been listed
+        self.listed: Dict[str, int] = {}
+        # Tars Globus has reported as transferred
+        self.transferred: Set[str] = set()
+        # The process requesting the tars
+        self.owner_pid: int = os.getpid()
+        # The TransferClient can't be shared with processes forked from this one
+        self.pid: int = os.getpid()
+
+    def in_cache(self, name: str) -> bool:
+        """
+        Whether the tar is in the cache with its expected size.
+        A tar whose size isn't known may be a partial download, so it isn't.
+        """
+        local_path: str = os.path.join(self.local_dir, name)
+        if (name not in self.expected_sizes) or not os.path.exists(local_path):
+            return False
+        return os.path.getsize(local_path) == self.expected_sizes[name]
+
+    def landed(self, name: str) -> bool:
+        """
+        Whether the tar's transfer is confirmed by its task,
+        and it's in the cache, with its expected size if that's known.
+        """
+        if name not in self.transferred:
+            return False
+        local_path: str = os.path.join(self.local_dir, name)
+        if not os.path.exists(local_path):
+            return False
+        if name not in self.expected_sizes:
+            return True
+        return os.path.getsize(local_path) == self.expected_sizes[name]
+
+    def tar_size(self, name: str) -> int:
+        # Without a tars table, assume the largest size a tar can have
+        return self.expected_sizes.get(name, int(config.maxsize or 0))
+
+    def submit(self, names: List[str]):
+        """
+        Get the tars in `names` that aren't in the cache already, in order:
+        the first ones now, as far as the budget allows, the others as tars are done with.
+        """
+        for name in names:
+            if (name not in self.pending_names) and not self.in_cache(name):
+                self.pending.append(name)
+                self.pending_names.add(name)
+        self.refill()
+
+    def is_pending(self, name: str) -> bool:
+        """
+        Whether the tar is still waiting to be requested.
+        """
+        return name in self.pending_names
+
+    def makes_a_task(self, num_bytes: int, num_tars: int) -> bool:
+        """
+        Whether tars of `num_bytes` in all are worth a task of their own:
+        as much as a share of the budget, for each task Globus runs at once.
+        """
+        if (self.budget.max_bytes is not None) and (
+            num_bytes * GLOBUS_MAX_ACTIVE_TASKS < self.budget.max_bytes
+        ):
+            return False
+        if (self.budget.max_tars is not None) and (
+            num_tars * GLOBUS_MAX_ACTIVE_TASKS < self.budget.max_tars
+        ):
+            return False
+        return True
+
+    def refill(self):
+        """
+        Request the next tars, as far as the budget allows with the ones held.
+        The first ones are split into at most GLOBUS_MAX_ACTIVE_TASKS tasks.
+        After that, a task is only started once it's worth one, or has the last tars,
+        so that the tars still come in a few large tasks.
+        """
+        if os.getpid() != self.owner_pid:
+            return
+        while self.pending:
+            held_bytes: int = sum(self.held.values())
+            batch: List[str] = []
+            batch_bytes: int = 0
+            for name in self.pending:
+                size: int = self.tar_size(name)
+                # At least one tar, even if it's over the budget by itself
+                if (self.held or batch) and not self.budget.allows(
+                    held_bytes + batch_bytes + size, len(self.held) + len(batch) + 1
+                ):
+                    break
+                batch.append(name)
+                batch_bytes += size
+            if not batch:
+                return
+            if (
+                self.held
+                and (len(batch) < len(self.pending))
+                and not self.makes_a_task(batch_bytes, len(batch))
+            ):
+                return
+            n_tasks: int = 1 if self.held else min(GLOBUS_MAX_ACTIVE_TASKS, len(batch))
+            for name in batch:
+                self.pending.popleft()
+                self.pending_names.discard(name)
+                self.held[name] = self.tar_size(name)
+            for i in range(n_tasks):
+                self.request(
+                    batch[i * len(batch) // n_tasks : (i + 1) * len(batch) // n_tasks]
+                )
+
+    def request(self, batch: List[str]):
+        """
+        Start a task getting the tars in `batch`.
+        If it can't be submitted, they're left to `hpss_get`, one at a time.
+        """
+        if (not self.globus_config) or (not self.globus_config.transfer_client):
+            return
+        transfer_client: TransferClient = self.globus_config.transfer_client
+        local_endpoint: Optional[str] = self.globus_config.local_endpoint
+        remote_endpoint: Optional[str] = self.globus_config.remote_endpoint
+        if (not local_endpoint) or (not remote_endpoint):
+            return
+        label: str = get_label(self.remote_path, batch[0])
+        transfer_data: TransferData = create_TransferData(
+            "get", local_endpoint, remote_endpoint, transfer_client, label
+        )
+        for name in batch:
+            add_file_to_TransferData(
+                "get",
+                local_endpoint,
+                remote_endpoint,
+                self.remote_path,
+                name,
+                transfer_data,
+                label,
+                self.local_dir,
+            )
+        try:
+            task: GlobusHTTPResponse = submit_transfer_with_checks(
+                transfer_client, transfer_data
+            )
+        except Exception as e:
+            logger.warning(
+                f"{ts_utc()}: Could not submit the transfer of {len(batch)} tars, getting them one at a time: {e}"
+            )
+            return
+        task_id: str = task["task_id"]
+        logger.info(
+            f"{ts_utc()}: Globus task {task_id} is getting {len(batch)} tars, {batch[0]} to {batch[-1]}"
+        )
+        for name in batch:
+            self.task_ids[name] = task_id
+
+    def done(self, tfname: str):
+        """
+        The tar `tfname` has been extracted, and deleted unless it's kept:
+        request more tars in its place.
+        """
+        self.held.pop(os.path.basename(tfname), None)
+        self.refill()
+
+    def get_transfer_client(self) -> TransferClient:
+        if os.getpid() != self.pid:
+            # In a worker process of a parallel extract: connect again
+            self.globus_config = globus_activate(self.hpss)
+            self.pid = os.getpid()
+        if (not self.globus_config) or (not self.globus_config.transfer_client):
+            raise RuntimeError("No Globus TransferClient to check the transfers")
+        return self.globus_config.transfer_client
+
+    def task_status(self, task_id: str) -> TaskStatus:
+        """
+        The task's status, FAILED if it's still active with a fatal error.
+        Its successful transfers are listed again whenever Globus counts more of them,
+        so that its tars can be used while it goes on.
+        """
+        if task_id in self.task_statuses:
+            return self.task_statuses[task_id]
+        transfer_client: TransferClient = self.get_transfer_client()
+        task: GlobusHTTPResponse = transfer_client.get_task(task_id)
+        status: TaskStatus = TaskStatus.convert_from_status_from_globus_sdk(task)
+        if (status == TaskStatus.ACTIVE) and task.get("fatal_error"):
+            logger.warning(
+                f"{ts_utc()}: Globus task {task_id} has a fatal error: {task['fatal_error']}"
+            )
+            self.give_up(task_id, TaskStatus.FAILED)
+            return TaskStatus.FAILED
+        ended: bool = status in (TaskStatus.SUCCEEDED, TaskStatus.FAILED)
+        # How many files the task has transferred so far, if Globus says
+        files_transferred: Optional[int] = task.get("files_transferred")
+        if (ended and (files_transferred is None) and (task_id not in self.listed)) or (
+            (files_transferred or 0) > self.listed.get(task_id, 0)
+        ):
+            listed: int = 0
+            response: Dict[str, str]
+            for response in transfer_client.paginated.task_successful_transfers(
+                task_id
+            ).items():
+                self.transferred.add(os.path.basename(response["destination_path"]))
+                listed += 1
+            self.listed[task_id] = listed
+        if ended:
+            self.task_statuses[task_id] = status
+        return status
+
+    def give_up(self, task_id: str, status: TaskStatus):
+        """
+        Cancel a task that hasn't ended, so it doesn't write into the cache
+        while its tars are fetched otherwise, and remember `status` for it.
+        """
+        self.task_statuses[task_id] = status
+        try:
+            self.get_transfer_client().cancel_task(task_id)
+        except Exception as e:
+            logger.warning(f"{ts_utc()}: Could not cancel Globus task {task_id}: {e}")
+
+    def wait_for(self, tfname: str) -> bool:
+        """
+        Wait until the tar `tfname` has landed in the cache.
+        Return False if it wasn't submitted, so it has to be fetched otherwise,
+        which is also what happens if this is called again after an error.
+        Raise RuntimeError if its task ends without it, goes inactive,
+        or doesn't get it within `timeout` seconds.
+        """
+        name: str = os.path.basename(tfname)
+        if self.is_pending(name) and (os.getpid() == self.owner_pid):
+            # Needed before its turn, e.g. for a file split across tars
+            self.pending.remove(name)
+            self.pending_names.discard(name)
+            self.held[name] = self.tar_size(name)
+            self.request([name])
+        task_id: Optional[str] = self.task_ids.pop(name, None)
+        if task_id is None:
+            return False
+        deadline: float = time.monotonic() + self.timeout
+        while True:
+            status: TaskStatus = self.task_status(task_id)
+            if self.landed(name):
+                logger.info(f"{ts_utc()}: {name} landed from Globus task {task_id}")
+                return True
+            if task_id not in self.task_statuses:
+                if status == TaskStatus.INACTIVE:
+                    self.give_up(task_id, status)
+                elif time.monotonic() >= deadline:
+                    status = TaskStatus.EXHAUSTED_TIMEOUT_RETRIES
+                    self.give_up(task_id, status)
+            if task_id in self.task_statuses:
+                raise RuntimeError(
+                    f"Globus task {task_id} ended with status {status} without getting {name}"
+                )
+            time.sleep(self.poll_interval)
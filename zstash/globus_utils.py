@@ -260,16 +260,19 @@ def add_file_to_TransferData(
     name: str,
     transfer_data: TransferData,
     label: str,
+    local_dir: Optional[str] = None,
 ):
     if not local_endpoint:
         raise ValueError("Local endpoint ID is not set.")
     if not remote_endpoint:
         raise ValueError("Remote endpoint ID is not set.")
+    if not local_dir:
+        local_dir = os.getcwd()
     if transfer_type == "get":
         src_path = os.path.join(remote_path, name)
-        dst_path = os.path.join(os.getcwd(), name)
+        dst_path = os.path.join(local_dir, name)
     else:
-        src_path = os.path.join(os.getcwd(), name)
+        src_path = os.path.join(local_dir, name)
         dst_path = os.path.join(remote_path, name)
 
     transfer_data.add_item(src_path, dst_path)
@@ -1,15 +1,17 @@
 from __future__ import absolute_import, print_function
 
 import os.path
+import shlex
 import subprocess
-from typing import List, Optional
+import tempfile
+from typing import IO, List, Optional
 
 from six.moves.urllib.parse import urlparse
 
 from .globus import globus_transfer
 from .settings import get_db_filename, logger
 from .transfer_tracking import GlobusConfig, TaskStatus, TransferBatch, TransferManager
-from .utils import run_command, ts_utc
+from .utils import command_error, get_command_environment, run_command, ts_utc
 
 
 def hpss_transfer(
@@ -96,17 +98,19 @@ def hpss_transfer(
             )
 
         # Need to be in local directory for `hsi` to work
-        cwd = os.getcwd()
+        # For `put`, this directory contains the file we want to transfer to HPSS.
+        # For `get`, this directory is where the file we get from HPSS will go.
+        # Note: we don't `os.chdir` into it, because `create` transfers tars
+        # on a background thread while the main thread is reading relative paths.
+        local_dir: str = os.getcwd()
         if path != "":
-            if (transfer_type == "get") and (not os.path.isdir(path)):
+            if transfer_type == "get":
                 # We are getting a file from HPSS.
-                # The directory the file is in doesn't exist locally.
-                # So, make the path locally
-                os.makedirs(path)
-            # Enter the path (directory)
-            # For `put`, this directory contains the file we want to transfer to HPSS.
-            # For `get`, this directory is where the file we get from HPSS will go.
-            os.chdir(path)
+                # The directory the file is in may not exist locally.
+                # So, make the path locally.
+                # Prefetched tars may be getting it at the same time.
+                os.makedirs(path, exist_ok=True)
+            local_dir = os.path.abspath(path)
 
         globus_status: TaskStatus = TaskStatus.UNKNOWN
         if scheme == "globus":
@@ -115,7 +119,13 @@ def hpss_transfer(
             # Transfer file using the Globus Transfer Service
             logger.info(f"{ts_utc()}: DIVING: hpss calls globus_transfer(name={name})")
             task_status: TaskStatus = globus_transfer(
-                transfer_manager, endpoint, url_path, name, transfer_type, non_blocking
+                transfer_manager,
+                endpoint,
+                url_path,
+                name,
+                transfer_type,
+                non_blocking,
+                local_dir,
             )
             logger.info(
                 f"{ts_utc()}: SURFACE: hpss globus_transfer(name={name}) returned task_status={task_status}"
@@ -134,11 +144,7 @@ def hpss_transfer(
             # Transfer file using `hsi`
             command: str = 'hsi -q "cd {}; {} {}"'.format(hpss, transfer_command, name)
             error_str: str = "Transferring file {} HPSS: {}".format(transfer_word, name)
-            run_command(command, error_str)
-
-        # Return to original working directory
-        if path != "":
-            os.chdir(cwd)
+            run_command(command, error_str, cwd=local_dir)
 
         if transfer_type == "put":
             if not keep:
@@ -189,6 +195,78 @@ def hpss_get(
     )
 
 
+def check_stream_supported(hpss: str):
+    """
+    Tars can only be streamed to an HPSS archive transferred with `hsi`.
+    """
+    if (hpss == "none") or (urlparse(hpss).scheme == "globus"):
+        error_str: str = (
+            f"--stream requires an HPSS path transferred with hsi, not --hpss={hpss}"
+        )
+        logger.error(error_str)
+        raise ValueError(error_str)
+
+
+class HPSSStream(object):
+    """
+    A file written straight to the HPSS archive,
+    through the standard input of `hsi put - : <name>`,
+    so it never has to be written to the cache.
+    """
+
+    def __init__(self, hpss: str, name: str):
+        self.command: str = 'hsi -q "cd {}; put - : {}"'.format(hpss, name)
+        self.error_str: str = "Streaming file to HPSS: {}".format(name)
+        logger.info("Streaming file to HPSS: {}".format(name))
+        command_args: List[str] = shlex.split(self.command)
+        # `hsi` output goes to temporary files, rather than pipes,
+        # so that it can't fill a pipe and block while we're writing to its input.
+        self.stdout: IO[bytes] = tempfile.TemporaryFile()
+        self.stderr: IO[bytes] = tempfile.TemporaryFile()
+        self.p: subprocess.Popen = subprocess.Popen(
+            command_args,
+            stdin=subprocess.PIPE,
+            stdout=self.stdout,
+            stderr=self.stderr,
+            env=get_command_environment(command_args),
+        )
+        self.closed: bool = False
+
+    def write(self, s) -> int:
+        if self.p.stdin is None:
+            raise TypeError("Invalid stdin={}".format(self.p.stdin))
+        return self.p.stdin.write(s)
+
+    def close(self):
+        """
+        Finish the file, and wait for `hsi` to store it.
+        Raise a RuntimeError if it couldn't.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.p.stdin is not None:
+                self.p.stdin.close()
+        except BrokenPipeError:
+            # `hsi` exited early; its status says why.
+            pass
+        status: int = self.p.wait()
+        try:
+            if status != 0:
+                self.stdout.seek(0)
+                self.stderr.seek(0)
+                raise command_error(
+                    self.command,
+                    self.error_str,
+                    self.stdout.read(),
+                    self.stderr.read(),
+                )
+        finally:
+            self.stdout.close()
+            self.stderr.close()
+
+
 def hpss_chgrp(hpss: str, group: str, recurse: bool = False):
     """
     Change the group of the HPSS archive.
@@ -1,20 +1,59 @@
 from __future__ import absolute_import, print_function
 
+import collections
+import copy
 import hashlib
+import multiprocessing
+import multiprocessing.pool
 import os
 import os.path
+import queue
 import sqlite3
 import tarfile
+import threading
+import time
 import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, List, Optional, Tuple
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Set, Tuple
+from urllib.parse import urlparse
 
 import _hashlib
 
-from .hpss import hpss_put
-from .settings import TupleFilesRowNoId, TupleTarsRowNoId, config, logger
-from .transfer_tracking import TransferManager
-from .utils import create_tars_table, tars_table_exists, ts_utc
+from .globus import globus_release_cache, globus_transfer_succeeded
+from .hpss import HPSSStream, check_stream_supported, hpss_put
+from .journal import CreateJournal
+from .settings import (
+    DEFAULT_DIGEST,
+    TupleChunksRowNoFileId,
+    TupleFilesRowNoId,
+    TupleTarsRowNoId,
+    config,
+    has_mtime_ns,
+    logger,
+    mtime_to_ns,
+)
+from .transfer_tracking import CacheBudget, TransferBatch, TransferManager
+from .utils import (
+    FileStats,
+    chunks_table_exists,
+    create_chunks_table,
+    create_tars_table,
+    tars_table_exists,
+    ts_utc,
+)
+
+# Size of the blocks file data is copied into the tar in.
+# hashlib releases the GIL when hashing blocks this large,
+# so reading, hashing and writing can run on different threads at the same time.
+STREAM_BLOCK_SIZE: int = 4 * 1024 * 1024
+# Maximum number of blocks waiting for each background stage.
+# File data is read into (STREAM_QUEUE_DEPTH + 2) reusable buffers,
+# which bounds the memory used per tar to roughly that many blocks.
+STREAM_QUEUE_DEPTH: int = 4
+
+# Seconds between checks on transfers, while tar production is paused by --cache-budget
+CACHE_BUDGET_POLL_INTERVAL: int = 20
 
 
 # This class holds parameters for developer options.
@@ -56,16 +95,38 @@ class DevOptions(object):
 
 
 class TarWrapper(object):
-    def __init__(self, tar_num: int, cache: str, do_hash: bool, follow_symlinks: bool):
+    def __init__(
+        self,
+        tar_num: int,
+        cache: str,
+        do_hash: bool,
+        follow_symlinks: bool,
+        block_size: int = STREAM_BLOCK_SIZE,
+        digest: str = DEFAULT_DIGEST,
+        stream_to: Optional[str] = None,
+    ):
         # Create a hex value at least 6 digits long
         tname: str = "{0:0{1}x}".format(tar_num, 6)
         # Create the tar file name by adding ".tar"
         self.tfname: str = f"{tname}.tar"
         logger.info(f"{ts_utc()}: Creating new tar archive {self.tfname}")
-        # Open that tar file in the cache
-        self.tarFileObject = HashIO(os.path.join(cache, self.tfname), "wb", do_hash)
+        # Open that tar file in the cache,
+        # or, with `stream_to`, write it straight to that HPSS archive.
+        self.streamed: bool = stream_to is not None
+        self.tarFileObject = HashIO(
+            os.path.join(cache, self.tfname),
+            "wb",
+            do_hash,
+            digest,
+            HPSSStream(stream_to, self.tfname) if stream_to else None,
+        )
         # FIXME: error: Argument "fileobj" to "open" has incompatible type "HashIO"; expected "Optional[IO[bytes]]"
         self.tar = tarfile.open(mode="w", fileobj=self.tarFileObject, dereference=follow_symlinks)  # type: ignore
+        # Writes file data into the tar, instead of `tarfile.addfile`
+        self.payload_writer: PayloadWriter = PayloadWriter(
+            self.tarFileObject, block_size, digest
+        )
+        self.digest: str = digest
 
     def process_file(
         self,
@@ -82,7 +143,7 @@ class TarWrapper(object):
             mtime: datetime
             md5: Optional[str]
             offset, size, mtime, md5 = add_file_to_tar_archive(
-                self.tar, current_file, tar_info
+                self.tar, current_file, tar_info, self.payload_writer, self.digest
             )
             t: TupleFilesRowNoId = (
                 current_file,
@@ -103,7 +164,239 @@ class TarWrapper(object):
             failures.append(current_file)
         return tar_size
 
-    def process_tar(
+    def close(self, archived: List[TupleFilesRowNoId]) -> "BuiltTar":
+        """
+        Close the tar and return what's needed to transfer it
+        and to add it to the database.
+        """
+        logger.debug(f"{ts_utc()}: Closing tar archive {self.tfname}")
+        self.tar.close()
+        self.payload_writer.close()
+
+        tar_size: int = self.tarFileObject.tell()
+        tar_md5: Optional[str] = self.tarFileObject.md5()
+        self.tarFileObject.close()
+        logger.info(f"{ts_utc()}: (close): Completed archive file {self.tfname}")
+        return BuiltTar(
+            self.tfname, tar_size, tar_md5, archived, streamed=self.streamed
+        )
+
+
+# A tar that has been closed in the cache,
+# but that may not have been transferred or added to the database yet.
+class BuiltTar(object):
+    def __init__(
+        self,
+        tfname: str,
+        size: int,
+        md5: Optional[str],
+        archived: List[TupleFilesRowNoId],
+        split_file: Optional[TupleFilesRowNoId] = None,
+        split_chunks: Optional[List[TupleChunksRowNoFileId]] = None,
+        streamed: bool = False,
+    ):
+        self.tfname: str = tfname
+        self.size: int = size
+        self.md5: Optional[str] = md5
+        # The rows to add to the files table, once the tar has been transferred.
+        self.archived: List[TupleFilesRowNoId] = archived
+        # For the tar holding the last part of a file split across several tars:
+        # the file's row, and the rows for all of its parts.
+        # They're only added once every part has been transferred.
+        self.split_file: Optional[TupleFilesRowNoId] = split_file
+        self.split_chunks: List[TupleChunksRowNoFileId] = split_chunks or []
+        # True if the tar was written straight to HPSS, so there's nothing to transfer.
+        self.streamed: bool = streamed
+
+
+def transfer_tar(
+    built_tar: BuiltTar,
+    cache: str,
+    keep: bool,
+    non_blocking: bool,
+    transfer_manager: TransferManager,
+):
+    """
+    Submit the tar to the transfer manager's batch transfer system.
+    Return the batch of a non-blocking Globus transfer,
+    which may still be in progress, or None once the tar is transferred.
+    """
+    if config.hpss is not None:
+        hpss: str = config.hpss
+    else:
+        raise TypeError("Invalid config.hpss={}".format(config.hpss))
+
+    if built_tar.streamed:
+        logger.info(f"{ts_utc()}: {built_tar.tfname} was streamed to HPSS")
+        return None
+
+    logger.debug(f"Contents of the cache prior to `hpss_put`: {os.listdir(cache)}")
+
+    logger.info(
+        f"{ts_utc()}: DIVING: (transfer_tar): Calling hpss_put to dispatch archive file {built_tar.tfname} [keep, non_blocking] = [{keep}, {non_blocking}]"
+    )
+    # Actually submit the tar file
+    hpss_put(
+        hpss,
+        os.path.join(cache, built_tar.tfname),
+        cache,
+        transfer_manager,
+        keep,
+        non_blocking,
+        is_index=False,
+    )
+    logger.info(
+        f"{ts_utc()}: SURFACE (transfer_tar): Called hpss_put to dispatch archive file {built_tar.tfname}"
+    )
+    if non_blocking and (urlparse(hpss).scheme == "globus"):
+        return transfer_manager.get_most_recent_batch()
+    return None
+
+
+def index_files_row(row: TupleFilesRowNoId) -> tuple:
+    """
+    Return the values to insert in the files table for `row`,
+    with the mtime in the database's layout.
+    """
+    if has_mtime_ns():
+        return row[:2] + (mtime_to_ns(row[2]),) + row[3:]
+    return row
+
+
+def add_tar_to_database(
+    built_tar: BuiltTar,
+    skip_tars_table: bool,
+    cur: sqlite3.Cursor,
+    con: sqlite3.Connection,
+    dev_options: DevOptions,
+):
+    """
+    Add a transferred tar, and the files it contains, to the database.
+    """
+    tfname: str = built_tar.tfname
+    tar_size: int = built_tar.size
+    tar_md5: Optional[str] = built_tar.md5
+
+    # 1. Add the tar itself to the tars table ##############################
+    if not skip_tars_table:
+        tar_tuple: TupleTarsRowNoId = (tfname, tar_size, tar_md5)
+        logger.info("tar name={}, tar size={}, tar md5={}".format(*tar_tuple))
+        if not tars_table_exists(cur):
+            # Need to create tars table
+            create_tars_table(cur, con)
+
+        # For developers only! For debugging/testing purposes only!
+        dev_options.simulate_row_existing(tfname, cur, tar_tuple, tar_size, tar_md5)
+
+        # We're done adding files to the tar.
+        # And we've transferred it to HPSS.
+        # Now we can insert the tar into the database.
+        cur.execute("SELECT COUNT(*) FROM tars WHERE name = ?", (tfname,))
+        tar_count: int = cur.fetchone()[0]
+        if tar_count != 0:
+            error_str: str = (
+                f"Database corruption detected! {tfname} is already in the database."
+            )
+            if dev_options.error_on_duplicate_tar:
+                # Tested by database_corruption.bash Case 3
+                # Exists - error out
+                logger.error(error_str)
+                raise RuntimeError(error_str)
+            elif dev_options.overwrite_duplicate_tars:
+                # Tested by database_corruption.bash Case 4
+                # Exists - update with new size and md5
+                logger.warning(error_str)
+                logger.warning(f"Updating existing tar {tfname} to proceed.")
+                cur.execute(
+                    "UPDATE tars SET size = ?, md5 = ? WHERE name = ?",
+                    (tar_size, tar_md5, tfname),
+                )
+            else:
+                # Tested by database_corruption.bash Cases 5,7
+                # Proceed as if we're in the typical case -- insert new
+                logger.warning(error_str)
+                logger.warning(f"Adding a new entry for {tfname}.")
+                cur.execute("INSERT INTO tars VALUES (NULL,?,?,?)", tar_tuple)
+        elif dev_options.force_database_corruption == "simulate_no_correct_size":
+            # Tested by database_corruption.bash Case 6
+            # For developers only! For debugging purposes only!
+            # Add this tar twice, with different sizes.
+            logger.info(
+                f"TESTING/DEBUGGING ONLY: Simulating no correct size for {tfname}."
+            )
+            cur.execute(
+                "INSERT INTO tars VALUES (NULL,?,?,?)",
+                (tfname, tar_size + 1000, tar_md5),
+            )
+            cur.execute(
+                "INSERT INTO tars VALUES (NULL,?,?,?)",
+                (tfname, tar_size + 2000, tar_md5),
+            )
+        elif (
+            dev_options.force_database_corruption == "simulate_bad_size_for_most_recent"
+        ):
+            # Tested by database_corruption.bash Case 8
+            # For developers only! For debugging purposes only!
+            # Add this tar twice, second time with bad size.
+            logger.info(
+                f"TESTING/DEBUGGING ONLY: Simulating bad size for most recent entry for {tfname}."
+            )
+            cur.execute(
+                "INSERT INTO tars VALUES (NULL,?,?,?)",
+                (tfname, tar_size, tar_md5),
+            )
+            cur.execute(
+                "INSERT INTO tars VALUES (NULL,?,?,?)",
+                (tfname, tar_size + 2000, tar_md5),
+            )
+        else:
+            # Tested by database_corruption.bash Cases 1,2
+            # Typical case
+            # Doesn't exist - insert new
+            logger.info(f"Adding {tfname} to the database.")
+            cur.execute("INSERT INTO tars VALUES (NULL,?,?,?)", tar_tuple)
+
+        con.commit()
+
+    # 2. Add the files included in this tar to the files table #############
+    # Update database with the individual files that have been archived
+    # Add a row to the "files" table,
+    # the last 6 columns matching the values of `archived`
+    cur.executemany(
+        "insert into files values (NULL,?,?,?,?,?,?)",
+        map(index_files_row, built_tar.archived),
+    )
+    con.commit()
+
+    # 3. Add a file split across several tars, and its parts ###############
+    if built_tar.split_file is not None:
+        if not chunks_table_exists(cur):
+            create_chunks_table(cur, con)
+        cur.execute(
+            "insert into files values (NULL,?,?,?,?,?,?)",
+            index_files_row(built_tar.split_file),
+        )
+        file_id: Optional[int] = cur.lastrowid
+        cur.executemany(
+            "insert into chunks values (NULL,?,?,?,?,?,?)",
+            [(file_id,) + chunk for chunk in built_tar.split_chunks],
+        )
+        con.commit()
+
+
+class TransferPipeline(object):
+    """
+    Transfers closed tars on a background thread,
+    so that the next tar can be built while the previous one is uploading.
+
+    At most one tar is transferred at a time.
+    A tar is only added to the database once its transfer has returned.
+    It's only added to the journal once its transfer has succeeded,
+    which for a non-blocking Globus transfer can be a while later.
+    The database is only ever accessed from the thread that built the tars.
+    """
+
+    def __init__(
         self,
         cache: str,
         keep: bool,
@@ -113,143 +406,251 @@ class TarWrapper(object):
         cur: sqlite3.Cursor,
         con: sqlite3.Connection,
         dev_options: DevOptions,
-        archived: List[TupleFilesRowNoId],
+        journal: Optional[CreateJournal] = None,
     ):
-        # 1. Close the tar ####################################################
-        logger.debug(f"{ts_utc()}: Closing tar archive {self.tfname}")
-        self.tar.close()
+        self.cache: str = cache
+        self.keep: bool = keep
+        self.non_blocking: bool = non_blocking
+        self.transfer_manager: TransferManager = transfer_manager
+        self.skip_tars_table: bool = skip_tars_table
+        self.cur: sqlite3.Cursor = cur
+        self.con: sqlite3.Connection = con
+        self.dev_options: DevOptions = dev_options
+        # Checkpoints each tar once it's in the database, for `--resume`
+        self.journal: Optional[CreateJournal] = journal
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=1)
+        # Held while a tar is handed to the transfer manager,
+        # which wait_for_cache also checks on from this thread
+        self.transfer_lock: threading.Lock = threading.Lock()
+        # The tar currently being transferred, if any
+        self.in_flight: Optional[Tuple[BuiltTar, Future]] = None
+        # Tars in the database whose non-blocking transfers haven't succeeded yet
+        self.unconfirmed: List[Tuple[BuiltTar, TransferBatch]] = []
 
-        tar_size = self.tarFileObject.tell()
-        tar_md5: Optional[str] = self.tarFileObject.md5()
-        self.tarFileObject.close()
-        logger.info(f"{ts_utc()}: (process_tar): Completed archive file {self.tfname}")
-
-        # 2. Submit the tar to the transfer manager's batch transfer system ###
-        if config.hpss is not None:
-            hpss: str = config.hpss
-        else:
-            raise TypeError("Invalid config.hpss={}".format(config.hpss))
+    def submit(self, built_tar: BuiltTar):
+        """
+        Start transferring `built_tar`,
+        once the previous tar has been transferred and added to the database.
+        """
+        self.wait()
+        future: Future = self.executor.submit(self.transfer, built_tar)
+        self.in_flight = (built_tar, future)
 
-        logger.debug(f"Contents of the cache prior to `hpss_put`: {os.listdir(cache)}")
+    def transfer(self, built_tar: BuiltTar) -> Optional[TransferBatch]:
+        with self.transfer_lock:
+            return transfer_tar(
+                built_tar,
+                self.cache,
+                self.keep,
+                self.non_blocking,
+                self.transfer_manager,
+            )
 
-        logger.info(
-            f"{ts_utc()}: DIVING: (process_tar): Calling hpss_put to dispatch archive file {self.tfname} [keep, non_blocking] = [{keep}, {non_blocking}]"
-        )
-        # Actually submit the tar file
-        hpss_put(
-            hpss,
-            os.path.join(cache, self.tfname),
-            cache,
-            transfer_manager,
-            keep,
-            non_blocking,
-            is_index=False,
-        )
-        logger.info(
-            f"{ts_utc()}: SURFACE (process_tar): Called hpss_put to dispatch archive file {self.tfname}"
+    def wait(self):
+        """
+        Wait for the tar in flight to finish transferring,
+        then add it to the database.
+        """
+        if self.in_flight is None:
+            return
+        built_tar: BuiltTar
+        future: Future
+        built_tar, future = self.in_flight
+        self.in_flight = None
+        # This re-raises any exception from the transfer in this thread.
+        batch: Optional[TransferBatch] = future.result()
+        add_tar_to_database(
+            built_tar, self.skip_tars_table, self.cur, self.con, self.dev_options
         )
+        if self.journal:
+            if batch is None:
+                self.journal.record(built_tar.tfname, built_tar.size, built_tar.md5)
+            else:
+                self.unconfirmed.append((built_tar, batch))
+            self.record_transferred()
 
-        # 3. Add the tar itself to the tars table #############################
-        if not skip_tars_table:
-            tar_tuple: TupleTarsRowNoId = (self.tfname, tar_size, tar_md5)
-            logger.info("tar name={}, tar size={}, tar md5={}".format(*tar_tuple))
-            if not tars_table_exists(cur):
-                # Need to create tars table
-                create_tars_table(cur, con)
-
-            # For developers only! For debugging/testing purposes only!
-            dev_options.simulate_row_existing(
-                self.tfname, cur, tar_tuple, tar_size, tar_md5
-            )
-
-            # We're done adding files to the tar.
-            # And we've transferred it to HPSS.
-            # Now we can insert the tar into the database.
-            cur.execute("SELECT COUNT(*) FROM tars WHERE name = ?", (self.tfname,))
-            tar_count: int = cur.fetchone()[0]
-            if tar_count != 0:
-                error_str: str = (
-                    f"Database corruption detected! {self.tfname} is already in the database."
-                )
-                if dev_options.error_on_duplicate_tar:
-                    # Tested by database_corruption.bash Case 3
-                    # Exists - error out
-                    logger.error(error_str)
-                    raise RuntimeError(error_str)
-                elif dev_options.overwrite_duplicate_tars:
-                    # Tested by database_corruption.bash Case 4
-                    # Exists - update with new size and md5
-                    logger.warning(error_str)
-                    logger.warning(f"Updating existing tar {self.tfname} to proceed.")
-                    cur.execute(
-                        "UPDATE tars SET size = ?, md5 = ? WHERE name = ?",
-                        (tar_size, tar_md5, self.tfname),
-                    )
-                else:
-                    # Tested by database_corruption.bash Cases 5,7
-                    # Proceed as if we're in the typical case -- insert new
-                    logger.warning(error_str)
-                    logger.warning(f"Adding a new entry for {self.tfname}.")
-                    cur.execute("INSERT INTO tars VALUES (NULL,?,?,?)", tar_tuple)
-            elif dev_options.force_database_corruption == "simulate_no_correct_size":
-                # Tested by database_corruption.bash Case 6
-                # For developers only! For debugging purposes only!
-                # Add this tar twice, with different sizes.
-                logger.info(
-                    f"TESTING/DEBUGGING ONLY: Simulating no correct size for {self.tfname}."
-                )
-                cur.execute(
-                    "INSERT INTO tars VALUES (NULL,?,?,?)",
-                    (self.tfname, tar_size + 1000, tar_md5),
-                )
-                cur.execute(
-                    "INSERT INTO tars VALUES (NULL,?,?,?)",
-                    (self.tfname, tar_size + 2000, tar_md5),
+    def record_transferred(self):
+        """
+        Add the tars whose non-blocking transfers have succeeded since to the journal.
+        The ones that never do are left out, so that `--resume` builds them again.
+        """
+        if not self.journal:
+            return
+        # Each batch is checked once, however many tars it has
+        succeeded: Dict[int, bool] = {}
+        unconfirmed: List[Tuple[BuiltTar, TransferBatch]] = []
+        for built_tar, batch in self.unconfirmed:
+            if id(batch) not in succeeded:
+                succeeded[id(batch)] = globus_transfer_succeeded(
+                    self.transfer_manager, batch
                 )
-            elif (
-                dev_options.force_database_corruption
-                == "simulate_bad_size_for_most_recent"
+            if succeeded[id(batch)]:
+                self.journal.record(built_tar.tfname, built_tar.size, built_tar.md5)
+            else:
+                unconfirmed.append((built_tar, batch))
+        self.unconfirmed = unconfirmed
+
+    def wait_for_cache(self, budget: CacheBudget, incoming_tars: int, max_size: int):
+        """
+        Pause until the tars waiting in the cache to be transferred,
+        plus `incoming_tars` more of up to `max_size` bytes, fit in `budget`.
+        The tar in flight counts as waiting.
+        """
+        paused: bool = False
+        while True:
+            # Checking on the transfers changes the transfer manager,
+            # so it's skipped while the tar in flight is being handed to it.
+            if self.transfer_lock.acquire(blocking=False):
+                try:
+                    globus_release_cache(self.transfer_manager)
+                finally:
+                    self.transfer_lock.release()
+            staged: Set[str] = set(self.transfer_manager.staged_files())
+            if (self.in_flight is not None) and (not self.in_flight[0].streamed):
+                # It may not be handed to the transfer manager yet
+                staged.add(os.path.join(self.cache, self.in_flight[0].tfname))
+            staged_bytes: int = sum(
+                os.path.getsize(path) for path in staged if os.path.exists(path)
+            )
+            if (not staged) or budget.allows(
+                staged_bytes + incoming_tars * max_size, len(staged) + incoming_tars
             ):
-                # Tested by database_corruption.bash Case 8
-                # For developers only! For debugging purposes only!
-                # Add this tar twice, second time with bad size.
-                logger.info(
-                    f"TESTING/DEBUGGING ONLY: Simulating bad size for most recent entry for {self.tfname}."
-                )
-                cur.execute(
-                    "INSERT INTO tars VALUES (NULL,?,?,?)",
-                    (self.tfname, tar_size, tar_md5),
+                break
+            if self.in_flight is not None:
+                # Its transfer has to be submitted before it can free up the cache
+                self.wait()
+                continue
+            if not self.transfer_manager.has_pending_transfers():
+                # Nothing in flight can free up the cache; waiting wouldn't help.
+                logger.warning(
+                    f"Cache budget of {budget} exceeded, but no transfers are in progress"
                 )
-                cur.execute(
-                    "INSERT INTO tars VALUES (NULL,?,?,?)",
-                    (self.tfname, tar_size + 2000, tar_md5),
+                break
+            if not paused:
+                logger.info(
+                    f"{ts_utc()}: Cache budget of {budget} reached: {len(staged)} tars ({staged_bytes} bytes) waiting to be transferred. Pausing."
                 )
-            else:
-                # Tested by database_corruption.bash Cases 1,2
-                # Typical case
-                # Doesn't exist - insert new
-                logger.info(f"Adding {self.tfname} to the database.")
-                cur.execute("INSERT INTO tars VALUES (NULL,?,?,?)", tar_tuple)
+                paused = True
+            time.sleep(CACHE_BUDGET_POLL_INTERVAL)
+        if paused:
+            logger.info(f"{ts_utc()}: Cache budget of {budget} available. Resuming.")
 
-            con.commit()
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self.executor.shutdown(wait=True)
 
-        # 4. Add the files included in this tar to the files table ############
-        # Update database with the individual files that have been archived
-        # Add a row to the "files" table,
-        # the last 6 columns matching the values of `archived`
-        cur.executemany("insert into files values (NULL,?,?,?,?,?,?)", archived)
-        con.commit()
+
+class BlockStage(object):
+    """
+    Runs `consume` on each item put on a bounded queue, on a background thread.
+
+    Items are consumed in the order they're put.
+    `put` blocks while the queue is full, so a slow stage slows down its producer
+    rather than buffering without limit.
+    An exception raised by `consume` is re-raised in the producer's thread
+    by the next call to `put`, `drain` or `close`.
+    """
+
+    def __init__(self, consume: Callable[[Any], Any], name: str):
+        self.consume: Callable[[Any], Any] = consume
+        self.queue: queue.Queue = queue.Queue(maxsize=STREAM_QUEUE_DEPTH)
+        self.error: Optional[BaseException] = None
+        self.closed: bool = False
+        # Number of items put, and number of items consumed (or skipped after an error)
+        self.put_count: int = 0
+        self.done_count: int = 0
+        self.done_condition: threading.Condition = threading.Condition()
+        self.thread: threading.Thread = threading.Thread(
+            target=self.run, name=f"zstash-{name}", daemon=True
+        )
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                # After a failure, keep emptying the queue so the producer doesn't block.
+                if self.error is None:
+                    self.consume(item)
+            except BaseException as e:
+                self.error = e
+            finally:
+                if item is not None:
+                    with self.done_condition:
+                        self.done_count += 1
+                        self.done_condition.notify_all()
+                self.queue.task_done()
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def put(self, item):
+        self.check()
+        self.queue.put(item)
+        self.put_count += 1
+
+    def wait_for(self, count: int):
+        """
+        Wait until the first `count` items put have been consumed.
+        """
+        with self.done_condition:
+            self.done_condition.wait_for(lambda: self.done_count >= count)
+        self.check()
+
+    def drain(self):
+        """
+        Wait until every item put so far has been consumed.
+        """
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+            self.thread.join()
+        self.check()
+
+
+def update_hash(item: Tuple[Any, bytes]):
+    hasher, block = item
+    hasher.update(block)
 
 
 # Minimum output file object
 class HashIO(object):
-    def __init__(self, name: str, mode: str, do_hash: bool):
-        self.f = open(name, mode)
+    """
+    Writes the tar to disk, and computes its digest, on two background threads.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        mode: str,
+        do_hash: bool,
+        digest: str = DEFAULT_DIGEST,
+        fileobj: Optional[Any] = None,
+    ):
+        # Write to `fileobj` if given, instead of opening `name`
+        self.f = fileobj if fileobj is not None else open(name, mode)
         self.hash: Optional[_hashlib.HASH]
+        self.hash_stage: Optional[BlockStage]
         if do_hash:
-            self.hash = hashlib.md5()
+            self.hash = hashlib.new(digest)
+            self.hash_stage = BlockStage(self.hash.update, "tar-md5")
         else:
             self.hash = None
+            self.hash_stage = None
+        self.write_stage: BlockStage = BlockStage(self.f.write, "tar-write")
+        # Every stage that holds on to what's passed to `write`
+        self.stages: List[BlockStage] = [self.write_stage]
+        if self.hash_stage:
+            self.stages.append(self.hash_stage)
         self.closed: bool = False
         self.position: int = 0
 
@@ -268,15 +669,22 @@ class HashIO(object):
 
         tarfile.open requires that the fileobj argument has a write() method.
         It calls that method to write data to the tar file.
+
+        `s` is handed off to the background stages as is,
+        so it must not be modified until they've consumed it.
+        tarfile only ever passes in `bytes`;
+        PayloadWriter passes in views of buffers it reuses once `stages` are done with them.
         """
-        self.f.write(s)
-        if self.hash:
-            self.hash.update(s)
+        self.write_stage.put(s)
+        if self.hash_stage:
+            self.hash_stage.put(s)
         self.position += len(s)
 
+    # Named for the `md5` column, but uses whichever digest algorithm the archive uses.
     def md5(self) -> Optional[str]:
         md5: Optional[str]
-        if self.hash:
+        if self.hash and self.hash_stage:
+            self.hash_stage.drain()
             md5 = self.hash.hexdigest()
         else:
             md5 = None
@@ -286,27 +694,162 @@ class HashIO(object):
         if self.closed:
             return
 
-        self.f.close()
         self.closed = True
+        try:
+            self.write_stage.close()
+            if self.hash_stage:
+                self.hash_stage.close()
+        finally:
+            self.f.close()
 
 
-def estimate_tar_entry_size(file_size: int) -> int:
+class PayloadWriter(object):
+    """
+    Adds regular files to a tar, doing what `tarfile.TarFile.addfile` does,
+    but with far fewer Python-level calls per byte.
+
+    File data is read with `readinto` into a few reusable buffers of `block_size` bytes.
+    Views of those buffers are handed to the background stages,
+    and a buffer is only reused once every stage is done with it.
+    The tar written is byte-identical to the one `addfile` writes.
+    """
+
+    def __init__(
+        self,
+        out: HashIO,
+        block_size: int = STREAM_BLOCK_SIZE,
+        digest: str = DEFAULT_DIGEST,
+    ):
+        self.out: HashIO = out
+        self.block_size: int = block_size
+        self.digest: str = digest
+        # Computes the digest of each file's data while the next block is being read
+        self.hash_stage: BlockStage = BlockStage(update_hash, "file-md5")
+        self.stages: List[BlockStage] = [self.hash_stage] + out.stages
+        count: int = STREAM_QUEUE_DEPTH + 2
+        self.views: List[memoryview] = [
+            memoryview(bytearray(block_size)) for _ in range(count)
+        ]
+        # For each buffer, how many items each stage must have consumed
+        # before it's safe to reuse.
+        self.tickets: List[List[Tuple[BlockStage, int]]] = [[] for _ in range(count)]
+        self.next_buffer: int = 0
+
+    def acquire(self) -> Tuple[int, memoryview]:
+        i: int = self.next_buffer
+        self.next_buffer = (i + 1) % len(self.views)
+        for stage, count in self.tickets[i]:
+            stage.wait_for(count)
+        self.tickets[i] = []
+        return i, self.views[i]
+
+    def release(self, i: int):
+        # Everything put so far may refer to buffer i.
+        self.tickets[i] = [(stage, stage.put_count) for stage in self.stages]
+
+    def add(
+        self,
+        tar: tarfile.TarFile,
+        tar_info: tarfile.TarInfo,
+        file_name: str,
+        start: int = 0,
+        whole_file_hash: Optional[Any] = None,
+    ) -> str:
+        """
+        Add the header for `tar_info`, followed by the contents of `file_name`, to `tar`.
+        Return the digest of the contents.
+
+        To add one part of a split file, `start` is where the part begins in the file,
+        and `tar_info.size` is the size of the part.
+        `whole_file_hash` is also updated with the part.
+        """
+        buf: bytes = tar_info.tobuf(tar.format, tar.encoding, tar.errors)
+        self.out.write(buf)
+        tar.offset += len(buf)
+
+        hash_md5 = hashlib.new(self.digest)
+        # A file that fits in one block is hashed right away;
+        # handing it to another thread would cost more than it saves.
+        staged: bool = tar_info.size > self.block_size
+        remaining: int = tar_info.size
+        # Unbuffered, so `readinto` reads straight into our buffers.
+        with open(file_name, "rb", buffering=0) as f:
+            if start:
+                f.seek(start)
+            while remaining > 0:
+                i: int
+                view: memoryview
+                i, view = self.acquire()
+                n: int = f.readinto(view[: min(remaining, self.block_size)])
+                if not n:
+                    # Same error `addfile` raises if the file shrank
+                    raise OSError("unexpected end of data")
+                chunk: memoryview = view[:n]
+                if staged:
+                    self.hash_stage.put((hash_md5, chunk))
+                    if whole_file_hash:
+                        self.hash_stage.put((whole_file_hash, chunk))
+                else:
+                    hash_md5.update(chunk)
+                    if whole_file_hash:
+                        whole_file_hash.update(chunk)
+                self.out.write(chunk)
+                self.release(i)
+                remaining -= n
+
+        blocks: int
+        remainder: int
+        blocks, remainder = divmod(tar_info.size, tarfile.BLOCKSIZE)
+        if remainder > 0:
+            self.out.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+            blocks += 1
+        tar.offset += blocks * tarfile.BLOCKSIZE
+
+        if staged:
+            self.hash_stage.drain()
+        return hash_md5.hexdigest()
+
+    def close(self):
+        self.hash_stage.close()
+
+
+def tar_header_size(name: str, file_size: int) -> int:
+    """
+    How much space the header of a member takes in the tar archive,
+    including the pax extended header written before it
+    for a name longer than 100 characters or not in ASCII,
+    or a size of 8 GiB or more.
+    """
+    if file_size == 0:
+        # It may be an empty directory, whose name ends with '/'
+        name += "/"
+    if name.isascii() and (len(name) <= tarfile.LENGTH_NAME) and (file_size < 8**11):
+        return tarfile.BLOCKSIZE
+    tar_info: tarfile.TarInfo = tarfile.TarInfo(name)
+    tar_info.size = file_size
+    return len(tar_info.tobuf(tarfile.PAX_FORMAT, tarfile.ENCODING, "surrogateescape"))
+
+
+def estimate_tar_entry_size(file_size: int, name: str = "") -> int:
     """
     Estimate how much space a file of a given size would take in the tar archive,
     including metadata and padding.
     """
     TAR_BLOCK_SIZE = 512
-    TAR_HEADER_SIZE = 512  # per file header
     # This formula computes: ceil(file_size / TAR_BLOCK_SIZE)
     # But faster and avoiding floats.
     data_blocks = (file_size + TAR_BLOCK_SIZE - 1) // TAR_BLOCK_SIZE
-    return TAR_HEADER_SIZE + (data_blocks * TAR_BLOCK_SIZE)
+    return tar_header_size(name, file_size) + (data_blocks * TAR_BLOCK_SIZE)
 
 
 # Add file to tar archive while computing its hash
 # Return file offset (in tar archive), size and md5 hash
 def add_file_to_tar_archive(
-    tar: tarfile.TarFile, file_name: str, tar_info: tarfile.TarInfo
+    tar: tarfile.TarFile,
+    file_name: str,
+    tar_info: tarfile.TarInfo,
+    payload_writer: Optional[PayloadWriter] = None,
+    digest: str = DEFAULT_DIGEST,
 ) -> Tuple[int, int, datetime, Optional[str]]:
     offset = tar.offset
 
@@ -314,9 +857,12 @@ def add_file_to_tar_archive(
 
     # For files/hardlinks
     if tar_info.isfile() or tar_info.islnk():
-        if tar_info.size > 0:
+        if (tar_info.size > 0) and payload_writer:
+            # Non-empty files: stream with hash computation
+            md5 = payload_writer.add(tar, tar_info, file_name)
+        elif tar_info.size > 0:
             # Non-empty files: stream with hash computation
-            hash_md5 = hashlib.md5()
+            hash_md5 = hashlib.new(digest)
             with open(file_name, "rb") as f:
                 wrapper = HashingFileWrapper(f, hash_md5)
                 tar.addfile(tar_info, wrapper)
@@ -324,7 +870,7 @@ def add_file_to_tar_archive(
         else:
             # Empty files: just add to tar, compute hash of empty data
             tar.addfile(tar_info)
-            md5 = hashlib.md5(b"").hexdigest()  # MD5 of empty bytes
+            md5 = hashlib.new(digest, b"").hexdigest()  # Hash of empty bytes
     else:
         # Directories, symlinks, etc.
         # md5 will be None in these cases.
@@ -335,11 +881,389 @@ def add_file_to_tar_archive(
     return offset, size, mtime, md5
 
 
-def construct_tars(
+def plan_tars(
+    file_stats: FileStats,
+    max_size: int,
+    packing: str = "sequential",
+) -> List[List[int]]:
+    """
+    Split the files of `file_stats` into groups, one group per tar,
+    such that each tar stays under `max_size`.
+    A file larger than `max_size` gets a tar of its own.
+    Groups are lists of positions in `file_stats`.
+
+    With the "sequential" packing, groups are contiguous runs of files.
+    With the "balanced" packing, see `plan_tars_balanced`.
+    """
+    if packing == "balanced":
+        return plan_tars_balanced(file_stats, max_size)
+    elif packing != "sequential":
+        raise ValueError(f"Invalid packing={packing}")
+    groups: List[List[int]] = []
+    group: List[int] = []
+    cumulative_tar_size: int = 0
+    for i, current_file_size in enumerate(file_stats.sizes):
+        estimated_entry_size: int = estimate_tar_entry_size(
+            current_file_size, file_stats.path(i)
+        )
+        if group and (cumulative_tar_size + estimated_entry_size > max_size):
+            # Over the size limit: start a new tar.
+            groups.append(group)
+            group = []
+            cumulative_tar_size = 0
+        # If we make it this far,
+        # we know we can add the current file without going over the max size.
+        # (Either that, or the tar is currently empty,
+        # in which case we add the file even if it's over the max size.)
+        group.append(i)
+        cumulative_tar_size += estimated_entry_size
+    if group:
+        groups.append(group)
+    return groups
+
+
+class FirstFitBins(object):
+    """
+    Bins of a fixed capacity, for first-fit packing.
+
+    A segment tree over the bins' remaining capacities
+    finds the first bin an item fits in in O(log(number of bins)).
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity: int = capacity
+        self.count: int = 0
+        # Number of leaves; always a power of 2
+        self.leaves: int = 1
+        # tree[leaves + b] is the remaining capacity of bin b,
+        # tree[i] is the max of its two children.
+        self.tree: List[int] = [0, 0]
+
+    def add(self, size: int) -> int:
+        """
+        Put an item of `size` in the first bin it fits in,
+        opening a new bin if there is none. Return the bin's index.
+        """
+        b: int
+        if self.tree[1] >= size:
+            i: int = 1
+            while i < self.leaves:
+                i = 2 * i if self.tree[2 * i] >= size else 2 * i + 1
+            b = i - self.leaves
+        else:
+            b = self.open()
+        self.set_remaining(b, self.tree[self.leaves + b] - size)
+        return b
+
+    def open(self) -> int:
+        if self.count == self.leaves:
+            # Double the number of leaves, and rebuild the tree
+            old_leaves: List[int] = self.tree[self.leaves :]
+            self.leaves *= 2
+            self.tree = [0] * (2 * self.leaves)
+            self.tree[self.leaves : self.leaves + len(old_leaves)] = old_leaves
+            for i in range(self.leaves - 1, 0, -1):
+                self.tree[i] = max(self.tree[2 * i], self.tree[2 * i + 1])
+        b: int = self.count
+        self.count += 1
+        # An item larger than the capacity gets a bin of its own, with no room left.
+        self.set_remaining(b, self.capacity)
+        return b
+
+    def set_remaining(self, b: int, remaining: int):
+        i: int = self.leaves + b
+        self.tree[i] = max(remaining, 0)
+        i //= 2
+        while i:
+            self.tree[i] = max(self.tree[2 * i], self.tree[2 * i + 1])
+            i //= 2
+
+
+def plan_tars_balanced(
+    file_stats: FileStats,
+    max_size: int,
+) -> List[List[int]]:
+    """
+    Pack the files of `file_stats` into tars close to `max_size`,
+    using first-fit-decreasing.
+
+    A directory whose files fit in one tar is packed as a single item,
+    so it is never split across tars.
+    The files of a larger directory are packed individually.
+    Within a tar, files stay in the order of `file_stats`,
+    and tars are ordered by their first file.
+    """
+    # Items to pack: (size, positions in `file_stats`)
+    items: List[Tuple[int, List[int]]] = []
+    group_start: int = 0
+    group_size: int = 0
+    num_files: int = len(file_stats)
+    directory_index = file_stats.directory_index
+    entry_sizes: List[int] = [
+        estimate_tar_entry_size(size, file_stats.path(i))
+        for i, size in enumerate(file_stats.sizes)
+    ]
+    for i in range(num_files + 1):
+        if (i == num_files) or (
+            i > group_start and directory_index[i] != directory_index[group_start]
+        ):
+            # End of a directory's run of files
+            if group_size <= max_size:
+                items.append((group_size, list(range(group_start, i))))
+            else:
+                items.extend((entry_sizes[j], [j]) for j in range(group_start, i))
+            group_start = i
+            group_size = 0
+        if i < num_files:
+            group_size += entry_sizes[i]
+
+    # Largest first; ties keep path order.
+    items.sort(key=lambda item: (-item[0], item[1][0]))
+    bins: FirstFitBins = FirstFitBins(max_size)
+    bin_indices: Dict[int, List[int]] = collections.defaultdict(list)
+    for size, indices in items:
+        bin_indices[bins.add(size)].extend(indices)
+
+    groups: List[List[int]] = [sorted(indices) for indices in bin_indices.values()]
+    groups.sort(key=lambda indices: indices[0])
+    return groups
+
+
+def log_tar_plan(
+    groups: List[List[int]],
+    file_stats: FileStats,
+    tar_nums: List[int],
+    packing: str,
+    parts: Optional[List[int]] = None,
+):
+    """
+    Report which files will go in which tar, before any tar is written.
+    A group with `parts[i] > 0` is a single file split across that many tars.
+    """
+    if not groups:
+        return
+    if parts is None:
+        parts = [0] * len(groups)
+    sizes: List[int] = []
+    for group, n in zip(groups, parts):
+        size: int = sum(
+            estimate_tar_entry_size(file_stats.sizes[j], file_stats.path(j))
+            for j in group
+        )
+        # Each part of a split file has its own header
+        sizes.append(-(-(size + (n - 1) * tarfile.BLOCKSIZE) // n) if n else size)
+    num_tars: int = sum(max(n, 1) for n in parts)
+    logger.info(
+        f"Planned {num_tars} tars with {packing} packing: "
+        f"min size={min(sizes)}, mean size={sum(sizes) // len(sizes)}, max size={max(sizes)}"
+    )
+    if any(parts):
+        logger.info(
+            f"Splitting {sum(1 for n in parts if n)} files across {sum(parts)} tars"
+        )
+    for tar_num, group, size, n in zip(tar_nums, groups, sizes, parts):
+        if n:
+            logger.debug(
+                "Planned {0:0{1}x}.tar to {2:0{1}x}.tar: {3} split into {4} parts, estimated size={5}".format(
+                    tar_num, 6, tar_num + n - 1, file_stats.path(group[0]), n, size
+                )
+            )
+        else:
+            logger.debug(
+                "Planned {0:0{1}x}.tar: {2} files, estimated size={3}".format(
+                    tar_num, 6, len(group), size
+                )
+            )
+
+
+def build_tar(
+    tar_num: int,
+    files: List[str],
+    cache: str,
+    do_hash: bool,
+    follow_symlinks: bool,
+    operation: str,
+    digest: str = DEFAULT_DIGEST,
+    stream_to: Optional[str] = None,
+) -> Tuple[BuiltTar, List[str]]:
+    """
+    Build one tar in the cache, containing `files`.
+    Return the closed tar, and the files that could not be archived.
+
+    This only touches the cache (or, with `stream_to`, its own `hsi` process),
+    so it can be run in a worker process.
+    """
+    failures: List[str] = []
+    archived: List[TupleFilesRowNoId] = []
+
+    # Note: if we're not skipping the tars table, then we DO want to calculate the hash of the tars.
+    # That is, we DO want to add the tar to the tars table in the database.
+    # That means we need to calculate the hash of the tar file as well.
+    #
+    # We ALWAYS want to calculate the hashes of the individual files, regardless of skip_tars_table,
+    # because we need to add those to the files table.
+    tar_wrapper = TarWrapper(
+        tar_num=tar_num,
+        cache=cache,
+        do_hash=do_hash,
+        follow_symlinks=follow_symlinks,
+        digest=digest,
+        stream_to=stream_to,
+    )
+    for current_file in files:
+        try:
+            tar_info = tar_wrapper.tar.gettarinfo(current_file)
+            if tar_info.islnk():
+                tar_info.size = os.path.getsize(current_file)
+        except FileNotFoundError:
+            logger.error(f"Archiving {current_file}")
+            if follow_symlinks:
+                raise Exception(f"Archive {operation} failed due to broken symlink.")
+            else:
+                raise
+        tar_wrapper.process_file(current_file, tar_info, archived, failures)
+    return tar_wrapper.close(archived), failures
+
+
+def plan_parts(
+    groups: List[List[int]],
+    file_stats: FileStats,
+    itar: int,
+    max_size: int,
+    split_large_files: bool,
+) -> Tuple[List[int], List[int]]:
+    """
+    Number the tars of each group, starting after `itar`.
+    Return the first tar number of each group,
+    and the number of parts each group is split into (0 if it isn't).
+    """
+    parts: List[int] = []
+    for group in groups:
+        path: str = file_stats.path(group[0])
+        if (
+            split_large_files
+            and (len(group) == 1)
+            and (estimate_tar_entry_size(file_stats.sizes[group[0]], path) > max_size)
+        ):
+            chunk_size: int = split_chunk_size(max_size, path)
+            parts.append(-(-file_stats.sizes[group[0]] // chunk_size))
+        else:
+            parts.append(0)
+    tar_nums: List[int] = []
+    next_tar: int = itar + 1
+    for n in parts:
+        tar_nums.append(next_tar)
+        next_tar += max(n, 1)
+    return tar_nums, parts
+
+
+def split_chunk_size(max_size: int, name: str = "") -> int:
+    """
+    Return how many bytes of the split file `name` go in each part,
+    so that a part and its header stay under `max_size`.
+    """
+    header_size: int = tar_header_size(f"{name}.part0000", max_size)
+    return max(
+        tarfile.BLOCKSIZE,
+        (max_size - header_size) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE,
+    )
+
+
+def build_split_file(
+    tar_num: int,
+    file_name: str,
+    cache: str,
+    do_hash: bool,
+    follow_symlinks: bool,
+    operation: str,
+    chunk_size: int,
+    digest: str,
+    failures: List[str],
+    stream_to: Optional[str] = None,
+) -> Iterator[BuiltTar]:
+    """
+    Build consecutive tars, starting at `tar_num`,
+    each containing one part of `file_name` of at most `chunk_size` bytes.
+    Yield each tar as soon as it's closed, so it can be transferred
+    while the next part is written.
+
+    Part `n` is stored as the member `<file_name>.part<n>`.
+    The last tar carries the rows for the file and all of its parts,
+    so the file is only added to the database once every part has been transferred.
+    """
+    logger.info(f"Archiving {file_name} in parts of at most {chunk_size} bytes")
+    whole_file_hash = hashlib.new(digest)
+    chunks: List[TupleChunksRowNoFileId] = []
+    tar_info: Optional[tarfile.TarInfo] = None
+    file_size: int = 0
+    start: int = 0
+    part: int = 0
+    while (tar_info is None) or (start < file_size):
+        tar_wrapper = TarWrapper(
+            tar_num=tar_num + part,
+            cache=cache,
+            do_hash=do_hash,
+            follow_symlinks=follow_symlinks,
+            digest=digest,
+            stream_to=stream_to,
+        )
+        if tar_info is None:
+            try:
+                tar_info = tar_wrapper.tar.gettarinfo(file_name)
+                if tar_info.islnk():
+                    tar_info.size = os.path.getsize(file_name)
+            except FileNotFoundError:
+                logger.error(f"Archiving {file_name}")
+                if follow_symlinks:
+                    raise Exception(
+                        f"Archive {operation} failed due to broken symlink."
+                    )
+                else:
+                    raise
+            file_size = tar_info.size
+        part_info: tarfile.TarInfo = copy.copy(tar_info)
+        part_info.name = f"{tar_info.name}.part{part:04d}"
+        part_info.type = tarfile.REGTYPE
+        part_info.linkname = ""
+        part_info.size = min(chunk_size, file_size - start)
+        offset: int = tar_wrapper.tar.offset
+        try:
+            md5: str = tar_wrapper.payload_writer.add(
+                tar_wrapper.tar, part_info, file_name, start, whole_file_hash
+            )
+        except Exception:
+            # Same as `process_file`: record the failure and move on.
+            # The parts already transferred are not added to the database.
+            traceback.print_exc()
+            logger.error(f"Archiving {file_name}")
+            failures.append(file_name)
+            yield tar_wrapper.close([])
+            return
+        chunks.append((part, part_info.size, md5, tar_wrapper.tfname, offset))
+        start += part_info.size
+        part += 1
+        if start < file_size:
+            yield tar_wrapper.close([])
+        else:
+            built_tar: BuiltTar = tar_wrapper.close([])
+            built_tar.split_file = (
+                file_name,
+                file_size,
+                datetime.utcfromtimestamp(tar_info.mtime),
+                whole_file_hash.hexdigest(),
+                tar_wrapper.tfname,
+                offset,
+            )
+            built_tar.split_chunks = chunks
+            yield built_tar
+
+
+# C901 'construct_tars' is too complex (19)
+def construct_tars(  # noqa: C901
     cur: sqlite3.Cursor,
     con: sqlite3.Connection,
     itar: int,
-    file_stats: Dict[str, Tuple[int, datetime]],
+    file_stats: FileStats,
     cache: str,
     keep: bool,
     follow_symlinks: bool,
@@ -347,16 +1271,44 @@ def construct_tars(
     transfer_manager: TransferManager,
     skip_tars_table: bool = False,
     non_blocking: bool = False,
+    workers: int = 1,
+    packing: str = "sequential",
+    split_large_files: bool = False,
+    stream: bool = False,
+    journal: Optional[CreateJournal] = None,
+    resume: bool = False,
+    cache_budget: Optional[CacheBudget] = None,
 ) -> List[str]:
 
     failures: List[str] = []
-    files: List[str] = list(file_stats.keys())
-    nfiles: int = len(files)
 
     if config.maxsize is not None:
         max_size: int = config.maxsize
     else:
         raise TypeError(f"Invalid config.maxsize={config.maxsize}")
+    if config.digest is not None:
+        digest: str = config.digest
+    else:
+        raise TypeError(f"Invalid config.digest={config.digest}")
+    # With `stream`, tars are written straight to HPSS instead of the cache.
+    stream_to: Optional[str] = None
+    if stream:
+        if config.hpss is None:
+            raise TypeError(f"Invalid config.hpss={config.hpss}")
+        check_stream_supported(config.hpss)
+        stream_to = config.hpss
+    # Tars only pile up in the cache while non-blocking Globus transfers finish,
+    # and are only deleted from it afterwards without `keep`.
+    if cache_budget and not (
+        non_blocking
+        and (not keep)
+        and (stream_to is None)
+        and (urlparse(config.hpss or "").scheme == "globus")
+    ):
+        logger.warning(
+            "--cache-budget only applies to --non-blocking Globus transfers without --keep. Ignoring it."
+        )
+        cache_budget = None
 
     operation: str
     if itar == -1:
@@ -364,80 +1316,127 @@ def construct_tars(
     else:
         operation = "update"
 
-    i_file: int = 0
-    while i_file < nfiles:
-        # Each iteration of this loop constructs one tar
-
+    # With `split_large_files`, a file that would overflow a tar on its own
+    # is split into parts of `split_chunk_size` bytes, one part per tar.
+    groups: List[List[str]]
+    tar_nums: List[int]
+    parts: List[int]
+    # Indices of the groups to build
+    todo: List[int]
+    if resume and journal:
+        # Pick up the plan of the interrupted run,
+        # and only build the groups it didn't finish.
+        groups, tar_nums, parts = journal.groups, journal.tar_nums, journal.parts
+        todo = journal.remaining(cur, con, cache, digest, keep)
+        logger.info(
+            f"Resuming {operation}: {len(groups) - len(todo)} of {len(groups)} planned groups of files are already archived"
+        )
+    else:
+        # Decide up front which files go in which tar,
+        # so that tar numbering doesn't depend on the order tars finish in.
         # `create` passes in itar=-1, so the first tar will be 000000.tar
         # `update` passes in itar=max existing tar number, so the first tar will be max+1
-        itar += 1
-        cumulative_tar_size: int = 0
-        archived: List[TupleFilesRowNoId] = []
-
-        # Open a new tar
-        # Note: if we're not skipping the tars table, then we DO want to calculate the hash of the tars.
-        # That is, we DO want to add the tar to the tars table in the database.
-        # That means we need to calculate the hash of the tar file as well.
-        #
-        # We ALWAYS want to calculate the hashes of the individual files, regardless of skip_tars_table,
-        # because we need to add those to the files table.
-        tar_wrapper = TarWrapper(
-            tar_num=itar,
-            cache=cache,
-            do_hash=not skip_tars_table,
-            follow_symlinks=follow_symlinks,
+        planned: List[List[int]] = plan_tars(file_stats, max_size, packing)
+        tar_nums, parts = plan_parts(
+            planned, file_stats, itar, max_size, split_large_files
         )
+        log_tar_plan(planned, file_stats, tar_nums, packing, parts)
+        groups = [[file_stats.path(j) for j in group] for group in planned]
+        todo = list(range(len(groups)))
+        if journal:
+            journal.start(groups, tar_nums, parts)
+    workers = max(1, min(workers, len(todo)))
+    if workers > 1:
+        logger.info(f"Building {len(todo)} tars with {workers} workers")
 
-        # Add files to the tar until we reach the max size
-        while i_file < nfiles:
-            current_file: str = files[i_file]
-            current_file_size: int
-            current_file_size, _ = file_stats[current_file]
-            estimated_entry_size: int = estimate_tar_entry_size(current_file_size)
-            if (cumulative_tar_size != 0) and (
-                cumulative_tar_size + estimated_entry_size > max_size
-            ):
-                # Over the size limit: time to close and transfer this tar archive.
-                # Done adding files to this particular tar.
-                # Break out of the inner while-loop
-                break
-            # If we make it this far,
-            # we know we can add the current file without going over the max size.
-            # (Either that, or the tar is currently empty,
-            # in which case we add the file even if it's over the max size.)
-            try:
-                tar_info = tar_wrapper.tar.gettarinfo(current_file)
-                if tar_info.islnk():
-                    tar_info.size = os.path.getsize(current_file)
-            except FileNotFoundError:
-                logger.error(f"Archiving {current_file}")
-                if follow_symlinks:
-                    raise Exception(
-                        f"Archive {operation} failed due to broken symlink."
-                    )
-                else:
-                    raise
-            new_cumulative_tar_size = tar_wrapper.process_file(
-                current_file, tar_info, archived, failures
+    # The pool has to be forked before the transfer thread is started.
+    pool: Optional[multiprocessing.pool.Pool] = None
+    if workers > 1:
+        pool = multiprocessing.Pool(processes=workers)
+
+    # Tars are transferred on a background thread while the next ones are built.
+    pipeline: TransferPipeline = TransferPipeline(
+        cache,
+        keep,
+        non_blocking,
+        transfer_manager,
+        skip_tars_table,
+        cur,
+        con,
+        dev_options,
+        journal,
+    )
+    try:
+        # Tars being built by the pool, oldest first.
+        # At most `workers` are outstanding at once,
+        # so that finished tars can't pile up in the cache.
+        building: Deque[multiprocessing.pool.AsyncResult] = collections.deque()
+        built_tar: BuiltTar
+        tar_failures: List[str]
+        for i in todo:
+            tar_num, group, n = tar_nums[i], groups[i], parts[i]
+            if n:
+                # Parts are written here, one after the other,
+                # since they all update the digest of the whole file.
+                # First hand off the tars before them, to keep transfers in order.
+                while building:
+                    built_tar, tar_failures = building.popleft().get()
+                    failures.extend(tar_failures)
+                    pipeline.submit(built_tar)
+                for built_tar in build_split_file(
+                    tar_num,
+                    group[0],
+                    cache,
+                    not skip_tars_table,
+                    follow_symlinks,
+                    operation,
+                    split_chunk_size(max_size, group[0]),
+                    digest,
+                    failures,
+                    stream_to,
+                ):
+                    pipeline.submit(built_tar)
+                    if cache_budget:
+                        pipeline.wait_for_cache(cache_budget, 1, max_size)
+                continue
+            build_args = (
+                tar_num,
+                group,
+                cache,
+                not skip_tars_table,
+                follow_symlinks,
+                operation,
+                digest,
+                stream_to,
             )
-            if new_cumulative_tar_size != 0:
-                # Update the cumulative tar size with the new tar size returned by process_file.
-                cumulative_tar_size = new_cumulative_tar_size
-            # Else: process_file failed, so we should keep the original cumulative_tar_size
-            i_file += 1
-
-        # Close the tar, submit it to the batch transfer system, and update the database with the archived files (and optionally the tar as well, depending on skip_tars_table)
-        tar_wrapper.process_tar(
-            cache,
-            keep,
-            non_blocking,
-            transfer_manager,
-            skip_tars_table,
-            cur,
-            con,
-            dev_options,
-            archived,
-        )
+            if cache_budget:
+                # Don't build more tars than the cache has room for.
+                pipeline.wait_for_cache(cache_budget, len(building) + 1, max_size)
+            if pool is None:
+                built_tar, tar_failures = build_tar(*build_args)
+                failures.extend(tar_failures)
+                # Close the tar and hand it off to be transferred.
+                # Once it's been transferred, the database will be updated with the archived files
+                # (and optionally the tar as well, depending on skip_tars_table).
+                # Meanwhile, we can start building the next tar.
+                pipeline.submit(built_tar)
+            else:
+                if len(building) == workers:
+                    built_tar, tar_failures = building.popleft().get()
+                    failures.extend(tar_failures)
+                    pipeline.submit(built_tar)
+                building.append(pool.apply_async(build_tar, build_args))
+        # Hand off the remaining tars in order.
+        while building:
+            built_tar, tar_failures = building.popleft().get()
+            failures.extend(tar_failures)
+            pipeline.submit(built_tar)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        # Wait for the last tar to be transferred and added to the database.
+        pipeline.close()
 
     return failures
 
@@ -0,0 +1,216 @@
+from __future__ import absolute_import, print_function
+
+import hashlib
+import json
+import os
+import sqlite3
+from typing import Dict, List, Optional, Tuple
+
+from .settings import BLOCK_SIZE, logger
+from .utils import chunks_table_exists, tars_table_exists
+
+JOURNAL_NAME: str = "journal.jsonl"
+
+
+def tar_names(tar_num: int, parts: int) -> List[str]:
+    """
+    Return the names of the tars a planned group is written to:
+    one tar, or one per part of a split file.
+    """
+    return [
+        "{0:0{1}x}.tar".format(n, 6) for n in range(tar_num, tar_num + max(parts, 1))
+    ]
+
+
+def hash_file(file_path: str, digest: str) -> str:
+    hash_md5 = hashlib.new(digest)
+    with open(file_path, "rb") as f:
+        while True:
+            s: bytes = f.read(BLOCK_SIZE)
+            hash_md5.update(s)
+            if len(s) < BLOCK_SIZE:
+                break
+    return hash_md5.hexdigest()
+
+
+class CreateJournal(object):
+    """
+    Checkpoints for `zstash create` and `zstash update`, kept in the cache.
+
+    The plan comes first: a line with the number of planned groups of files,
+    then a line per group, with its files and the tar it goes in.
+    Then there's a line for each tar, once it's been transferred
+    and added to the database.
+    Each line is a JSON object, flushed to disk before moving on,
+    so a torn last line from a crash is simply ignored.
+    The journal is removed once the run completes.
+    """
+
+    def __init__(self, cache: str):
+        self.path: str = os.path.join(cache, JOURNAL_NAME)
+        self.groups: List[List[str]] = []
+        self.tar_nums: List[int] = []
+        self.parts: List[int] = []
+        # Completed tars: name -> (size, md5)
+        self.done: Dict[str, Tuple[int, Optional[str]]] = {}
+        # The last tar recorded as completed
+        self.last_done: Optional[str] = None
+
+    @classmethod
+    def load(cls, cache: str) -> "CreateJournal":
+        journal: CreateJournal = cls(cache)
+        if not os.path.exists(journal.path):
+            error_str: str = f"Nothing to resume: {journal.path} does not exist"
+            logger.error(error_str)
+            raise FileNotFoundError(error_str)
+        planned: Optional[int] = None
+        # Read a line at a time: the plan can list millions of files
+        torn: Optional[ValueError] = None
+        with open(journal.path, "r") as f:
+            for line in f:
+                # Only the last line can be incomplete
+                if torn is not None:
+                    raise torn
+                try:
+                    entry = json.loads(line)
+                except ValueError as e:
+                    torn = e
+                    continue
+                if "planned" in entry:
+                    planned = entry["planned"]
+                elif "files" in entry:
+                    journal.groups.append(entry["files"])
+                    journal.tar_nums.append(entry["tar_num"])
+                    journal.parts.append(entry["parts"])
+                else:
+                    journal.done[entry["tar"]] = (entry["size"], entry["md5"])
+                    journal.last_done = entry["tar"]
+        if torn is not None:
+            logger.warning(f"Ignoring incomplete last line of {journal.path}")
+        if (planned is None) or (len(journal.groups) != planned):
+            error_str = f"{journal.path} stops before the end of its plan: nothing was archived yet, run it again without --resume"
+            logger.error(error_str)
+            raise RuntimeError(error_str)
+        return journal
+
+    def start(self, groups: List[List[str]], tar_nums: List[int], parts: List[int]):
+        """
+        Start a new journal with the plan, a line per group of files.
+        """
+        self.groups = groups
+        self.tar_nums = tar_nums
+        self.parts = parts
+        self.done = {}
+        self.last_done = None
+        with open(self.path, "w") as f:
+            f.write(json.dumps({"planned": len(groups)}) + "\n")
+            for group, tar_num, n_parts in zip(groups, tar_nums, parts):
+                f.write(
+                    json.dumps({"files": group, "tar_num": tar_num, "parts": n_parts})
+                    + "\n"
+                )
+            f.flush()
+            os.fsync(f.fileno())
+
+    def record(self, tfname: str, size: int, md5: Optional[str]):
+        """
+        Record that `tfname` has been transferred and added to the database.
+        """
+        self.done[tfname] = (size, md5)
+        self.last_done = tfname
+        with open(self.path, "a") as f:
+            self.write_line(f, {"tar": tfname, "size": size, "md5": md5})
+
+    def write_line(self, f, entry: dict):
+        f.write(json.dumps(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def is_archived(
+        self, tfname: str, cur: sqlite3.Cursor, cache: str, digest: str, keep: bool
+    ) -> bool:
+        """
+        Check a tar the journal says is done against the tars table,
+        and against the size of the tar itself if it's still in the cache.
+        Without `keep`, a tar is only deleted from the cache once it's transferred,
+        so one that's still there may never have made it.
+        Only the last tar recorded, the one closest to where the run stopped,
+        is hashed again: the others are trusted to have their recorded digest.
+        """
+        if tfname not in self.done:
+            return False
+        size: int
+        md5: Optional[str]
+        size, md5 = self.done[tfname]
+        if tars_table_exists(cur):
+            cur.execute(
+                "select size, md5 from tars where name = ? order by id desc",
+                (tfname,),
+            )
+            row: Optional[Tuple[int, Optional[str]]] = cur.fetchone()
+            if row != (size, md5):
+                logger.warning(f"{tfname} does not match the tars table: {row}")
+                return False
+        local_tar: str = os.path.join(cache, tfname)
+        if os.path.exists(local_tar):
+            if not keep:
+                logger.warning(
+                    f"{tfname} is still in the cache, so it may not be transferred"
+                )
+                return False
+            if os.path.getsize(local_tar) != size:
+                logger.warning(f"{tfname} in the cache has the wrong size")
+                return False
+            if (
+                (tfname == self.last_done)
+                and (md5 is not None)
+                and (hash_file(local_tar, digest) != md5)
+            ):
+                logger.warning(f"{tfname} in the cache has the wrong {digest}")
+                return False
+        return True
+
+    def remaining(
+        self,
+        cur: sqlite3.Cursor,
+        con: sqlite3.Connection,
+        cache: str,
+        digest: str,
+        keep: bool,
+    ) -> List[int]:
+        """
+        Return the indices of the planned groups that still have to be archived.
+        Remove whatever a previous run left in the database and the cache for them.
+        """
+        remaining: List[int] = []
+        for i, (tar_num, parts) in enumerate(zip(self.tar_nums, self.parts)):
+            names: List[str] = tar_names(tar_num, parts)
+            if all(self.is_archived(name, cur, cache, digest, keep) for name in names):
+                continue
+            remaining.append(i)
+            for name in names:
+                discard_tar(name, cur, cache)
+        con.commit()
+        return remaining
+
+
+def discard_tar(tfname: str, cur: sqlite3.Cursor, cache: str):
+    """
+    Remove a tar that will be built again from the database and the cache.
+    """
+    if chunks_table_exists(cur):
+        cur.execute(
+            "delete from chunks where tar = ? or file_id in (select id from files where tar = ?)",
+            (tfname, tfname),
+        )
+    cur.execute("delete from files where tar = ?", (tfname,))
+    if tars_table_exists(cur):
+        cur.execute("delete from tars where name = ?", (tfname,))
+    local_tar: str = os.path.join(cache, tfname)
+    if os.path.exists(local_tar):
+        # With --hpss=none, tars are read-only; the cache itself is not.
+        os.remove(local_tar)
@@ -5,7 +5,7 @@ import logging
 import os
 import sqlite3
 import sys
-from typing import List, Tuple, Union
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
 
 from .hpss import hpss_get
 from .settings import (
@@ -18,7 +18,12 @@ from .settings import (
     get_db_filename,
     logger,
 )
-from .utils import tars_table_exists, update_config
+from .utils import (
+    create_indexes,
+    create_matches_table,
+    tars_table_exists,
+    update_config,
+)
 
 
 def ls():
@@ -31,7 +36,7 @@ def ls():
     cache: str
     args, cache = setup_ls()
 
-    matches: List[FilesRow] = ls_database(args, cache)
+    matches: Iterator[FilesRow] = ls_database(args, cache)
 
     print_matches(args, matches)
 
@@ -89,7 +94,7 @@ def setup_ls() -> Tuple[argparse.Namespace, str]:
     return args, cache
 
 
-def ls_database(args: argparse.Namespace, cache: str) -> List[FilesRow]:
+def ls_database(args: argparse.Namespace, cache: str) -> Iterator[FilesRow]:
     # Open database
     logger.debug("Opening index database")
     if not os.path.exists(get_db_filename(cache)):
@@ -118,6 +123,7 @@ def ls_database(args: argparse.Namespace, cache: str) -> List[FilesRow]:
     cur: sqlite3.Cursor = con.cursor()
 
     update_config(cur)
+    create_indexes(cur, con)
 
     if config.maxsize is not None:
         maxsize: int = config.maxsize
@@ -133,36 +139,43 @@ def ls_database(args: argparse.Namespace, cache: str) -> List[FilesRow]:
     logger.debug("Running zstash ls")
     logger.debug("HPSS path  : %s" % (config.hpss))
 
-    # Find matching files
-    matches_: List[TupleFilesRow] = []
-    for args_file in args.files:
-        cur.execute(
-            "select * from files where name GLOB ? or tar GLOB ?",
-            (args_file, args_file),
-        )
-        matches_ = matches_ + cur.fetchall()
-
-    if matches_ == []:
+    # Find matching files, each version of a file once,
+    # sorted by tape and order within tapes (offset).
+    create_matches_table(cur, args.files)
+    cur.execute("""
+select files.* from matches join files using (id)
+order by files.tar, files.offset, files.name
+    """)
+    first: Optional[TupleFilesRow] = cur.fetchone()
+    if first is None:
+        con.close()
         raise FileNotFoundError("There was nothing to ls.")
 
-    # Remove duplicates
-    matches_ = list(set(matches_))
-    matches: List[FilesRow] = list(map(FilesRow, matches_))
-
-    # Sort by tape and order within tapes (offset)
-    matches = sorted(matches, key=lambda t: (t.tar, t.offset))
-
     if args.long:
         # Get the names of the columns
-        cur.execute("PRAGMA table_info(files);")
-        cols = [str(col_info[1]) for col_info in cur.fetchall()]
+        cols = [str(col_info[0]) for col_info in cur.description]
+        # mtime_ns is printed as a timestamp, like the mtime column it replaced.
+        cols = ["mtime" if col == "mtime_ns" else col for col in cols]
         print("\t".join(cols))
 
-    # Close database
-    con.commit()
-    con.close()
+    # Stream the rows, rather than loading them all
+    return stream_files_rows(con, cur, first)
 
-    return matches
+
+def stream_files_rows(
+    con: sqlite3.Connection, cur: sqlite3.Cursor, first: TupleFilesRow
+) -> Iterator[FilesRow]:
+    """
+    Yield `first`, then the rest of the rows of the query run on `cur`.
+    Close the database once they're all read, or the caller stops reading them.
+    """
+    try:
+        yield FilesRow(first)
+        for match in cur:
+            yield FilesRow(match)
+    finally:
+        # Close database
+        con.close()
 
 
 def ls_tars_database(args: argparse.Namespace, cache: str) -> List[TarsRow]:
@@ -202,7 +215,7 @@ def ls_tars_database(args: argparse.Namespace, cache: str) -> List[TarsRow]:
 
 
 def print_matches(
-    args: argparse.Namespace, matches: Union[List[FilesRow], List[TarsRow]]
+    args: argparse.Namespace, matches: Union[Iterable[FilesRow], Iterable[TarsRow]]
 ):
     # Print the results
     match: Union[FilesRow, TarsRow]
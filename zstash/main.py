@@ -14,6 +14,7 @@ from .chgrp import chgrp
 from .create import create
 from .extract import extract
 from .ls import ls
+from .migrate import migrate_index
 from .update import update
 
 
@@ -49,6 +50,7 @@ Available zstash commands:
   chgrp      change the group of an archive
   check      check the integrity of the files in the archive
   ls         list the files in an archive
+  migrate-index  convert the index database to the latest layout
 
 For help with a specific command
   zstash command --help
@@ -78,6 +80,8 @@ For help with a specific command
         check()
     elif args.command == "ls":
         ls()
+    elif args.command == "migrate-index":
+        migrate_index()
     else:
         print("Unrecognized command")
         parser.print_help()
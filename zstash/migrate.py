@@ -0,0 +1,167 @@
+from __future__ import absolute_import, print_function
+
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+from datetime import datetime
+from typing import Optional, Tuple
+
+from .globus import globus_activate, globus_finalize
+from .hpss import hpss_get, hpss_put
+from .settings import (
+    DEFAULT_CACHE,
+    SCHEMA_VERSION,
+    config,
+    get_db_filename,
+    logger,
+    mtime_to_ns,
+)
+from .transfer_tracking import TransferManager
+from .utils import create_indexes, update_config
+
+
+def migrate_index():
+    """
+    Convert the index database of an archive to the latest layout.
+    """
+
+    args: argparse.Namespace
+    cache: str
+    args, cache = setup_migrate_index()
+
+    transfer_manager: TransferManager = TransferManager()
+    if args.hpss is not None:
+        transfer_manager.globus_config = globus_activate(args.hpss)
+    migrated: bool = migrate_database(args, cache, transfer_manager)
+
+    # Replace the database on HPSS too. Always keep the local copy.
+    if migrated and (args.hpss is not None):
+        hpss_put(
+            args.hpss,
+            get_db_filename(cache),
+            cache,
+            transfer_manager,
+            keep=True,
+            is_index=True,
+        )
+        globus_finalize(transfer_manager, True)
+
+
+def setup_migrate_index() -> Tuple[argparse.Namespace, str]:
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(
+        usage="zstash migrate-index [<args>]",
+        description="Convert the index database of an existing archive to the latest layout, which is faster to load. Archives in either layout can be used by every command, so this is optional.",
+    )
+    optional: argparse._ArgumentGroup = parser.add_argument_group(
+        "optional named arguments"
+    )
+    optional.add_argument(
+        "--hpss",
+        type=str,
+        help='path to storage on HPSS. The database is retrieved from it if the cache has no copy, and the converted database replaces the one stored on it. Set to "none" for local archiving.',
+    )
+    optional.add_argument(
+        "--cache",
+        type=str,
+        help='the path to the zstash archive on the local file system. The default name is "zstash".',
+    )
+    optional.add_argument(
+        "-v", "--verbose", action="store_true", help="increase output verbosity"
+    )
+
+    args: argparse.Namespace = parser.parse_args(sys.argv[2:])
+    if args.hpss and args.hpss.lower() == "none":
+        args.hpss = "none"
+    cache: str
+    if args.cache:
+        cache = args.cache
+    else:
+        cache = DEFAULT_CACHE
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+
+    return args, cache
+
+
+def migrate_database(
+    args: argparse.Namespace, cache: str, transfer_manager: TransferManager
+) -> bool:
+    """
+    Convert the database in the cache, retrieving it from HPSS if needed.
+    Return whether it was converted.
+    """
+    if not os.path.exists(get_db_filename(cache)):
+        if args.hpss is not None:
+            config.hpss = args.hpss
+            hpss_get(args.hpss, get_db_filename(cache), cache, transfer_manager)
+        else:
+            error_str: str = (
+                "--hpss argument is required when local copy of database is unavailable"
+            )
+            logger.error(error_str)
+            raise ValueError(error_str)
+
+    con: sqlite3.Connection = sqlite3.connect(get_db_filename(cache))
+    cur: sqlite3.Cursor = con.cursor()
+    update_config(cur)
+    schema_version: int = int(config.schema_version or 1)
+    if schema_version >= SCHEMA_VERSION:
+        logger.info(
+            f"{get_db_filename(cache)} already has schema version {schema_version}"
+        )
+        con.close()
+        return False
+
+    logger.info(
+        f"Migrating {get_db_filename(cache)} from schema version {schema_version} to {SCHEMA_VERSION}"
+    )
+    migrate_files_table(con)
+    con.close()
+    config.schema_version = SCHEMA_VERSION
+    return True
+
+
+def timestamp_to_ns(timestamp: Optional[str]) -> Optional[int]:
+    # Timestamps are stored as text by the sqlite3 module's datetime adapter.
+    if timestamp is None:
+        return None
+    return mtime_to_ns(datetime.fromisoformat(timestamp))
+
+
+def migrate_files_table(con: sqlite3.Connection):
+    """
+    Replace files.mtime by files.mtime_ns, keeping the ids,
+    and record the new schema version, all in one transaction.
+    """
+    con.create_function("timestamp_to_ns", 1, timestamp_to_ns, deterministic=True)
+    cur: sqlite3.Cursor = con.cursor()
+    con.commit()
+    cur.execute("begin")
+    cur.execute("""
+create table files_migrated (
+  id integer primary key,
+  name text,
+  size integer,
+  mtime_ns integer,
+  md5 text,
+  tar text,
+  offset integer
+);
+    """)
+    cur.execute("""
+insert into files_migrated
+select id, name, size, timestamp_to_ns(mtime), md5, tar, offset from files
+order by id
+    """)
+    cur.execute("drop table files")
+    cur.execute("alter table files_migrated rename to files")
+    cur.execute(
+        "insert or replace into config values (?,?)",
+        ("schema_version", SCHEMA_VERSION),
+    )
+    con.commit()
+    # The indexes went with the old table
+    create_indexes(cur, con)
+    cur.execute("vacuum")
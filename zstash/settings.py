@@ -3,14 +3,34 @@ from __future__ import absolute_import, print_function
 import datetime
 import logging
 import os.path
-from typing import Optional, Tuple
+from typing import Optional, Tuple, Union
+
+# Digest algorithms that can be used to checksum files and tars.
+# These are all guaranteed to be in hashlib.
+DIGESTS: Tuple[str, ...] = ("md5", "sha256", "blake2b")
+# Archives created before the digest was recorded in the database use md5.
+DEFAULT_DIGEST: str = "md5"
+
+# Policies for deciding which files go in which tar.
+# sequential: fill tars in path order.
+# balanced: first-fit-decreasing, keeping small directories together.
+PACKINGS: Tuple[str, ...] = ("sequential", "balanced")
+
+# Layouts of the index database, recorded as `schema_version` in its config table.
+# 1: files.mtime is a timestamp, stored as text.
+# 2: files.mtime_ns is an integer, in nanoseconds since the epoch (UTC).
+SCHEMA_VERSION: int = 2
 
 
 # Class to hold configuration
+# A setting missing from an older database keeps the default set here.
 class Config(object):
     path: Optional[str] = None
     hpss: Optional[str] = None
     maxsize: Optional[int] = None
+    digest: Optional[str] = DEFAULT_DIGEST
+    # Databases without a schema_version use the first layout.
+    schema_version: Optional[int] = 1
 
 
 def get_db_filename(cache: str) -> str:
@@ -30,16 +50,45 @@ TIME_TOL: float = 1.0
 # Initialize config
 config: Config = Config()
 
+
+def has_mtime_ns() -> bool:
+    """
+    Whether the files table of the open database has the `mtime_ns` column.
+    """
+    return int(config.schema_version or 1) >= 2
+
+
+EPOCH: datetime.datetime = datetime.datetime(1970, 1, 1)
+
+
+def mtime_to_ns(mtime: datetime.datetime) -> int:
+    # Mtimes in the index are exact to the microsecond,
+    # so they can be converted back and forth without any rounding.
+    return (mtime - EPOCH) // datetime.timedelta(microseconds=1) * 1000
+
+
+def mtime_from_index(mtime: Union[datetime.datetime, int]) -> datetime.datetime:
+    if isinstance(mtime, datetime.datetime):
+        return mtime
+    return EPOCH + datetime.timedelta(microseconds=mtime // 1000)
+
+
 # Initialize logger
 logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
 logger: logging.Logger = logging.getLogger(__name__)
 
 # Type aliases
-TupleFilesRow = Tuple[int, str, int, datetime.datetime, Optional[str], str, int]
+# The mtime is a datetime, or nanoseconds if the database has schema_version 2.
+TupleFilesRow = Tuple[
+    int, str, int, Union[datetime.datetime, int], Optional[str], str, int
+]
 TupleTarsRow = Tuple[int, str, int, str]
 # No corresponding class needed for these tuples.
 TupleFilesRowNoId = Tuple[str, int, datetime.datetime, Optional[str], str, int]
 TupleTarsRowNoId = Tuple[str, int, Optional[str]]
+TupleChunksRow = Tuple[int, int, int, int, Optional[str], str, int]
+# A chunk of a file, before the file has an id: (part, size, md5, tar, offset)
+TupleChunksRowNoFileId = Tuple[int, int, Optional[str], str, int]
 
 
 # Corresponding classes to make accessing variables easier
@@ -48,11 +97,16 @@ class FilesRow(object):
         self.identifier: int = t[0]
         self.name: str = t[1]
         self.size: int = t[2]
-        self.mtime: datetime.datetime = t[3]
+        self.stored_mtime: Union[datetime.datetime, int] = t[3]
         self.md5: Optional[str] = t[4]
         self.tar: str = t[5]
         self.offset: int = t[6]
 
+    @property
+    def mtime(self) -> datetime.datetime:
+        # Only converted when needed: most rows that are loaded never use it.
+        return mtime_from_index(self.stored_mtime)
+
     def to_tuple(self) -> TupleFilesRow:
         return (
             self.identifier,
@@ -74,3 +128,26 @@ class TarsRow(object):
 
     def to_tuple(self) -> TupleTarsRow:
         return (self.identifier, self.name, self.size, self.md5)
+
+
+# One part of a file that was split across several tars
+class ChunksRow(object):
+    def __init__(self, t: TupleChunksRow):
+        self.identifier: int = t[0]
+        self.file_id: int = t[1]
+        self.part: int = t[2]
+        self.size: int = t[3]
+        self.md5: Optional[str] = t[4]
+        self.tar: str = t[5]
+        self.offset: int = t[6]
+
+    def to_tuple(self) -> TupleChunksRow:
+        return (
+            self.identifier,
+            self.file_id,
+            self.part,
+            self.size,
+            self.md5,
+            self.tar,
+            self.offset,
+        )
@@ -1,4 +1,5 @@
 import os
+import re
 from enum import Enum, auto
 from typing import List, Optional
 
@@ -105,3 +106,58 @@ class TransferManager:
                 batch.delete_files()
                 logger.debug("Deletion completed")
                 batch.file_paths = []  # Mark as processed
+
+    def staged_files(self) -> List[str]:
+        """Files in the cache that haven't been confirmed transferred yet"""
+        return [path for batch in self.batches for path in batch.file_paths]
+
+    def has_pending_transfers(self) -> bool:
+        """True if some staged files may still be transferred, and so deleted"""
+        for batch in self.batches:
+            if not (batch.file_paths and batch.is_globus):
+                continue
+            if batch.task_status in (
+                None,
+                TaskStatus.SUBMITTED,
+                TaskStatus.ACTIVE,
+                TaskStatus.UNKNOWN,
+            ):
+                return True
+        return False
+
+
+class CacheBudget:
+    """How much the cache may hold in tars waiting to be transferred"""
+
+    UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+    def __init__(self, max_bytes: Optional[int] = None, max_tars: Optional[int] = None):
+        self.max_bytes: Optional[int] = max_bytes
+        self.max_tars: Optional[int] = max_tars
+
+    def __str__(self) -> str:
+        if self.max_tars is not None:
+            return f"{self.max_tars} tars"
+        return f"{self.max_bytes} bytes"
+
+    def allows(self, num_bytes: int, num_tars: int) -> bool:
+        if (self.max_bytes is not None) and (num_bytes > self.max_bytes):
+            return False
+        if (self.max_tars is not None) and (num_tars > self.max_tars):
+            return False
+        return True
+
+
+def parse_cache_budget(value: str) -> CacheBudget:
+    """
+    Parse `--cache-budget`: a number of bytes, with an optional K, M, G or T suffix
+    (powers of 1024, like --maxsize), or a number of tars, like "8tars".
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*", value, re.IGNORECASE)
+    if match:
+        unit: int = CacheBudget.UNITS[match.group(2).upper()]
+        return CacheBudget(max_bytes=int(float(match.group(1)) * unit))
+    match = re.fullmatch(r"\s*(\d+)\s*tars?\s*", value, re.IGNORECASE)
+    if match:
+        return CacheBudget(max_tars=int(match.group(1)))
+    raise ValueError(f"Invalid cache budget: {value}")
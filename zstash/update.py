@@ -6,14 +6,33 @@ import os.path
 import sqlite3
 import sys
 from datetime import datetime
-from typing import Dict, List, Optional, Tuple
+from typing import Any, List, Optional, Tuple
 
 from .globus import globus_activate, globus_finalize
-from .hpss import hpss_get, hpss_put
+from .hpss import check_stream_supported, hpss_get, hpss_put
 from .hpss_utils import DevOptions, construct_tars
-from .settings import DEFAULT_CACHE, TIME_TOL, config, get_db_filename, logger
-from .transfer_tracking import TransferManager
-from .utils import get_files_to_archive_with_stats, update_config
+from .journal import CreateJournal
+from .settings import (
+    DEFAULT_CACHE,
+    DIGESTS,
+    PACKINGS,
+    TIME_TOL,
+    config,
+    get_db_filename,
+    has_mtime_ns,
+    logger,
+    mtime_from_index,
+)
+from .transfer_tracking import TransferManager, parse_cache_budget
+from .utils import (
+    FileStats,
+    chunks_table_exists,
+    create_indexes,
+    get_files_from_manifest,
+    get_files_to_archive_with_stats,
+    tars_table_exists,
+    update_config,
+)
 
 
 def update():
@@ -45,7 +64,13 @@ def update():
         is_index=True,
     )
 
-    globus_finalize(transfer_manager, args.keep)
+    if globus_finalize(transfer_manager, args.keep):
+        # Every tar is archived: nothing left to resume.
+        CreateJournal(cache).remove()
+    else:
+        logger.error(
+            "Some Globus transfers did not succeed. Their tars are left out of the journal, so `zstash update --resume` builds and transfers them again."
+        )
 
     # List failures
     if len(failures) > 0:
@@ -115,6 +140,66 @@ def setup_update() -> Tuple[argparse.Namespace, str]:
         action="store_true",
         help="FOR ADVANCED USERS ONLY: If a duplicate tar is encountered, overwrite the existing database record with the new one (i.e., it will assume the latest tar is the correct one). If this flag is not set, zstash will permit multiple entries for the same tar in its database.",
     )
+    optional.add_argument(
+        "--digest",
+        type=str,
+        choices=DIGESTS,
+        help="checksum algorithm the archive was created with. Defaults to the archive's; it is an error to give a different one.",
+    )
+    optional.add_argument(
+        "--packing",
+        type=str,
+        choices=PACKINGS,
+        default="sequential",
+        help="how files are assigned to tars. sequential (default): fill tars in path order. balanced: first-fit-decreasing, keeping small directories together, for tars closer to --maxsize.",
+    )
+    optional.add_argument(
+        "--split-large-files",
+        action="store_true",
+        help="split files larger than --maxsize into parts stored in consecutive tars, instead of giving each its own oversized tar. Archives with split files need this version of zstash or later to extract.",
+    )
+    optional.add_argument(
+        "--stream",
+        action="store_true",
+        help="write tars straight to HPSS through `hsi put -`, instead of staging them in the cache. Requires an hsi HPSS path; --keep and --non-blocking have no effect on tars.",
+    )
+    optional.add_argument(
+        "--cache-budget",
+        type=parse_cache_budget,
+        help='with --non-blocking, pause building tars while the tars waiting in the cache to be transferred would exceed this. Either a size (e.g. "500G"; K, M, G and T are powers of 1024) or a number of tars (e.g. "8tars"). Has no effect with --keep.',
+    )
+    optional.add_argument(
+        "--resume",
+        action="store_true",
+        help="resume an interrupted update, from the journal it left in the cache. Tars it already archived are checked against the database and skipped.",
+    )
+    optional.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="num of multiprocess workers building tars in parallel",
+    )
+    optional.add_argument(
+        "--scan-workers",
+        type=int,
+        default=1,
+        help="num of threads listing directories in parallel while looking for files to archive. Helps on parallel filesystems such as Lustre, where every metadata call is a round trip.",
+    )
+    optional.add_argument(
+        "--scan-cache",
+        action="store_true",
+        help="keep what each directory contained in the cache, and reuse it for directories whose mtime hasn't changed since the last scan, without stat'ing their files. Files modified in place don't change their directory's mtime, so they are only found by --full-scan.",
+    )
+    optional.add_argument(
+        "--files-from",
+        type=str,
+        help="only consider the files listed in this file (- for stdin), instead of walking the whole directory. One path per line, or NUL-separated, relative to the directory being archived. A regular file may be followed by its size and mtime (in seconds since the epoch), tab-separated, which are archived instead of the ones it's stat'ed with, e.g. from `find . -type f -printf '%%P\\t%%s\\t%%T@\\n'`. Other entries listed that way get their own size and mtime.",
+    )
+    optional.add_argument(
+        "--full-scan",
+        action="store_true",
+        help="with --scan-cache, read every directory instead of reusing the ones that haven't changed, and record them again. Use it after modifying files in place.",
+    )
     optional.add_argument(
         "-v", "--verbose", action="store_true", help="increase output verbosity"
     )
@@ -175,6 +260,7 @@ def update_database(  # noqa: C901
     cur: sqlite3.Cursor = con.cursor()
 
     update_config(cur)
+    create_indexes(cur, con)
 
     if config.maxsize is not None:
         maxsize = config.maxsize
@@ -182,6 +268,16 @@ def update_database(  # noqa: C901
         raise TypeError("Invalid config.maxsize={}".format(config.maxsize))
     config.maxsize = int(maxsize)
 
+    # Every file in an archive is checksummed with the same algorithm.
+    if args.digest and (args.digest != config.digest):
+        digest_error_str: str = (
+            "--digest={} does not match the archive's digest algorithm: {}".format(
+                args.digest, config.digest
+            )
+        )
+        logger.error(digest_error_str)
+        raise ValueError(digest_error_str)
+
     keep: bool
     # The command line arg should always have precedence
     if args.hpss == "none":
@@ -193,6 +289,8 @@ def update_database(  # noqa: C901
 
     if args.hpss is not None:
         config.hpss = args.hpss
+    if args.stream and (config.hpss is not None):
+        check_stream_supported(config.hpss)
 
     # Start doing actual work
     logger.debug("Running zstash update")
@@ -201,54 +299,54 @@ def update_database(  # noqa: C901
     logger.debug("Max size  : {}".format(maxsize))
     logger.debug("Keep local tar files  : {}".format(keep))
 
-    file_stats: Dict[str, Tuple[int, datetime]] = get_files_to_archive_with_stats(
-        cache, args.include, args.exclude
+    dev_options: DevOptions = DevOptions(
+        error_on_duplicate_tar=args.error_on_duplicate_tar,
+        overwrite_duplicate_tars=args.overwrite_duplicate_tars,
+        force_database_corruption="",
     )
+    failures: List[str]
+    if args.resume:
+        # Finish an interrupted update, following the plan in its journal,
+        # instead of looking for new files again.
+        journal: CreateJournal = CreateJournal.load(cache)
+        failures = construct_tars(
+            cur,
+            con,
+            min(journal.tar_nums, default=0) - 1,
+            FileStats(),
+            cache,
+            keep,
+            args.follow_symlinks,
+            dev_options,
+            transfer_manager,
+            non_blocking=args.non_blocking,
+            workers=args.workers,
+            stream=args.stream,
+            journal=journal,
+            resume=True,
+            cache_budget=args.cache_budget,
+        )
+        con.commit()
+        con.close()
+        return failures
 
-    files: List[str] = list(file_stats.keys())
-
-    # Dictionary mapping file path -> (size, mtime) for O(1) lookup
-    archived_files: Dict[str, Tuple[int, datetime]] = {}
-
-    cur.execute("SELECT name, size, mtime FROM files")
-    db_rows = cur.fetchall()
-
-    for row in db_rows:
-        file_path: str = row[0]
-        size: int = row[1]
-        mtime: datetime = row[2]
-
-        # If file appears multiple times, keep the one with latest mtime
-        if file_path in archived_files:
-            existing_mtime = archived_files[file_path][1]
-            if mtime > existing_mtime:
-                archived_files[file_path] = (size, mtime)
-        else:
-            archived_files[file_path] = (size, mtime)
-
-    newfiles: Dict[str, Tuple[int, datetime]] = {}
-    files_checked = 0
-
-    for file_path in files:
-        # Get the stat info we already collected during filesystem walk
-        size_new, mdtime_new = file_stats[file_path]
-
-        # Check if file exists in database
-        if file_path not in archived_files:
-            # File not in database - it's new
-            newfiles[file_path] = (size_new, mdtime_new)
-        else:
-            # File exists in database - check if it changed
-            archived_size, archived_mtime = archived_files[file_path]
-
-            if not (
-                (size_new == archived_size)
-                and (abs((mdtime_new - archived_mtime).total_seconds()) <= TIME_TOL)
-            ):
-                # File has changed
-                newfiles[file_path] = (size_new, mdtime_new)
-
-        files_checked += 1
+    file_stats: FileStats
+    if args.files_from:
+        file_stats = get_files_from_manifest(
+            cache, args.files_from, args.include, args.exclude, args.scan_workers
+        )
+    else:
+        file_stats = get_files_to_archive_with_stats(
+            cache,
+            args.include,
+            args.exclude,
+            args.scan_workers,
+            args.scan_cache,
+            args.full_scan,
+        )
+
+    # Positions in file_stats of the new and changed files
+    newfiles: List[int] = find_new_files(cur, file_stats)
 
     # Anything to do?
     if len(newfiles) == 0:
@@ -261,37 +359,33 @@ def update_database(  # noqa: C901
     # --dry-run option
     if args.dry_run:
         print("List of files to be updated")
-        for file_path in newfiles.keys():
-            print(file_path)
+        for i in newfiles:
+            print(file_stats.path(i))
         # Close database
         con.commit()
         con.close()
         return None
 
-    # Find last used tar archive
-    itar: int = -1
-    cur.execute("select distinct tar from files")
-    tfiles: List[Tuple[str]] = cur.fetchall()
-    for tfile in tfiles:
-        tfile_string: str = tfile[0]
-        itar = max(itar, int(tfile_string[0:6], 16))
-    dev_options: DevOptions = DevOptions(
-        error_on_duplicate_tar=args.error_on_duplicate_tar,
-        overwrite_duplicate_tars=args.overwrite_duplicate_tars,
-        force_database_corruption="",
-    )
+    # Find last used tar archive.
+    itar: int = last_tar_number(cur)
     # Add files
     failures = construct_tars(
         cur,
         con,
         itar,
-        newfiles,
+        file_stats.subset(newfiles),
         cache,
         keep,
         args.follow_symlinks,
         dev_options,
         transfer_manager,
         non_blocking=args.non_blocking,
+        workers=args.workers,
+        packing=args.packing,
+        split_large_files=args.split_large_files,
+        stream=args.stream,
+        journal=CreateJournal(cache),
+        cache_budget=args.cache_budget,
     )
 
     # Close database
@@ -299,3 +393,95 @@ def update_database(  # noqa: C901
     con.close()
 
     return failures
+
+
+# Margin around TIME_TOL for the mtime comparison done by SQLite,
+# which only keeps milliseconds of timestamps. Files in this band are compared in Python.
+TIME_TOL_MARGIN: float = 0.01
+
+
+def last_tar_number(cur: sqlite3.Cursor) -> int:
+    """
+    Return the number of the last tar used by the archive, or -1 if there's none.
+    The tars of a split file can be in the tars and chunks tables
+    without the file itself, if a previous run stopped partway.
+    """
+    # Tar names are fixed-width hex, so the largest name is the largest number.
+    used_tars: List[str] = ["select tar from files"]
+    if tars_table_exists(cur):
+        used_tars.append("select name from tars")
+    if chunks_table_exists(cur):
+        used_tars.append("select tar from chunks")
+    cur.execute("select max(tar) from ({})".format(" union all ".join(used_tars)))
+    last_tar: Optional[str] = cur.fetchone()[0]
+    if last_tar is None:
+        return -1
+    return int(last_tar[0:6], 16)
+
+
+def find_new_files(cur: sqlite3.Cursor, file_stats: FileStats) -> List[int]:
+    """
+    Return the positions in `file_stats` of the files that are new,
+    or that changed since the latest version archived:
+    a different size, or an mtime more than TIME_TOL seconds apart.
+    The latest version of a file is the one with the latest mtime.
+
+    The scan is loaded into a temporary table and joined with the files table,
+    so that the archive's history is never loaded in memory.
+    """
+    cur.execute(
+        "create temp table scan (position integer primary key, name text, size integer, mtime_ns integer)"
+    )
+    cur.executemany(
+        "insert into scan values (?,?,?,?)",
+        (
+            (i, file_stats.path(i), file_stats.sizes[i], file_stats.mtimes_ns[i])
+            for i in range(len(file_stats))
+        ),
+    )
+    cur.execute("create index temp.scan_name on scan (name)")
+    # Difference in seconds between the archived mtime and the one found.
+    # julianday() is in days; 2440587.5 is the Unix epoch.
+    mtime_column: str = "mtime_ns" if has_mtime_ns() else "mtime"
+    seconds_apart: str = (
+        "abs(latest.mtime - scan.mtime_ns) / 1e9"
+        if has_mtime_ns()
+        else "abs((julianday(latest.mtime) - 2440587.5) * 86400.0 - scan.mtime_ns / 1e9)"
+    )
+    cur.execute(
+        f"""
+with latest as (
+  select name, size, mtime from (
+    select name, size, {mtime_column} as mtime,
+      row_number() over (partition by name order by {mtime_column} desc, id) as version
+    from files
+  ) where version = 1
+)
+select scan.position, latest.name is null, latest.size != scan.size,
+  {seconds_apart},
+  latest.mtime
+from scan left join latest on latest.name = scan.name
+where latest.name is null or latest.size != scan.size
+  or {seconds_apart} > ?
+order by scan.position
+""",
+        (TIME_TOL - TIME_TOL_MARGIN,),
+    )
+    newfiles: List[int] = []
+    for position, is_new, size_changed, mtime_difference, archived_mtime in cur:
+        if (
+            is_new
+            or size_changed
+            or (mtime_difference > TIME_TOL + TIME_TOL_MARGIN)
+            or mtime_changed(file_stats.mtime(position), archived_mtime)
+        ):
+            newfiles.append(position)
+    cur.execute("drop table temp.scan")
+    return newfiles
+
+
+def mtime_changed(mtime_new: datetime, archived_mtime: Any) -> bool:
+    if isinstance(archived_mtime, str):
+        archived_mtime = datetime.fromisoformat(archived_mtime)
+    archived_mtime = mtime_from_index(archived_mtime)
+    return abs((mtime_new - archived_mtime).total_seconds()) > TIME_TOL
@@ -1,42 +1,441 @@
 from __future__ import absolute_import, print_function
 
+import concurrent.futures
+import json
 import os
+import re
 import shlex
 import sqlite3
 import stat as stat_module
 import subprocess
-from collections import OrderedDict
+import sys
+import threading
+import time
+from array import array
+from collections.abc import Mapping
 from datetime import datetime, timezone
-from fnmatch import fnmatch
-from typing import Any, Dict, List, Tuple
+from decimal import Decimal
+from fnmatch import translate
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
-from .settings import TupleTarsRow, config, logger
+from .settings import Config, TupleTarsRow, config, logger
 
 LOADER_SANITIZED_ENV_VARS: Tuple[str, ...] = ("LD_LIBRARY_PATH", "LD_PRELOAD")
 
 
+# (path, size, mtime in ns) of the files in one directory, its subdirectories,
+# the number of files, and whether it's an empty directory
+DirectoryListing = Tuple[List[Tuple[str, int, int]], List[str], int, bool]
+
+# (inode, mtime in ns, ctime in ns) of a directory
+DirectoryStamp = Tuple[int, int, int]
+
+SCAN_STATE_NAME: str = "scan_state.db"
+# Directories modified this recently aren't recorded in the scan state:
+# with coarse timestamps, they could still change without their mtime changing.
+SCAN_STATE_RACY_NS: int = 2 * 1000000000
+
+# Secondary indexes of the index database: (name, table, columns).
+# GLOB patterns with a literal prefix, e.g. "dir/*.nc", are looked up in them too.
+INDEXES: Tuple[Tuple[str, str, str], ...] = (
+    ("files_name", "files", "name"),
+    ("files_tar", "files", "tar, offset"),
+    ("tars_name", "tars", "name"),
+)
+
+
 # Classes #####################################################################
+class PathMatcher:
+    """
+    Comma separated list of file patterns, compiled into a single regex.
+
+    Patterns follow `fnmatch` rules, so `*` also matches `/`.
+    A pattern ending in '/' matches the entire subdirectory content,
+    as if it ended in '/*'.
+    """
+
+    def __init__(self, subset: str):
+        self.patterns: List[str] = [
+            pattern + "*" if pattern.endswith("/") else pattern
+            for pattern in subset.split(",")
+        ]
+        self.regex: re.Pattern = compile_patterns(self.patterns)
+        # What every match of a pattern starts with, up to its first wildcard
+        self.prefixes: List[str] = [
+            re.split(r"[*?[]", pattern, maxsplit=1)[0] for pattern in self.patterns
+        ]
+        # Patterns ending in '*': if one matches "dir/",
+        # it matches everything under dir too.
+        self.subtree_regex: Optional[re.Pattern] = None
+        subtree_patterns = [p for p in self.patterns if p.endswith("*")]
+        if subtree_patterns:
+            self.subtree_regex = compile_patterns(subtree_patterns)
+
+    def matches(self, path: str) -> bool:
+        return self.regex.match(os.path.normcase(path)) is not None
+
+    def may_match_under(self, directory: str) -> bool:
+        """
+        Return False if no path under `directory` can match.
+        """
+        prefix: str = os.path.normcase(directory + os.sep)
+        return any(
+            prefix.startswith(literal) or literal.startswith(prefix)
+            for literal in self.prefixes
+        )
+
+    def matches_all_under(self, directory: str) -> bool:
+        """
+        Return True if every path under `directory` matches.
+        """
+        if self.subtree_regex is None:
+            return False
+        return (
+            self.subtree_regex.match(os.path.normcase(directory + os.sep)) is not None
+        )
+
+
+class FileStats(Mapping):
+    """
+    Sizes and mtimes of the files to archive, stored in columns.
+
+    Each directory is stored once, in a table of directories.
+    Each file only keeps the index of its directory, its basename,
+    its size and its mtime in integer nanoseconds,
+    rather than a tuple and a `datetime` per file.
+
+    Files are addressed by position.
+    It can also be used as a mapping of path -> (size, mtime),
+    but looking up a path builds an index of all the paths on first use.
+    """
+
+    def __init__(self):
+        self.directories: List[str] = []
+        self.directory_ids: Dict[str, int] = {}
+        self.directory_index: "array[int]" = array("I")
+        self.names: List[str] = []
+        self.sizes: "array[int]" = array("q")
+        self.mtimes_ns: "array[int]" = array("q")
+        self.positions: Optional[Dict[str, int]] = None
+
+    def add(self, path: str, size: int, mtime_ns: int):
+        directory: str
+        name: str
+        directory, name = os.path.split(path)
+        directory_id: Optional[int] = self.directory_ids.get(directory)
+        if directory_id is None:
+            directory_id = len(self.directories)
+            self.directory_ids[directory] = directory_id
+            self.directories.append(directory)
+        self.directory_index.append(directory_id)
+        self.names.append(name)
+        self.sizes.append(size)
+        self.mtimes_ns.append(mtime_ns)
+        self.positions = None
+
+    def directory(self, i: int) -> str:
+        return self.directories[self.directory_index[i]]
+
+    def path(self, i: int) -> str:
+        return os.path.join(self.directory(i), self.names[i])
+
+    def mtime(self, i: int) -> datetime:
+        return mtime_from_ns(self.mtimes_ns[i])
+
+    def position(self, path: str) -> int:
+        if self.positions is None:
+            self.positions = {self.path(i): i for i in range(len(self))}
+        return self.positions[path]
+
+    def subset(self, indices: Iterable[int]) -> "FileStats":
+        """
+        Return the files at `indices`, in that order.
+        """
+        file_stats: FileStats = FileStats()
+        file_stats.directories = self.directories
+        file_stats.directory_ids = self.directory_ids
+        for i in indices:
+            file_stats.directory_index.append(self.directory_index[i])
+            file_stats.names.append(self.names[i])
+            file_stats.sizes.append(self.sizes[i])
+            file_stats.mtimes_ns.append(self.mtimes_ns[i])
+        return file_stats
+
+    def sort_key(self, i: int) -> Tuple[str, str]:
+        # Sort on directory and filename, like the original os.walk() based version.
+        # Empty directories (size 0) use their full path as directory, and an empty filename.
+        # Note: broken symlinks are caught by not os.path.isfile() but not by os.path.isdir(). We want the latter.
+        if self.sizes[i] == 0:
+            path: str = self.path(i)
+            if os.path.isdir(path):
+                return (path, "")
+        return (self.directory(i), self.names[i])
+
+    def sorted(self) -> "FileStats":
+        return self.subset(sorted(range(len(self)), key=self.sort_key))
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(len(self)):
+            yield self.path(i)
+
+    def __getitem__(self, path: str) -> Tuple[int, datetime]:
+        i: int = self.position(path)
+        return self.sizes[i], self.mtime(i)
+
+
+class ScanState:
+    """
+    What each directory contained when it was last scanned, kept in the cache,
+    so that the next scan can reuse the directories that haven't changed.
+
+    A directory is reused if its inode, mtime and ctime are the same as last time,
+    without stat'ing its files again.
+    Its mtime changes when entries are added, removed or renamed in it,
+    but not when one of its files is modified in place:
+    such changes are only found by a full scan.
+
+    The scanner may look up and store directories from several threads.
+    """
+
+    def __init__(self, cache: str, filters: List[Optional[str]], full_scan: bool):
+        self.path: str = os.path.join(cache, SCAN_STATE_NAME)
+        self.con: sqlite3.Connection = sqlite3.connect(
+            self.path, check_same_thread=False
+        )
+        self.cur: sqlite3.Cursor = self.con.cursor()
+        self.lock: threading.Lock = threading.Lock()
+        self.cur.execute(
+            "create table if not exists config (arg text primary key, value text)"
+        )
+        self.cur.execute("""
+create table if not exists directories (
+id integer primary key,
+path text unique,
+ino integer,
+mtime_ns integer,
+ctime_ns integer,
+file_count integer,
+empty integer
+)""")
+        self.cur.execute("""
+create table if not exists entries (
+directory_id integer,
+path text,
+size integer,
+mtime_ns integer
+)""")
+        self.cur.execute(
+            "create table if not exists subdirs (directory_id integer, path text)"
+        )
+        self.cur.execute(
+            "create index if not exists entries_directory on entries (directory_id)"
+        )
+        self.cur.execute(
+            "create index if not exists subdirs_directory on subdirs (directory_id)"
+        )
+        # The listings depend on the cache and the include/exclude filters
+        key: str = json.dumps(filters)
+        self.cur.execute("select value from config where arg = 'filters'")
+        row: Optional[Tuple[str]] = self.cur.fetchone()
+        if full_scan or (row is None) or (row[0] != key):
+            for table in ["directories", "entries", "subdirs"]:
+                self.cur.execute(f"delete from {table}")
+            self.cur.execute(
+                "insert or replace into config values ('filters', ?)", (key,)
+            )
+        self.con.commit()
+        self.cur.execute("select path, id, ino, mtime_ns, ctime_ns from directories")
+        # Directory path -> (id, stamp)
+        self.stamps: Dict[str, Tuple[int, DirectoryStamp]] = {
+            path: (directory_id, (ino, mtime_ns, ctime_ns))
+            for path, directory_id, ino, mtime_ns, ctime_ns in self.cur.fetchall()
+        }
+        self.visited: Set[str] = set()
+        self.reused_count: int = 0
+
+    def lookup(self, path: str, stamp: DirectoryStamp) -> Optional[DirectoryListing]:
+        """
+        Return the stored listing of `path`, if the directory hasn't changed.
+        """
+        with self.lock:
+            stored: Optional[Tuple[int, DirectoryStamp]] = self.stamps.get(path)
+            if (stored is None) or (stored[1] != stamp):
+                return None
+            directory_id: int = stored[0]
+            self.cur.execute(
+                "select file_count, empty from directories where id = ?",
+                (directory_id,),
+            )
+            file_count, empty = self.cur.fetchone()
+            self.cur.execute(
+                "select path, size, mtime_ns from entries where directory_id = ? order by rowid",
+                (directory_id,),
+            )
+            entries: List[Tuple[str, int, int]] = self.cur.fetchall()
+            self.cur.execute(
+                "select path from subdirs where directory_id = ? order by rowid",
+                (directory_id,),
+            )
+            subdirs: List[str] = [row[0] for row in self.cur.fetchall()]
+            self.visited.add(path)
+            self.reused_count += 1
+        return entries, subdirs, file_count, bool(empty)
+
+    def store(self, path: str, stamp: DirectoryStamp, listing: DirectoryListing):
+        """
+        Replace the stored listing of `path`.
+        """
+        entries, subdirs, file_count, empty = listing
+        with self.lock:
+            self.delete(path)
+            self.visited.add(path)
+            if time.time_ns() - stamp[1] < SCAN_STATE_RACY_NS:
+                # Modified too recently to trust its mtime next time
+                return
+            self.cur.execute(
+                "insert into directories (path, ino, mtime_ns, ctime_ns, file_count, empty) values (?,?,?,?,?,?)",
+                (path, *stamp, file_count, empty),
+            )
+            directory_id: Optional[int] = self.cur.lastrowid
+            self.cur.executemany(
+                "insert into entries values (?,?,?,?)",
+                ((directory_id, *entry) for entry in entries),
+            )
+            self.cur.executemany(
+                "insert into subdirs values (?,?)",
+                ((directory_id, subdir) for subdir in subdirs),
+            )
+
+    def delete(self, path: str):
+        stored: Optional[Tuple[int, DirectoryStamp]] = self.stamps.pop(path, None)
+        if stored is None:
+            return
+        for table, column in [
+            ("directories", "id"),
+            ("entries", "directory_id"),
+            ("subdirs", "directory_id"),
+        ]:
+            self.cur.execute(f"delete from {table} where {column} = ?", (stored[0],))
+
+    def close(self):
+        """
+        Forget the directories that are gone, and save the scan state.
+        """
+        with self.lock:
+            for path in [p for p in self.stamps if p not in self.visited]:
+                self.delete(path)
+            self.con.commit()
+            self.con.close()
+
+
 class DirectoryScanner:
     """Helper class to scan directories and collect file stats."""
 
-    def __init__(self, cache_path: str):
+    def __init__(
+        self,
+        cache_path: str,
+        include: Optional[str] = None,
+        exclude: Optional[str] = None,
+        scan_state: Optional[ScanState] = None,
+    ):
         self.cache_path = cache_path
-        self.file_stats: Dict[str, Tuple[int, datetime]] = {}
+        # Listings of the directories that haven't changed since the last scan
+        self.scan_state: Optional[ScanState] = scan_state
+        # Filters are applied during the scan:
+        # excluded subtrees are never entered, and excluded files never stat'ed.
+        self.include: Optional[PathMatcher] = PathMatcher(include) if include else None
+        self.exclude: Optional[PathMatcher] = PathMatcher(exclude) if exclude else None
+        self.file_stats: FileStats = FileStats()
         self.dir_count = 0
         self.file_count = 0
         self.empty_dir_count = 0
 
     def scan_directory(self, path: str):
         """Recursively scan directory using os.scandir() for efficiency."""
+        listing: Optional[DirectoryListing] = self.list_directory(path)
+        if listing is None:
+            return
+        # Now recurse into subdirectories
+        for subdir in self.add_listing(listing):
+            self.scan_directory(subdir)
+
+    def scan_directory_parallel(self, path: str, workers: int):
+        """
+        Scan directory with a pool of `workers` threads.
+
+        Each directory is listed by a worker thread,
+        and its subdirectories are queued as soon as it's done.
+        Results are only recorded on this thread,
+        so `file_stats` ends up with the same contents as `scan_directory`.
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = {executor.submit(self.list_directory, path)}
+            while pending:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    listing: Optional[DirectoryListing] = future.result()
+                    if listing is None:
+                        continue
+                    for subdir in self.add_listing(listing):
+                        pending.add(executor.submit(self.list_directory, subdir))
+
+    def add_listing(self, listing: DirectoryListing) -> List[str]:
+        """
+        Record the listing of one directory, and return its subdirectories.
+        """
+        file_stats, subdirs, file_count, empty_dir = listing
+        self.dir_count += 1
+        self.file_count += file_count
+        if empty_dir:
+            self.empty_dir_count += 1
+        for path, size, mtime_ns in file_stats:
+            self.file_stats.add(path, size, mtime_ns)
+        return subdirs
+
+    def list_directory(self, path: str) -> Optional[DirectoryListing]:
+        """
+        List one directory, without recursing.
+
+        Returns the path, size and mtime of its files
+        (or of the directory itself, if it's empty),
+        its subdirectories, the number of files, and whether it's empty.
+        Doesn't modify the scanner, so it's safe to call from several threads.
+        """
+        if self.scan_state is None:
+            return self.read_directory(path)
+        # Stat the directory before reading it,
+        # so that changes made while reading it are found next time.
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return self.read_directory(path)
+        stamp: DirectoryStamp = (st.st_ino, st.st_mtime_ns, st.st_ctime_ns)
+        listing: Optional[DirectoryListing] = self.scan_state.lookup(path, stamp)
+        if listing is None:
+            listing = self.read_directory(path)
+            if listing is not None:
+                self.scan_state.store(path, stamp, listing)
+        return listing
+
+    def read_directory(self, path: str) -> Optional[DirectoryListing]:
         try:
             entries = list(os.scandir(path))
         except PermissionError:
             logger.warning(f"Permission denied: {path}")
-            return
+            return None
 
-        self.dir_count += 1
+        file_stats: List[Tuple[str, int, int]] = []
+        file_count = 0
         has_contents = False
         subdirs_to_process = []  # Defer subdirectory recursion
+        # Nothing under a pruned directory is wanted.
+        # It's only listed to find out if it's empty.
+        pruned = path != "." and self.prunes(os.path.normpath(path))
 
         for entry in entries:
             # Skip the cache directory entirely
@@ -45,6 +444,24 @@ class DirectoryScanner:
             ):
                 continue
 
+            if pruned:
+                has_contents = True
+                continue
+
+            # Skip filtered out entries without a stat
+            normalized_path = os.path.normpath(os.path.join(path, entry.name))
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if self.prunes(normalized_path) and not self.wants(normalized_path):
+                    has_contents = True
+                    continue
+            elif not self.wants(normalized_path):
+                has_contents = True
+                continue
+
             try:
                 # Get stat info - scandir provides this efficiently
                 # Use entry.stat(follow_symlinks=False) to match os.lstat() behavior
@@ -58,7 +475,7 @@ class DirectoryScanner:
                 else:
                     # It's a file or symlink
                     has_contents = True
-                    self.file_count += 1
+                    file_count += 1
 
                     # For symbolic links or directories, size should be 0
                     if stat_module.S_ISLNK(mode):
@@ -66,35 +483,49 @@ class DirectoryScanner:
                     else:
                         size = stat_info.st_size
 
-                    mtime = datetime.utcfromtimestamp(stat_info.st_mtime)
-
-                    # Normalize the path.
+                    # The path was normalized above.
                     # By building from path + entry.name,
                     # we guarantee the argument to normpath is constructed
                     # identically to how os.walk did it in previous code iterations.
-                    normalized_path = os.path.normpath(os.path.join(path, entry.name))
-                    self.file_stats[normalized_path] = (size, mtime)
+                    file_stats.append((normalized_path, size, stat_info.st_mtime_ns))
 
             except (OSError, PermissionError) as e:
                 logger.warning(f"Error accessing {entry.path}: {e}")
                 continue
 
         # Handle empty directories BEFORE recursing into subdirs
-        if not has_contents and path != ".":
-            self.empty_dir_count += 1
+        empty_dir = not has_contents and path != "."
+        if empty_dir and self.wants(os.path.normpath(path)):
             normalized_path = os.path.normpath(path)
             # Get actual mtime for empty directory
             try:
                 stat_info = os.lstat(path)
-                mtime = datetime.utcfromtimestamp(stat_info.st_mtime)
-                self.file_stats[normalized_path] = (0, mtime)
+                file_stats.append((normalized_path, 0, stat_info.st_mtime_ns))
             except (OSError, PermissionError):
                 # Fallback if we can't stat the directory
-                self.file_stats[normalized_path] = (0, datetime.utcnow())
-
-        # Now recurse into subdirectories
-        for subdir in subdirs_to_process:
-            self.scan_directory(subdir)
+                file_stats.append((normalized_path, 0, time.time_ns()))
+
+        return file_stats, subdirs_to_process, file_count, empty_dir
+
+    def wants(self, path: str) -> bool:
+        """
+        Return True if `path` passes the include and exclude filters.
+        """
+        if (self.include is not None) and not self.include.matches(path):
+            return False
+        if (self.exclude is not None) and self.exclude.matches(path):
+            return False
+        return True
+
+    def prunes(self, directory: str) -> bool:
+        """
+        Return True if nothing under `directory` can pass the filters.
+        """
+        if (self.include is not None) and not self.include.may_match_under(directory):
+            return True
+        if (self.exclude is not None) and self.exclude.matches_all_under(directory):
+            return True
+        return False
 
 
 # Functions #####################################################################
@@ -104,32 +535,25 @@ def ts_utc():
     return datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S_%f")
 
 
-def filter_files(subset: str, files: List[str], include: bool) -> List[str]:
+def mtime_from_ns(mtime_ns: int) -> datetime:
+    # Same as datetime.utcfromtimestamp(os.lstat(path).st_mtime),
+    # which is computed from the seconds and nanoseconds like this.
+    seconds: int
+    nanoseconds: int
+    seconds, nanoseconds = divmod(mtime_ns, 1000000000)
+    return datetime.utcfromtimestamp(seconds + nanoseconds * 1e-9)
+
+
+def compile_patterns(patterns: List[str]) -> re.Pattern:
+    # Same rules as fnmatch.fnmatch, for all the patterns at once
+    return re.compile(
+        "|".join(translate(os.path.normcase(pattern)) for pattern in patterns)
+    )
 
-    # Construct list of files to filter, based on
-    #  https://codereview.stackexchange.com/questions/33624/
-    #  filtering-a-long-list-of-files-through-a-set-of-ignore-patterns-using-iterators
-    subset_patterns: List[str] = subset.split(",")
-
-    # If subset pattern ends with a trailing '/', the user intends to filter
-    # the entire subdirectory content, therefore replace '/' with '/*'
-    for i in range(len(subset_patterns)):
-        if subset_patterns[i][-1] == "/":
-            subset_patterns[i] += "*"
-
-    # Actual files to filter
-    subset_files: List[str] = []
-    for file_name in files:
-        if any(fnmatch(file_name, pattern) for pattern in subset_patterns):
-            subset_files.append(file_name)
-
-    # Now, filter those files
-    if include:
-        new_files = [f for f in files if f in subset_files]
-    else:
-        new_files = [f for f in files if f not in subset_files]
 
-    return new_files
+def filter_files(subset: str, files: List[str], include: bool) -> List[str]:
+    matcher: PathMatcher = PathMatcher(subset)
+    return [f for f in files if matcher.matches(f) == include]
 
 
 def exclude_files(exclude: str, files: List[str]) -> List[str]:
@@ -151,28 +575,38 @@ def get_command_environment(command_args: List[str]) -> Dict[str, str]:
     return env
 
 
-def run_command(command: str, error_str: str) -> None:
+def run_command(command: str, error_str: str, cwd: Optional[str] = None) -> None:
     command_args: List[str] = shlex.split(command)
     p1: subprocess.Popen = subprocess.Popen(
         command_args,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
         env=get_command_environment(command_args),
+        cwd=cwd,
     )
     stdout: bytes
     stderr: bytes
     stdout, stderr = p1.communicate()
     status: int = p1.returncode
     if status != 0:
-        error_str = "Error={}, Command was `{}`".format(error_str, command)
-        if "hsi" in command:
-            error_str = f"{error_str}. This command includes `hsi`. Be sure that you have logged into `hsi`"
-        if "cd" in command:
-            error_str = f"{error_str}. This command includes `cd`. Check that this directory exists and contains the needed files"
-        logger.error(error_str)
-        logger.debug("stdout:\n{!r}".format(stdout))
-        logger.debug("stderr:\n{!r}".format(stderr))
-        raise RuntimeError(error_str)
+        raise command_error(command, error_str, stdout, stderr)
+
+
+def command_error(
+    command: str, error_str: str, stdout: bytes, stderr: bytes
+) -> RuntimeError:
+    """
+    Log why `command` failed, and return the error to raise.
+    """
+    error_str = "Error={}, Command was `{}`".format(error_str, command)
+    if "hsi" in command:
+        error_str = f"{error_str}. This command includes `hsi`. Be sure that you have logged into `hsi`"
+    if "cd" in command:
+        error_str = f"{error_str}. This command includes `cd`. Check that this directory exists and contains the needed files"
+    logger.error(error_str)
+    logger.debug("stdout:\n{!r}".format(stdout))
+    logger.debug("stderr:\n{!r}".format(stderr))
+    return RuntimeError(error_str)
 
 
 # Sort paths to match original behavior (directory first, then filename)
@@ -183,58 +617,178 @@ def path_sort_key(path: str) -> Tuple[str, str]:
 
 
 def get_files_to_archive_with_stats(
-    cache: str, include: str, exclude: str
-) -> Dict[str, Tuple[int, datetime]]:
+    cache: str,
+    include: str,
+    exclude: str,
+    scan_workers: int = 1,
+    scan_cache: bool = False,
+    full_scan: bool = False,
+) -> FileStats:
     """
     OPTIMIZED VERSION: Gather list of files to archive along with their stats.
 
     Uses os.scandir() to get file stats during the directory walk,
     eliminating the need to stat files again later during database comparison.
 
+    With `scan_workers` > 1, directories are listed by that many threads,
+    which helps on filesystems where every metadata call is a round trip.
+    The result is the same either way.
+
+    With `scan_cache`, directories that haven't changed since the last scan
+    reuse the listing recorded in the cache (see `ScanState`).
+    With `full_scan`, every directory is read, and recorded again.
+
     Returns:
-        Dictionary mapping file_path -> (size, mtime)
+        FileStats, sorted on directory and filename
     """
 
     logger.info("Gathering list of files to archive")
     cache_path = os.path.join(".", cache)
-    scanner = DirectoryScanner(cache_path)
-    scanner.scan_directory(".")
-    file_stats = scanner.file_stats
-
-    # Apply include/exclude filters
-    if include is not None:
-        file_list = list(file_stats.keys())
-        filtered_list = include_files(include, file_list)
-        # Keep only files that passed the filter
-        file_stats = {path: file_stats[path] for path in filtered_list}
-    if exclude is not None:
-        file_list = list(file_stats.keys())
-        filtered_list = exclude_files(exclude, file_list)
-        # Keep only files that passed the filter
-        file_stats = {path: file_stats[path] for path in filtered_list}
-
-    # Extract directory and filename BEFORE normalization for sorting
-    # For empty directories, preserve original behavior: use directory path with empty filename
-    path_components = []
-    for path in file_stats.keys():
-        size, mtime = file_stats[path]
-        # Empty directories (size 0) should use full path as directory, empty string as filename
-        # Note: broken symlinks are caught by not os.path.isfile() but not by os.path.isdir(). We want the latter.
-        if size == 0 and os.path.isdir(path):
-            directory = path
-            filename = ""
-        else:
-            directory = os.path.dirname(path)
-            filename = os.path.basename(path)
-        path_components.append((directory, filename, path))
+    # Include/exclude filters are applied during the scan
+    scan_state: Optional[ScanState] = None
+    if scan_cache:
+        scan_state = ScanState(cache, [cache_path, include, exclude], full_scan)
+    scanner = DirectoryScanner(cache_path, include, exclude, scan_state)
+    if scan_workers > 1:
+        scanner.scan_directory_parallel(".", scan_workers)
+    else:
+        scanner.scan_directory(".")
+    if scan_state is not None:
+        scan_state.close()
+        logger.info(
+            f"Reused the listings of {scan_state.reused_count} unchanged directories out of {scanner.dir_count}"
+        )
+    return scanner.file_stats.sorted()
+
+
+def read_manifest(files_from: str) -> List[Tuple[str, Optional[int], Optional[int]]]:
+    """
+    Read the entries listed in `files_from` ("-" for stdin).
 
-    # Sort on directory and filename like original
-    path_components.sort(key=lambda x: (x[0], x[1]))
+    Entries are separated by NULs if there are any, by newlines otherwise.
+    Each one is a path, optionally followed by the file's size
+    and mtime (in seconds since the epoch), separated by tabs,
+    as printed by `find . -type f -printf '%P\\t%s\\t%T@\\n'`.
+    Returns (path, size, mtime in ns), with None for what isn't given.
+    """
+    data: bytes
+    if files_from == "-":
+        data = sys.stdin.buffer.read()
+    else:
+        with open(files_from, "rb") as f:
+            data = f.read()
+    separator: bytes = b"\0" if b"\0" in data else b"\n"
+    entries: List[Tuple[str, Optional[int], Optional[int]]] = []
+    for raw_entry in data.split(separator):
+        entry: str = os.fsdecode(raw_entry)
+        if separator == b"\n":
+            entry = entry.rstrip("\r")
+        if not entry:
+            continue
+        fields: List[str] = entry.split("\t")
+        try:
+            if len(fields) == 1:
+                entries.append((entry, None, None))
+            elif len(fields) == 3:
+                mtime_ns: int = int(Decimal(fields[2]) * 1000000000)
+                entries.append((fields[0], int(fields[1]), mtime_ns))
+            else:
+                raise ValueError("expected a path, or a path, size and mtime")
+        except (ArithmeticError, ValueError) as e:
+            # decimal.InvalidOperation is an ArithmeticError
+            raise ValueError(f"Invalid entry in {files_from}: {entry!r}: {e}")
+    return entries
+
+
+def get_files_from_manifest(
+    cache: str,
+    files_from: str,
+    include: Optional[str],
+    exclude: Optional[str],
+    scan_workers: int = 1,
+) -> FileStats:
+    """
+    Gather the files listed in `files_from` (see `read_manifest`),
+    instead of walking the whole directory.
 
-    # NOW build the ordered dict with normalized paths
-    file_stats = OrderedDict((x[2], file_stats[x[2]]) for x in path_components)
+    Paths are relative to the directory being archived.
+    Every entry is stat'ed, by `scan_workers` threads.
+    Regular files listed with a size and mtime keep the ones listed.
+    Other entries listed with them would be archived as the wrong type of member,
+    so they get their own size and mtime, like entries listed by path alone.
+    As in a walk, a directory is only archived if it's empty:
+    the files of other directories have to be listed themselves.
 
-    return file_stats
+    Returns:
+        FileStats, sorted like `get_files_to_archive_with_stats`
+    """
+    logger.info(f"Gathering the files listed in {files_from}")
+    cache_path: str = os.path.normpath(os.path.join(".", cache))
+    scanner: DirectoryScanner = DirectoryScanner(cache_path, include, exclude)
+    seen: Set[str] = set()
+    to_stat: List[Tuple[str, Optional[int], Optional[int]]] = []
+    for path, size, mtime_ns in read_manifest(files_from):
+        if os.path.isabs(path):
+            path = os.path.relpath(path)
+        path = os.path.normpath(path)
+        if path == os.pardir or path.startswith(os.pardir + os.sep) or path == ".":
+            raise ValueError(
+                f"{path} from {files_from} is not in the directory being archived"
+            )
+        if (path in seen) or (path == cache_path):
+            continue
+        if path.startswith(cache_path + os.sep) or not scanner.wants(path):
+            continue
+        seen.add(path)
+        to_stat.append((path, size, mtime_ns))
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(scan_workers, 1)
+    ) as executor:
+        stat_infos: Iterator[Optional[os.stat_result]] = executor.map(
+            lstat_or_none, [entry[0] for entry in to_stat]
+        )
+        for (path, size, mtime_ns), stat_info in zip(to_stat, stat_infos):
+            if stat_info is None:
+                continue
+            mode: int = stat_info.st_mode
+            if (size is not None) and (mtime_ns is not None):
+                if stat_module.S_ISREG(mode):
+                    scanner.file_stats.add(path, size, mtime_ns)
+                    continue
+                logger.warning(
+                    f"{path} is listed with a size and mtime in {files_from}, but it isn't a regular file: using its own"
+                )
+            if stat_module.S_ISDIR(mode):
+                try:
+                    with os.scandir(path) as it:
+                        is_empty: bool = all(
+                            os.path.normpath(entry.path) == cache_path for entry in it
+                        )
+                except OSError as e:
+                    logger.warning(f"Error accessing {path}: {e}")
+                    continue
+                if not is_empty:
+                    logger.warning(
+                        f"Skipping {path}: only empty directories are archived, list the files in it instead"
+                    )
+                    continue
+                size = 0
+            elif stat_module.S_ISLNK(mode):
+                # For symbolic links, size should be 0
+                size = 0
+            else:
+                size = stat_info.st_size
+            scanner.file_stats.add(path, size, stat_info.st_mtime_ns)
+    return scanner.file_stats.sorted()
+
+
+def lstat_or_none(path: str) -> Optional[os.stat_result]:
+    try:
+        return os.lstat(path)
+    except OSError as e:
+        logger.warning(f"Error accessing {path}: {e}")
+        return None
 
 
 def update_config(cur: sqlite3.Cursor):
@@ -248,7 +802,12 @@ def update_config(cur: sqlite3.Cursor):
             # Get the value (column 2) for attribute `attr` (column 1)
             # i.e., for the row where column 1 is the attribute, get the value from column 2
             cur.execute("select value from config where arg=?", (attr,))
-            value = cur.fetchone()[0]
+            row: Optional[Tuple[Any]] = cur.fetchone()
+            if row is not None:
+                value = row[0]
+            else:
+                # Older databases don't have every setting.
+                value = getattr(Config, attr)
             # Update config with the new attribute-value pair
             setattr(config, attr, value)
 
@@ -261,11 +820,88 @@ id integer primary key,
 name text,
 size integer,
 md5 text
+);
+    """)
+    cur.execute("create index tars_name on tars (name)")
+    con.commit()
+
+
+def create_chunks_table(cur: sqlite3.Cursor, con: sqlite3.Connection):
+    # Create 'chunks' table, for files split across several tars
+    cur.execute("""
+create table chunks (
+id integer primary key,
+file_id integer,
+part integer,
+size integer,
+md5 text,
+tar text,
+offset integer
 );
     """)
     con.commit()
 
 
+def create_indexes(cur: sqlite3.Cursor, con: sqlite3.Connection):
+    """
+    Add the indexes missing from the database.
+    `zstash create` adds them once the files are loaded;
+    databases made by older versions get them the first time they're opened.
+    """
+    cur.execute("select name from sqlite_master where type = 'index'")
+    existing: Set[str] = {name for (name,) in cur.fetchall()}
+    missing: List[Tuple[str, str, str]] = [
+        (name, table, columns)
+        for name, table, columns in INDEXES
+        if (name not in existing) and ((table != "tars") or tars_table_exists(cur))
+    ]
+    if not missing:
+        return
+    try:
+        for name, table, columns in missing:
+            logger.debug(f"Creating index {name} on {table} ({columns})")
+            cur.execute(f"create index if not exists {name} on {table} ({columns})")
+        con.commit()
+    except sqlite3.OperationalError as e:
+        # e.g. a read-only database, which can still be used without them
+        logger.debug(f"Could not create the indexes: {e}")
+        con.rollback()
+
+
+def create_matches_table(
+    cur: sqlite3.Cursor, patterns: List[str], tars_only: bool = False
+) -> List[str]:
+    """
+    Fill the temporary table `matches` with the ids of the files
+    whose name or tar matches one of the GLOB `patterns`, each id once.
+    Each pattern is looked up on its own, so it can use the indexes.
+    Return the patterns that matched nothing.
+    """
+    condition: str = "tar GLOB ?" if tars_only else "name GLOB ? or tar GLOB ?"
+    cur.execute("drop table if exists temp.matches")
+    cur.execute("create temp table matches (id integer primary key)")
+    unmatched: List[str] = []
+    for pattern in patterns:
+        params: Tuple[str, ...] = (pattern,) if tars_only else (pattern, pattern)
+        cur.execute(
+            f"insert or ignore into matches select id from files where {condition}",
+            params,
+        )
+        if cur.rowcount == 0:
+            # Maybe only files already matched by another pattern
+            cur.execute(
+                f"select exists (select 1 from files where {condition})", params
+            )
+            if not cur.fetchone()[0]:
+                unmatched.append(pattern)
+    return unmatched
+
+
+def chunks_table_exists(cur: sqlite3.Cursor) -> bool:
+    cur.execute("PRAGMA table_info(chunks);")
+    return cur.fetchall() != []
+
+
 def tars_table_exists(cur: sqlite3.Cursor) -> bool:
     # https://stackoverflow.com/questions/1601151/how-do-i-check-in-sqlite-whether-a-table-exists
     cur.execute("PRAGMA table_info(tars);")